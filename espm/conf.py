@@ -54,6 +54,12 @@ DEFAULT_EDXS_PARAMS = {
 
 log_shift = 1e-14
 dicotomy_tol = 1e-5
+# Loosest tolerance of the dichotomy when it follows the relative change of the iterates (adaptive_dicotomy_tol of SmoothNMF)
+dicotomy_tol_max = 1e-2
 seed_max = 4294967295
 sigmaL = 8
 maxit_dichotomy = 100
+# Relative threshold (w.r.t. the maximum of each column) below which the entries of a sparse G matrix are dropped
+sparse_G_tol = 1e-8
+# Size in bytes of the temporaries of a tile of pixels in the fused KL kernel (kl_products), about the size of a L2 cache
+tile_bytes = 2**20
@@ -1,19 +1,20 @@
 import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils.validation import check_is_fitted
-from espm.estimators.updates import initialize_algorithms
-from espm.measures import KLdiv_loss, Frobenius_loss, find_min_angle, find_min_MSE
+from sklearn.utils import check_random_state
+from espm.estimators.updates import initialize_algorithms, initialize_W, G_matmul, compile_fixed, compile_indices, l2_products, update_l2_products
+from espm.measures import KLdiv_loss, Frobenius_loss, Frobenius_loss_products, find_min_angle, find_min_MSE
 from espm.conf import log_shift
 from espm.utils import rescaled_DH
 import time
 from abc import ABC, abstractmethod
-from espm.utils import create_laplacian_matrix 
-from scipy.sparse import lil_matrix
+from espm.utils import LaplacianOperator
+from scipy.sparse import issparse, identity, csr_matrix
 from espm.models.base import PhysicalModel
 
 
 def normalization_factor (X, nc) : 
-    m = np.mean(X)
+    m = X.mean() if issparse(X) else np.mean(X)
     return nc/(m*X.shape[0])
 
 class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
@@ -54,6 +55,11 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
 
     While the code will work, it is not recommended to use the Frobenius norm as a loss function. This code is optimized for the KL divergence.
 
+    The data matrix :math:`X` can also be given as a `scipy.sparse` matrix. This is useful for EDX spectrum images 
+    where most of the channels of a pixel contain zero counts. In that case, the KL updates and the loss evaluate the 
+    ratio :math:`X / GWH` and the log terms only at the non-zero entries of :math:`X`. The sparse format is only 
+    implemented for the KL divergence.
+
     The size of:
 
     * :math:`X` is :math:`(n, p)`,
@@ -62,7 +68,8 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     * :math:`G` is :math:`(n, m)`.
 
     The columns of the matrices :math:`H` and :math:`X` are assumed to be images. This is used typically for the smoothness regularization.
-    The parameter `shape_2d` defines the shape of the images, i.e. `shape_2d[0]*shape_2d[1] = p`.
+    The parameter `shape_2d` defines the shape of the images, i.e. `shape_2d[0]*shape_2d[1] = p`. A line scan (shape of 
+    length 1) or a volume (shape of length 3) can also be used.
 
     Parameters
     ----------
@@ -89,9 +96,11 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     G : np.array, function or None, default=None
         If np.array, it is the known matrix of the data. 
         If function, it is a function that takes as input the data matrix and returns the known matrix (np.array). 
-        If None, it is assumed that G is the identity matrix.
+        If None, it is assumed that G is the identity matrix. In that case, no G matrix is built: the attribute `G_` is None 
+        and the products with G are skipped.
     shape_2d : tuple or None, default=None
-        If not None, it is the image shape of the columns of the matrices  :math:`X` and  :math:`H`.
+        If not None, it is the image shape of the columns of the matrices  :math:`X` and  :math:`H`. The Laplacian is 
+        then the matrix-free operator :class:`espm.utils.LaplacianOperator` of this shape.
     normalize : bool, default=False
         If True, the algorithm will normalize the data matrix  :math:`X`.
     log_shift : float, default=1e-10
@@ -110,6 +119,34 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         Note that convergence is not guaranteed with fixed_W enabled.
     no_stop_criterion : bool, default=False
         If True, the algorithm will not stop when the stopping criterion is reached and will continue until max_iter is reached.
+    dtype : np.float32, np.float64 or None, default=None
+        Floating point type used for the computations. If not None, the matrices :math:`X`, :math:`G`, :math:`W`, :math:`H` 
+        and the Laplacian are cast to this type, so that all the updates run in this precision. The losses are always accumulated in float64.
+        Using np.float32 halves the memory footprint and the memory bandwidth of the updates.
+        If None, the type of :math:`X` is kept (float64 or float32) and the other matrices are not cast.
+    memory_budget : int or None, default=None
+        If not None, the algorithm runs out-of-core: :math:`X` (typically a `np.memmap` or an on-disk array supporting 
+        slicing, such as a h5py dataset) is never loaded nor copied in memory. It is read by blocks of pixels (columns of :math:`X`) 
+        whose size is chosen such that a block and its temporaries use about `memory_budget` bytes. 
+        This mode is only available with the KL divergence and requires the estimator to support it (see `SmoothNMF`). 
+        If no initial guess is given, :math:`H` is initialized randomly. For a C-ordered memmap, reading is faster 
+        when the pixels are the first axis of the array, i.e. with `hspy_comp=True`.
+    n_jobs : int or None, default=None
+        Number of threads used to compute the main terms of the KL updates, which are processed by tiles of pixels 
+        (see :func:`espm.estimators.updates.kl_products`). None means one thread and -1 means one thread per CPU.
+    check_every : int, default=1
+        Number of iterations between two evaluations of the stopping criterion. The loss, the relative changes of W and H 
+        and the ground truth metrics are only computed (and stored in `losses_`, `rel_`, ...) for these iterations, 
+        and W and H are only copied for them. The relative changes are the ones of the last iteration while the decrease 
+        of the loss is measured between two evaluations. With 1, the criterion is checked at every iteration.
+    check_subsample : int or None, default=None
+        If not None, the relative change of H is evaluated on a random subset of `check_subsample` pixels (columns of H), 
+        drawn once using `random_state`. Only these columns of H are then copied. If None, all the pixels are used.
+    lazy_loss : bool, default=False
+        If True, the KL loss of an iterate is assembled from the products computed by the update of the next iteration 
+        instead of being recomputed. The losses (and the stopping criterion) are thus reported one iteration late, but 
+        their evaluation is almost free. This is only effective for algorithms storing these products in the workspace 
+        (see `SmoothNMF`) and for a dense data matrix.
     hspy_comp : bool, default=False
         If True, the algorithm will use the format compatible with hyperspy.
         Use this option if you run the algorithm with the method decompositio in hyperspy.
@@ -121,12 +158,15 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     """
     loss_names_ = ["KL_div_loss"]
     const_KL_ = None
+    block_size_ = None
+    workspace_ = None
     
     def __init__(self, n_components=2, init=None, tol=1e-4, max_iter=200,
                  random_state=None, verbose=1, debug=False,
                  l2=False,  G=None, shape_2d = None, normalize = False, log_shift=log_shift, 
                  eval_print=10, true_D = None, true_H = None, fixed_H = None, fixed_W = None, hspy_comp = False, 
-                 no_stop_criterion = False, simplex_H=False, simplex_W = True
+                 no_stop_criterion = False, simplex_H=False, simplex_W = True, dtype = None, 
+                 memory_budget = None, n_jobs = None, lazy_loss = False, check_every = 1, check_subsample = None
                  ):
         self.n_components = n_components
         self.init = init
@@ -149,6 +189,12 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         self.no_stop_criterion = no_stop_criterion
         self.simplex_H = simplex_H
         self.simplex_W = simplex_W
+        self.dtype = dtype
+        self.memory_budget = memory_budget
+        self.n_jobs = n_jobs
+        self.lazy_loss = lazy_loss
+        self.check_every = check_every
+        self.check_subsample = check_subsample
 
     def _more_tags(self):
         return {'requires_positive_X': True}
@@ -156,6 +202,21 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     @abstractmethod
     def _iteration(self,  W, H):
         pass
+
+    def _restart(self):
+        """Called by the fit loop when the loss increased during the last iteration.
+
+        An estimator that takes extrapolated steps can go back to its previous iterate (setting W_ and H_) and return True, 
+        the iteration is then not taken into account by the stopping criterion. By default, it returns False.
+        """
+        return False
+
+    def _reference_loss(self, eval_before):
+        """Loss to which the loss after an iteration is compared (by the restart and the negative decrease stop).
+
+        By default, it is the loss before the iteration. A nonmonotone method can return a larger value.
+        """
+        return eval_before
     
 
     def loss(self, W, H, average=True, X = None):
@@ -180,21 +241,108 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
             Value of the loss function.
 
         """
-        GW = self.G_ @ W
+        GW = self._GW(W)
+        if X is None and self.block_size_ is not None : 
+            return self._loss_blocks(GW, H, average=average)
+        x_log = self._cached_x_log(W, H) if X is None else None
+        products = self._l2_products() if X is None and self.l2 else None
         if X is None : 
             X = self.X_
 
-        assert(X.shape == (self.G_.shape[0],H.shape[1]))
+        assert(X.shape == (GW.shape[0],H.shape[1]))
 
-        self.GWH_numel_ = self.G_.shape[0] * H.shape[1]
+        self.GWH_numel_ = GW.shape[0] * H.shape[1]
         
-        if self.l2:
+        if products is not None:
+            # Evaluated from the Gram products of the data, without n x p temporaries
+            loss_ = 0.5*Frobenius_loss_products(*products, W, H)
+        elif self.l2:
             loss_ = 0.5*Frobenius_loss(X, GW, H, average=False) 
         else:
             if self.const_KL_ is None:
-                self.const_KL_ = np.sum(X*np.log(np.maximum(self.X_, self.log_shift))) - np.sum(X) 
+                if issparse(X):
+                    # Zero entries of X do not contribute to the constant
+                    self.const_KL_ = np.sum(X.data*np.log(np.maximum(X.data, self.log_shift))) - X.sum()
+                else:
+                    self.const_KL_ = np.sum(X*np.log(np.maximum(self.X_, self.log_shift))) - np.sum(X) 
+
+            if x_log is None:
+                loss_ =  KLdiv_loss(X, GW, H, self.log_shift, average=False) + self.const_KL_
+            else:
+                # The log term was computed by the update, the linear term is obtained in closed form
+                x_lin = np.sum(np.maximum(GW, self.log_shift), axis=0, dtype=np.float64) @ np.sum(np.maximum(H, self.log_shift), axis=1, dtype=np.float64)
+                loss_ = x_lin - x_log + self.const_KL_
+        if average:
+            loss_ = loss_ / self.GWH_numel_
+        self.detailed_loss_ = [loss_]
+        return loss_
 
-            loss_ =  KLdiv_loss(X, GW, H, self.log_shift, average=False) + self.const_KL_
+    def _GW(self, W):
+        """Product G_ @ W, cached in the workspace so that the loss and the updates of the same W share it."""
+        cached = self.workspace_.get("GW") if self.workspace_ is not None else None
+        if cached is not None and cached[0] is self.G_ and cached[1] is W:
+            return cached[2]
+        GW = G_matmul(self.G_, W)
+        if self.workspace_ is not None:
+            self.workspace_["GW"] = (self.G_, W, GW)
+        return GW
+
+    def _l2_products(self):
+        """Products G_.T @ G_, G_.T @ X_ and squared norm of X_ of the l2 loss (see `l2_products`), cached in the workspace.
+        When G_ is updated by the physics model, only the products of its changed columns are recomputed (see `update_l2_products`)."""
+        cached = self.workspace_.get("l2_products") if self.workspace_ is not None else None
+        if cached is None or cached[0] is not self.G_:
+            products = None if cached is None else update_l2_products(cached[1:], self.X_, cached[0], self.G_)
+            if products is None:
+                products = l2_products(self.X_, self.G_)
+            cached = (self.G_,) + tuple(products)
+            if self.workspace_ is not None:
+                self.workspace_["l2_products"] = cached
+        return cached[1:]
+
+    def _check_pixels(self, H, copy=False):
+        """Columns of H used to evaluate its relative change (see `check_subsample`). The subset of columns is always a copy."""
+        if self.check_pixels_ is None:
+            return H.copy() if copy else H
+        return H[:, self.check_pixels_]
+
+    def _buffer(self, name, A, avoid=None):
+        """Preallocated array of the shape of A, owned by the estimator, in which the update of A can be written.
+
+        The returned buffer is never A itself (nor avoid): two buffers are used alternately, a third one is allocated 
+        if avoid is one of them. The workspace entries computed from the returned buffer are removed since it is about to be overwritten.
+        """
+        buffers = self.workspace_.get(name)
+        if buffers is None or buffers[0].shape != A.shape or buffers[0].dtype != A.dtype:
+            buffers = self.workspace_[name] = [np.empty_like(A), np.empty_like(A)]
+        out = next((b for b in buffers if b is not A and b is not avoid), None)
+        if out is None:
+            out = np.empty_like(A)
+            buffers.append(out)
+        for key, entry in list(self.workspace_.items()):
+            if isinstance(entry, tuple) and any(a is out for a in entry):
+                del self.workspace_[key]
+        return out
+
+    def _cached_x_log(self, W, H):
+        """Log term of the KL loss at W and H if it was stored in the workspace by an update, None otherwise."""
+        cached = self.workspace_.get("x_log") if self.workspace_ is not None else None
+        if cached is not None and cached[0] is self.G_ and cached[1] is W and cached[2] is H:
+            return cached[3]
+        return None
+
+    def _loss_blocks(self, GW, H, average=True):
+        """Out-of-core version of the KL loss, accumulated over the blocks of pixels of `self.X_`."""
+        self.GWH_numel_ = GW.shape[0] * H.shape[1]
+        compute_const = self.const_KL_ is None
+        const_KL, loss_ = 0.0, 0.0
+        for sl, Xb in self._X_blocks():
+            if compute_const:
+                const_KL += np.sum(Xb*np.log(np.maximum(Xb, self.log_shift)), dtype=np.float64) - np.sum(Xb, dtype=np.float64)
+            loss_ += KLdiv_loss(Xb, GW, H[:, sl], self.log_shift, average=False)
+        if compute_const:
+            self.const_KL_ = const_KL
+        loss_ = loss_ + self.const_KL_
         if average:
             loss_ = loss_ / self.GWH_numel_
         self.detailed_loss_ = [loss_]
@@ -216,7 +364,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         Parameters
         ----------
         X : {array-like, sparse matrix} of shape (n, p)
-            Data matrix to be decomposed
+            Data matrix to be decomposed. If X is a scipy.sparse matrix, the sparse KL path is used.
         y : Ignored
             Not used, present here for API consistency by convention.
         W : array-like of shape (m, k)
@@ -233,10 +381,21 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         ############################
         # Initialize the algorithm #
         ############################
-        if self.hspy_comp : 
-            self.X_ = self._validate_data(X.T, dtype=[np.float64, np.float32])
+        if self.memory_budget is not None : 
+            # Out-of-core mode: X is kept on disk and read by blocks
+            self._prepare_blocks(X)
         else : 
-            self.X_ = self._validate_data(X, dtype=[np.float64, np.float32])
+            self.block_size_ = None
+            dtype = [np.float64, np.float32] if self.dtype is None else self.dtype
+            if self.hspy_comp : 
+                self.X_ = self._validate_data(X.T, accept_sparse=('csr', 'csc'), dtype=dtype)
+            else : 
+                self.X_ = self._validate_data(X, accept_sparse=('csr', 'csc'), dtype=dtype)
+
+        if issparse(self.X_):
+            if self.l2:
+                raise ValueError("Sparse data matrices are only supported with the KL divergence (l2=False).")
+            self.X_ = csr_matrix(self.X_)
 
         if self.hspy_comp==False:
             try:
@@ -250,14 +409,18 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
             except:
                 pass
 
-        # The algorithm does not work when full columns or lines of X are zero
-        self.X_ = self.remove_zeros_lines(self.X_, self.log_shift)
-
         self.const_KL_ = None
-        if self.normalize : 
-            # We normalize the data so that the strength of the regularization is somewhat the same for all datasets
-            self.norm_factor_ = normalization_factor(self.X_,self.n_components)
-            self.X_ = self.norm_factor_ * self.X_
+        # Products shared between the updates and the loss evaluation of an iteration
+        self.workspace_ = {}
+        # In out-of-core mode, the zero lines and columns and the normalization are applied to each block when it is read
+        if self.block_size_ is None : 
+            # The algorithm does not work when full columns or lines of X are zero
+            self.X_ = self.remove_zeros_lines(self.X_, self.log_shift)
+
+            if self.normalize : 
+                # We normalize the data so that the strength of the regularization is somewhat the same for all datasets
+                self.norm_factor_ = normalization_factor(self.X_,self.n_components)
+                self.X_ = self._cast(self.norm_factor_ * self.X_)
         
         if isinstance(self.G, PhysicalModel):
             self.physics_model_ = self.G
@@ -265,23 +428,36 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         else:
             self.physics_model_ = None
             G = self.G
+        G = self._cast(G)
         
-        self.G_, self.W_, self.H_ = initialize_algorithms(X = self.X_,
-                                                          G = G,
-                                                          W = W,
-                                                          H = H,
-                                                          n_components = self.n_components,
-                                                          init = self.init,
-                                                          random_state = self.random_state,
-                                                          simplex_H = self.simplex_H,
-                                                          simplex_W = self.simplex_W,
-                                                          physics_model = self.physics_model_)
+        if self.block_size_ is not None : 
+            self.G_, self.W_, self.H_ = self._initialize_blocks(G, W, H)
+        else : 
+            self.G_, self.W_, self.H_ = initialize_algorithms(X = self.X_,
+                                                              G = G,
+                                                              W = W,
+                                                              H = H,
+                                                              n_components = self.n_components,
+                                                              init = self.init,
+                                                              random_state = self.random_state,
+                                                              simplex_H = self.simplex_H,
+                                                              simplex_W = self.simplex_W,
+                                                              physics_model = self.physics_model_)
+        self.W_, self.H_ = self._cast(self.W_), self._cast(self.H_)
         
+        self._compile_constraints()
+
+        L_dtype = np.float32 if self.dtype is None else self.dtype
         if not(self.shape_2d is None) :
-            self.L_ = create_laplacian_matrix(*self.shape_2d)
+            self.L_ = LaplacianOperator(self.shape_2d, dtype=L_dtype)
         else : 
-            self.L_ =lil_matrix((self.X_.shape[1],self.X_.shape[1]),dtype=np.float32)
-            self.L_.setdiag([1]*self.X_.shape[1])
+            self.L_ = identity(self.H_.shape[1], dtype=L_dtype, format="csr")
+
+        if self.check_subsample is not None and self.check_subsample < self.H_.shape[1] : 
+            rng = check_random_state(self.random_state)
+            self.check_pixels_ = np.sort(rng.choice(self.H_.shape[1], size=self.check_subsample, replace=False))
+        else : 
+            self.check_pixels_ = None
 
         algo_start = time.time()
         eval_before = np.inf
@@ -305,15 +481,43 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         #############
         try:
             while True:
+                # The stopping criterion is only checked every check_every iterations (and at the last one). 
+                # W and H are only copied for these iterations.
+                check = (self.n_iter_ + 1) % self.check_every == 0 or self.n_iter_ + 1 >= self.max_iter
+                if check:
+                    old_W, old_H = self.W_.copy(), self._check_pixels(self.H_, copy=True)
+                W_in, H_in = self.W_, self.H_
+
                 # Take one step in W, H
-                old_W, old_H = self.W_.copy(), self.H_.copy()
-                
                 self.W_, self.H_ = self._iteration(self.W_, self.H_ )
-                eval_after = self.loss(self.W_, self.H_)
                 self.n_iter_ +=1
+
+                if not check:
+                    if self.physics_model_ != None and self.n_iter_%3 == 0: 
+                        self.G_ = self._cast(self.physics_model_.NMF_update(self.W_))
+                        # The reference loss with the new G is only used at the next check: it is evaluated 
+                        # after the last update of G before that check
+                        next_check = min((self.n_iter_ // self.check_every + 1) * self.check_every, self.max_iter)
+                        if self.lazy_loss:
+                            eval_before = np.inf
+                        elif self.n_iter_ + 3 >= next_check:
+                            eval_before = self.loss(self.W_, self.H_)
+                    continue
+
+                if self.lazy_loss:
+                    # The loss of the previous iterate was computed by the updates of this iteration
+                    eval_after = self.loss(W_in, H_in)
+                else:
+                    eval_after = self.loss(self.W_, self.H_)
+
+                eval_ref = self._reference_loss(eval_before)
+                if eval_after > eval_ref and self.n_iter_ < self.max_iter and self._restart():
+                    # The estimator went back to its previous iterate, whose loss is eval_before
+                    continue
                 
+                H_check = self._check_pixels(self.H_)
                 rel_W = np.max(np.abs((self.W_ - old_W))/(self.W_ + self.tol*np.mean(self.W_) ))
-                rel_H = np.max(np.abs((self.H_ - old_H))/(self.H_ + self.tol*np.mean(self.H_) ))
+                rel_H = np.max(np.abs((H_check - old_H))/(H_check + self.tol*np.mean(H_check) ))
 
                 # store some information for assessing the convergence
                 # for debugging purposes
@@ -330,7 +534,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                             W, H = self.W_, self.H_ 
                         else:
                             W, H = rescaled_DH(self.W_, self.H_ )
-                        GW = self.G_ @ W
+                        GW = G_matmul(self.G_, W)
                         angles = find_min_angle(self.true_D.T,GW.T, unique=True)
                         mse = find_min_MSE(self.true_H, H,unique=True)
                         loss = self.loss(self.W_,H, X = true_DH )
@@ -365,7 +569,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                         print("exit because of the presence of NaN")
                         break
 
-                    elif (eval_before - eval_after) < 0:
+                    elif (eval_ref - eval_after) < 0:
                         print("exit because of negative decrease {}: {}, {}".format((eval_before - eval_after), eval_before, eval_after))
                         break
                 
@@ -377,8 +581,15 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                 # Update G might increase the loss so we reevaluate the loss to avoid artificial negative decrease
                 # We do this update every 3 iterations, but it is arbitrary.
                 if self.physics_model_ != None and self.n_iter_%3 == 0: 
-                    self.G_ = self.physics_model_.NMF_update(self.W_)
-                    eval_before = self.loss(self.W_, self.H_)
+                    self.G_ = self._cast(self.physics_model_.NMF_update(self.W_))
+                    if self.lazy_loss:
+                        # The next reported loss is the one of the current iterate with the new G, the decrease is not checked
+                        eval_before = np.inf
+                    else:
+                        eval_before = self.loss(self.W_, self.H_)
+                elif self.lazy_loss and self.n_iter_ == 1:
+                    # The first loss reported in lazy mode is the one of the initialization, the next one is not compared to it
+                    eval_before = np.inf
                 else :
                     eval_before = eval_after
         except KeyboardInterrupt:
@@ -400,7 +611,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         if self.normalize : 
             self.W_ = self.W_ / self.norm_factor_
         
-        GW = self.G_ @ self.W_
+        GW = G_matmul(self.G_, self.W_)
         self.n_components_ = self.H_.shape[0]
         
         if self.hspy_comp : 
@@ -465,7 +676,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         
         """
         check_is_fitted(self)
-        return self.G_ @ W @ self.H_
+        return G_matmul(self.G_, W) @ self.H_
     
     def get_losses(self):
         """
@@ -507,7 +718,111 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
 
         return array
 
+    def _cast(self, A) : 
+        r"""Cast a matrix (np.ndarray or scipy.sparse) to the computation type `dtype`. None is returned as is."""
+        if self.dtype is None or A is None : 
+            return A
+        return A.astype(self.dtype, copy=False)
+
+    def _compile_constraints(self) : 
+        r"""Compile fixed_W, fixed_H (see :class:`espm.estimators.updates.FixedEntries`) and the rows of W on which the 
+        simplex constraint is applied once, in the attributes `fixed_W_`, `fixed_H_` and `simplex_indices_`."""
+        self.fixed_W_ = compile_fixed(self.fixed_W)
+        self.fixed_H_ = compile_fixed(self.fixed_H)
+        if self.simplex_W and self.physics_model_ is not None : 
+            self.simplex_indices_ = compile_indices(self.physics_model_.NMF_simplex())
+        else : 
+            self.simplex_indices_ = None
+
+    def _prepare_blocks(self, X) : 
+        r"""Prepare the out-of-core mode for the data X, which is kept as is in `self.X_`.
+
+        The block size is chosen from `memory_budget` and a first pass over the blocks checks the data 
+        and computes the zero lines and columns of :math:`X` as well as the normalization factor.
+        """
+        if issparse(X) : 
+            raise ValueError("Sparse data matrices are not supported in out-of-core mode.")
+        if self.l2 : 
+            raise ValueError("The out-of-core mode is only supported with the KL divergence (l2=False).")
+        if len(X.shape) != 2 : 
+            raise ValueError("Expected a 2D data matrix, got an array of shape {}.".format(X.shape))
+        self.X_ = X
+        self.n_features_in_ = X.shape[1]
+        n, p = X.shape[::-1] if self.hspy_comp else X.shape
+        if self.dtype is not None : 
+            self.block_dtype_ = np.dtype(self.dtype)
+        elif X.dtype in (np.float32, np.float64) : 
+            self.block_dtype_ = np.dtype(X.dtype)
+        else : 
+            self.block_dtype_ = np.dtype(np.float64)
+        # A block of X comes with about three temporaries of the same size in the updates
+        self.block_size_ = int(min(p, max(1, self.memory_budget // (4 * n * self.block_dtype_.itemsize))))
+
+        self.zero_rows_, self.zero_cols_, self.norm_factor_ = None, None, 1.0
+        sum_rows = np.zeros(n)
+        sum_cols = np.zeros(p)
+        for sl, Xb in self._X_blocks() : 
+            if np.any(Xb < 0) : 
+                raise ValueError("There are negative values in X")
+            sum_rows += np.sum(Xb, axis=1, dtype=np.float64)
+            sum_cols[sl] = np.sum(Xb, axis=0, dtype=np.float64)
+        self.zero_rows_ = sum_rows == 0
+        self.zero_cols_ = sum_cols == 0
+
+        if self.normalize : 
+            # Same factor as `normalization_factor` applied to X with its zero lines and columns filled
+            n_rows, n_cols = np.sum(self.zero_rows_), np.sum(self.zero_cols_)
+            n_filled = n_rows * p + n_cols * n - n_rows * n_cols
+            mean = (np.sum(sum_rows) + n_filled * self.log_shift) / (n * p)
+            self.norm_factor_ = self.n_components / (mean * n)
+
+    def _X_blocks(self) : 
+        r"""Iterate over the blocks of pixels of the data in out-of-core mode.
+
+        Yields the slice of the pixels and the corresponding block of :math:`X` of shape (n, block_size_), 
+        read from `self.X_` and processed as in the in-memory mode (zero lines and columns, normalization).
+        """
+        p = self.X_.shape[0] if self.hspy_comp else self.X_.shape[1]
+        for start in range(0, p, self.block_size_) : 
+            sl = slice(start, min(start + self.block_size_, p))
+            Xb = self.X_[sl, :].T if self.hspy_comp else self.X_[:, sl]
+            Xb = np.array(Xb, dtype=self.block_dtype_)
+            if self.zero_rows_ is not None : 
+                Xb[:, self.zero_cols_[sl]] = self.log_shift
+                Xb[self.zero_rows_, :] = self.log_shift
+                if self.normalize : 
+                    Xb *= self.block_dtype_.type(self.norm_factor_)
+            yield sl, Xb
+
+    def _initialize_blocks(self, G, W, H) : 
+        r"""Out-of-core version of `initialize_algorithms`. If no initial guess is given, H is initialized randomly."""
+        n, p = self.zero_rows_.shape[0], self.zero_cols_.shape[0]
+        if W is None:
+            if H is None:
+                rng = check_random_state(self.random_state)
+                H = rng.uniform(size=(self.n_components, p))
+                if self.simplex_H:
+                    H = H / np.sum(H, axis=0, keepdims=True)
+            # Least squares estimate of GW from the normal equations, accumulated over the blocks
+            XHt = np.zeros((n, self.n_components))
+            for sl, Xb in self._X_blocks():
+                XHt += Xb @ H[:, sl].T
+            D = np.abs(np.linalg.solve(H @ H.T, XHt.T).T)
+            W = initialize_W(D, G, self.simplex_W, physics_model=self.physics_model_)
+        elif H is None:
+            pinvD = np.linalg.pinv(G_matmul(G, W))
+            H = np.empty((self.n_components, p))
+            for sl, Xb in self._X_blocks():
+                H[:, sl] = np.abs(pinvD @ Xb)
+            if self.simplex_H:
+                H = H / np.sum(H, axis=0, keepdims=True)
+        W = np.maximum(W, log_shift)
+        H = np.maximum(H, log_shift)
+        return G, W, H
+
     def remove_zeros_lines (self, X, epsilon) : 
+        if issparse(X):
+            return self.remove_zeros_columns_sparse(X, epsilon)
         if np.all(X >= 0) : 
             new_X = X.copy()
             sum_cols = X.sum(axis = 0)
@@ -518,3 +833,20 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         else : 
             raise ValueError("There are negative values in X")
 
+    def remove_zeros_columns_sparse (self, X, epsilon) : 
+        """Sparse version of `remove_zeros_lines`.
+
+        Only the zero columns (pixels) are filled with epsilon, which keeps the number of stored entries small.
+        Zero lines (channels) are left untouched since they do not contribute to the sparse KL terms.
+        """
+        if (X.data < 0).any() : 
+            raise ValueError("There are negative values in X")
+        new_X = csr_matrix(X, copy=True)
+        new_X.eliminate_zeros()
+        zero_cols = np.where(np.asarray(new_X.sum(axis=0)).ravel() == 0)[0]
+        if len(zero_cols) > 0 : 
+            rows = np.repeat(np.arange(X.shape[0]), len(zero_cols))
+            cols = np.tile(zero_cols, X.shape[0])
+            fill = csr_matrix((epsilon*np.ones(len(rows), dtype=X.dtype), (rows, cols)), shape=X.shape)
+            new_X = new_X + fill
+        return new_X
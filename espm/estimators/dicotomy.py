@@ -1,16 +1,29 @@
 import numpy as np
 from espm.conf import dicotomy_tol, log_shift, maxit_dichotomy
 
-def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
+def _columns(A, cols):
+    """
+    Select the columns cols of A. Arrays with a single column are broadcasted and returned as they are.
+    """
+    if A.ndim < 2 or A.shape[1] == 1:
+        return A
+    return A[:, cols]
+
+def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy, nu0=None):
     """
     Function to solve the num/(x+denum) -1 = 0 equation. Here, x is the Lagragian multiplier which is used to apply the simplex constraint.
-    The first part consists in finding a and b such that num/(a+denum) -1 > 0 and num/(b+denum) -1  < 0. 
-    The second part applies the dichotomy algorithm to solve the equation.
+    The first part consists in finding a and b such that num/(a+denum) -1 > 0 and num/(b+denum) -1  < 0.
+    The second part solves the equation with a safeguarded Newton method (see dicotomy).
+    If given, nu0 (typically the multiplier of the previous iteration) is used as the starting point. For 2 or 3 components, 
+    the closed-form solution (see simplex_root_small) is used instead, so that most columns are solved in a single evaluation.
     """
     # The function has exactly one root at the right of the first singularity (the singularity at min(denum))
-    
-    # num = num.astype("float64")
-    # denum = denum.astype("float64")
+    # For 2 or 3 components, the root is known in closed form (without the log_shift clipping) and is used as the starting point.
+
+    # The dichotomy is cheap compared to the updates, it is always solved in float64 to avoid rounding issues with float32 inputs
+    dtype = np.result_type(num, denum, np.float32)
+    num = num.astype("float64")
+    denum = denum.astype("float64")
 
     # do some test
 
@@ -24,72 +37,117 @@ def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=m
         denum_max = num/log_shift
     else:
         denum_max = np.inf
-    # Ideally we want to do this, but we have to exclude the case where num==0.
-    # a = np.max(num/2 - denum, axis=0)
-    if denum.shape[1]>1:
-        a = []
-        for n,d in zip(num.T, denum.T):
-            m = n>0
-            # The divided by 2 is just a factor to help a bit.
-            a.append(np.max(n[m]/2 - d[m]))
-        a = np.array(a)
-    else: 
-        # This else is just to preserve the size and make it work in any case...
-        # There might be a possiblity to write this more elegantly
-        d = denum[:,0]
-        def max_masked(n):
-            m = n>0
-            return np.max(n[m]/2-d[m])
-        a = np.apply_along_axis(max_masked, 0, num)
-        
-        
+    # We want a = np.max(num/2 - denum, axis=0), excluding the entries where num==0.
+    # The divided by 2 is just a factor to help a bit.
+    a = np.max(np.where(num>0, num/2 - denum, -np.inf), axis=0)
+
     # r = np.sum(num/denum, axis=0)
     # b = np.zeros(r.shape)
     # b[r>=1] = (len(num) * np.max(num, axis=0)/0.5 - np.min(denum, axis=0))[r>=1]
     b = len(num) * np.max(num, axis=0)/0.5 - np.min(denum, axis=0)
 
-    def func(x):
-        new_x = x + denum
-        return np.sum(np.maximum(num / new_x, log_shift), axis=0) - 1
+    def func(x, cols=slice(None)):
+        new_x = x + _columns(denum, cols)
+        return np.sum(np.maximum(num[:, cols] / new_x, log_shift), axis=0) - 1
 
-    return dicotomy(a, b, func, maxit, tol)
+    def dfunc(x, cols=slice(None)):
+        # Derivative of func, the entries clipped at log_shift do not contribute
+        new_x = x + _columns(denum, cols)
+        r = num[:, cols] / new_x
+        return - np.sum(np.where(r > log_shift, r / new_x, 0), axis=0)
 
-def dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
+    if len(num) in (2, 3):
+        # With a zero in num, the largest root of the polynomial can be a singularity: these columns are started from scratch
+        nu0 = np.where(np.all(num>0, axis=0), simplex_root_small(num, denum), np.nan)
+
+    return dicotomy(a, b, func, maxit, tol, dfunc=dfunc, x0=nu0).astype(dtype, copy=False)
+
+def simplex_root_small(num, denum):
+    """
+    Closed-form solution of sum(num/(x+denum), axis=0) = 1 for 2 or 3 rows (components).
+
+    Multiplying by the product of the (x+denum) gives a polynomial of degree 2 or 3 whose largest real root is the root 
+    at the right of the singularities. The log_shift clipping of `dichotomy_simplex` is not taken into account, so that 
+    the result is meant as a starting point for `dicotomy`, which checks it (it is exact unless some entries are clipped).
+    """
+    d = np.broadcast_to(denum, num.shape)
+    if len(num) == 2:
+        # x^2 + B x + C = 0
+        B = d[0] + d[1] - num[0] - num[1]
+        C = d[0]*d[1] - num[0]*d[1] - num[1]*d[0]
+        sq = np.sqrt(np.maximum(B**2 - 4*C, 0))
+        # Largest root, written without cancellation
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(B >= 0, -2*C / (B + sq), (-B + sq) / 2)
+    elif len(num) == 3:
+        # x^3 + A x^2 + B x + C = 0
+        d01, d02, d12 = d[0]*d[1], d[0]*d[2], d[1]*d[2]
+        A = d[0] + d[1] + d[2] - num[0] - num[1] - num[2]
+        B = d01 + d02 + d12 - num[0]*(d[1] + d[2]) - num[1]*(d[0] + d[2]) - num[2]*(d[0] + d[1])
+        C = d01*d[2] - num[0]*d12 - num[1]*d02 - num[2]*d01
+        # Depressed cubic t^3 + p t + q = 0 with x = t - A/3
+        p = B - A**2/3
+        q = 2*A**3/27 - A*B/3 + C
+        disc = (q/2)**2 + (p/3)**3
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # One real root (Cardano)
+            sq = np.sqrt(np.maximum(disc, 0))
+            t_one = np.cbrt(-q/2 + sq) + np.cbrt(-q/2 - sq)
+            # Three real roots (trigonometric form), the largest one
+            r = np.sqrt(np.maximum(-p/3, 0))
+            t_three = 2*r*np.cos(np.arccos(np.clip(-q/2 / r**3, -1, 1))/3)
+        return np.where(disc > 0, t_one, t_three) - A/3
+    else:
+        raise ValueError("The closed-form solution is only implemented for 2 or 3 components")
+
+def dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy, nu0=None):
     """
     Function to solve the dicotomy for the function:
     f(nu) = n_p * nu_k + 2a - sum_p sqrt ( (b_p + nu)^2 - 4 a c_p) + sum_p b_p
 
-    The first part consists in finding nu_max and nu_min such that f(nu_max) > 0 and f(nu_min) < 0. 
-    The second part applies the dichotomy algorithm to solve the equation.
+    The first part consists in finding nu_max and nu_min such that f(nu_max) > 0 and f(nu_min) < 0.
+    The second part solves the equation with a safeguarded Newton method (see dicotomy).
+    If given, nu0 is used as the starting point.
     """
     # do some test
     assert(a>=0)
     assert((minus_c>=0).all())
 
+    # The dichotomy is always solved in float64 (see dichotomy_simplex)
+    dtype = np.result_type(b, minus_c, np.float32)
+    b = b.astype("float64")
+    minus_c = minus_c.astype("float64")
+
     if log_shift>0:
         # Check that a solution is possible
         if b.shape[0] * log_shift >= 1:
             raise ValueError("No solution exists!")
 
-    n_p = len(b) 
+    n_p = len(b)
     nu_max = n_p * np.max(b**2/a+2*a+2*(b+ minus_c), axis=0) * 1.5 + 1e-3
     nu_min = - (2 * a + np.sum(b, axis=0))/ n_p  * 1.1 - 1e-3
-    
-    def func(x):
-        return   2*a - np.sum( np.maximum(np.sqrt( (b + x)**2 + 4*a*minus_c) - x - b, log_shift*2*a), axis=0)
 
-    return dicotomy(nu_max, nu_min, func, maxit, tol)
+    def func(x, cols=slice(None)):
+        bx = _columns(b, cols) + x
+        return   2*a - np.sum( np.maximum(np.sqrt( bx**2 + 4*a*_columns(minus_c, cols)) - bx, log_shift*2*a), axis=0)
+
+    def dfunc(x, cols=slice(None)):
+        bx = _columns(b, cols) + x
+        s = np.sqrt( bx**2 + 4*a*_columns(minus_c, cols))
+        return - np.sum(np.where(s - bx > log_shift*2*a, bx / s - 1, 0), axis=0)
+
+    return dicotomy(nu_max, nu_min, func, maxit, tol, dfunc=dfunc, x0=nu0).astype(dtype, copy=False)
 
 def dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
     r"""
     Function to solve the dicotomy for the function:
 
-    .. :math:: 
+    .. :math::
 
-        f(\nu) = \sum_p \max \left( \alpha_p+\nu, \epsilon right) - 1 = 0 
+        f(\nu) = \sum_p \max \left( \alpha_p+\nu, \epsilon right) - 1 = 0
 
-    The first part consists in finding nu_max and nu_min such that f(nu_max) > 0 and f(nu_min) < 0. 
-    The second part applies the dichotomy algorithm to solve the equation.
+    The first part consists in finding nu_max and nu_min such that f(nu_max) > 0 and f(nu_min) < 0.
+    The second part solves the equation with a safeguarded Newton method (see dicotomy).
     """
 
     if log_shift>0:
@@ -98,17 +156,55 @@ def dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=dicotomy_to
             raise ValueError("No solution exists!")
 
 
+    # The dichotomy is always solved in float64 (see dichotomy_simplex)
+    dtype = np.result_type(a, np.float32)
+    a = a.astype("float64")
+
     nu_min = -np.max(a, axis=0)
     nu_max = 1/a.shape[0] - np.min(a, axis=0)
-    
-    def func(x):
-        return   np.sum( np.maximum(a + x, log_shift), axis=0) -1
+
+    def func(x, cols=slice(None)):
+        return   np.sum( np.maximum(_columns(a, cols) + x, log_shift), axis=0) -1
+
+    def dfunc(x, cols=slice(None)):
+        # func is piecewise linear, its slope is the number of entries above log_shift
+        return   np.sum( _columns(a, cols) + x > log_shift, axis=0).astype("float64")
+
+    return dicotomy(nu_max, nu_min, func, maxit, tol, dfunc=dfunc).astype(dtype, copy=False)
 
 
-    return dicotomy(nu_max, nu_min, func, maxit, tol)     
+def simplex_projection_shift(a, log_shift=log_shift):
+    r"""
+    Exact solution of the equation solved by `dichotomy_simplex_projected_gradient`:
+
+    .. :math::
 
+        f(\nu) = \sum_p \max \left( \alpha_p+\nu, \epsilon right) - 1 = 0
 
-def dicotomy(a, b, func, maxit, tol):
+    i.e. the shift of the Euclidean projection of every column of a on the simplex (with entries larger than log_shift).
+    f is piecewise linear: if the j largest entries of a column are the ones above log_shift, the solution is
+    nu_j = (1 - (n_p - j) * log_shift - sum of the j largest entries) / j. The columns are sorted once and the largest valid j
+    is found for all the columns at the same time, without iterations and without tolerance.
+    """
+    if log_shift>0:
+        # Check that a solution is possible
+        if a.shape[0] * log_shift >= 1:
+            raise ValueError("No solution exists!")
+
+    # The projection is always computed in float64 (see dichotomy_simplex)
+    dtype = np.result_type(a, np.float32)
+    a = a.astype("float64")
+
+    n_p = a.shape[0]
+    a_sorted = - np.sort(- a, axis=0)
+    j = np.arange(1, n_p + 1).reshape((-1,) + (1,) * (a.ndim - 1))
+    nu = (1 - (n_p - j) * log_shift - np.cumsum(a_sorted, axis=0)) / j
+    # The j largest entries are above log_shift for j = 1, ..., rho (at least j = 1 since n_p * log_shift < 1)
+    rho = np.sum(a_sorted + nu > log_shift, axis=0)
+    return np.take_along_axis(nu, np.expand_dims(rho - 1, axis=0), axis=0)[0].astype(dtype, copy=False)
+
+
+def dicotomy(a, b, func, maxit, tol, dfunc=None, x0=None):
     """
     Dicotomy algorithm searching for func(x)=0.
 
@@ -120,54 +216,87 @@ def dicotomy(a, b, func, maxit, tol):
     b : float or numpy array
         Upper bound of the interval such that func(b) < 0
     func : function
-        Function to solve
+        Function to solve. It is called as func(x, cols) where cols indexes the entries of x that are still
+        being solved.
     maxit : int
         Maximum number of iterations - the algorithm stops if |func(sol)| < tol
     tol : float
         Tolerance - the algorithm stops if |func(sol)| < tol
-    
+    dfunc : function, optional
+        Derivative of func, called as dfunc(x, cols). If given, a Newton step is tried at every iteration and
+        the bisection step is only used when the Newton step leaves the interval [a, b]. Otherwise, a plain
+        bisection is used.
+    x0 : float or numpy array, optional
+        Starting point, for instance the solution of a previous, similar problem. The entries of x0 that are not 
+        inside the interval [a, b] (or that do not have the shape of a) are replaced by the middle of the interval.
 
     Returns
     -------
     new : float or numpy array
         Solution of the equation func(new) = 0
 
-    This algorithm works for number or numpy array of any size.
+    This algorithm works for number or numpy array of any size. Each entry is solved independently:
+    only the entries that have not converged yet are evaluated, so that a few hard entries do not
+    slow down the whole problem.
     """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype="float64"), np.asarray(b, dtype="float64"))
+    shape = a.shape
+    a = a.ravel().copy()
+    b = b.ravel().copy()
+    all_cols = np.arange(a.size)
+
+    # Starting point: the middle of the interval or the warm start x0 when it is inside the interval
+    new = (a + b)/2
+    cold = all_cols
+    if x0 is not None and np.size(x0) == new.size:
+        x0 = np.asarray(x0, dtype="float64").ravel()
+        inside = (x0 > np.minimum(a, b)) & (x0 < np.maximum(a, b))
+        new[inside] = x0[inside]
+        cold = all_cols[np.logical_not(inside)]
 
-    func_max = func(a)
-    func_min = func(b)
+    # The interval is checked for the entries that are not warm started
+    func_max = func(a[cold], cold)
+    func_min = func(b[cold], cold)
 
     assert(np.sum(func_min>=0)==0)
     assert(np.sum(func_max<=0)==0)
     assert(np.sum(np.isnan(func_max))==0)
     assert(np.sum(np.isnan(func_min))==0)
 
-    # Dichotomy algorithm to solve the equation
+    # Safeguarded Newton algorithm to solve the equation
     it = 0
-    new = (a + b)/2
-    func_new = func(new)
-    # print("A : {}, B: {}, new : {}, fA : {}, fB : {}, fnew : {}".format(np.min(np.abs(a)),np.min(np.abs(b)),np.min(np.abs(new)),np.min(np.abs(func(a))),np.min(np.abs(func(b))),np.min(np.abs(func(new)))))
-    # print("A : {}, B: {}, new : {}, fA : {}, fB : {}, fnew : {}".format(np.max(a),np.max(b),np.max(new),np.max(func(a)),np.max(func(b)),np.max(func(new))))
-    while np.max(np.abs(func_new)) > tol:
-        
+    func_new = func(new, all_cols)
+    active = all_cols[np.abs(func_new) > tol]
+    while active.size:
+
         it=it+1
-        func_a = func(a)
-        # func_b = func(b)
-
-        # if f(a)*f(new) <0 then f(new) < 0 --> store in b
-        minus_bool = func_a * func_new <= 0
-        
-        # if f(a)*f(new) > 0 then f(new) > 0 --> store in a
-        # plus_bool = func_a * func_new > 0
-        plus_bool = np.logical_not(minus_bool)
-
-        b[minus_bool] = new[minus_bool]
-        a[plus_bool] = new[plus_bool]
-        new = (a + b) / 2
-        func_new = func(new)
-        if it>=maxit:
+        x, fx = new[active], func_new[active]
+
+        # f(a) > 0 and f(b) < 0 are kept along the iterations
+        # if f(new) > 0 --> store in a, if f(new) <= 0 --> store in b
+        plus_bool = fx > 0
+        a[active[plus_bool]] = x[plus_bool]
+        minus_bool = np.logical_not(plus_bool)
+        b[active[minus_bool]] = x[minus_bool]
+        lo, hi = np.minimum(a[active], b[active]), np.maximum(a[active], b[active])
+
+        x_bisect = (lo + hi) / 2
+        if dfunc is None:
+            x = x_bisect
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x = x - fx / dfunc(x, active)
+            # Fall back to the bisection when the Newton step leaves the interval (or the derivative vanishes)
+            outside = np.logical_not((x > lo) & (x < hi))
+            x[outside] = x_bisect[outside]
+
+        new[active] = x
+        func_new[active] = func(x, active)
+        # Stop the entries that have converged or whose interval cannot be split anymore
+        keep = (np.abs(func_new[active]) > tol) & (x_bisect > lo) & (x_bisect < hi)
+        active = active[keep]
+        if it>=maxit and active.size:
             print("Dicotomy stopped for maximum number of iterations with an error of : {}".format(np.max(np.abs(func_new))))
             break
-        
-    return new
+
+    return new.reshape(shape)
@@ -1,11 +1,13 @@
 import numpy as np
 
-from espm.estimators.updates import multiplicative_step_h, multiplicative_step_w, multiplicative_step_hq, proj_grad_step_h, proj_grad_step_w, gradH, gradW, estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w
-from espm.measures import trace_xtLx, log_reg
+from espm.estimators.updates import initialize_algorithms, multiplicative_step_h, multiplicative_step_w, multiplicative_step_w_stats, kl_products, G_matmul, Gt_matmul, multiplicative_step_hq, proj_grad_step_h, proj_grad_step_w, gradH, gradW, estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w, power_iteration_lipschitz_h, power_iteration_lipschitz_w, hals_step_h, hals_step_w, carto_structure, carto_GW, G_colsum, Gt_matmul_entries, compile_fixed
+from espm.measures import log_reg
 from espm.estimators import NMFEstimator
+from espm.models.base import PhysicalModel
 from espm.estimators.surrogates import diff_surrogate, quadratic_surrogate
-from espm.conf import dicotomy_tol, sigmaL
+from espm.conf import dicotomy_tol, dicotomy_tol_max, sigmaL
 from copy import deepcopy
+from scipy.sparse import issparse, csr_matrix, identity
 # from espm.measures import KL_loss_surrogate, KLdiv_loss, log_reg, log_surrogate
 
 
@@ -66,15 +68,52 @@ class SmoothNMF(NMFEstimator):
     epsilon_reg : float, default=1
         Slope of the log regularization/sparsity at 0.
     algo : str, default="log_surrogate"
-        Algorithm to use for the smooth regularization term. Can be "log_surrogate", "l2_surrogate", or "projected_gradient".
+        Algorithm to use for the smooth regularization term. Can be "log_surrogate", "l2_surrogate", "projected_gradient" or "hals". 
+        "hals" (hierarchical alternating least squares) is only available for the l2 loss (`l2=True`): the rows of H and the 
+        columns of W are updated one after the other from the products G.T @ G and G.T @ X, which are computed once.
     simplex_H : bool, default=False
         If True, force the solution of H to be in the simplex.
     simplex_W : bool, default=True
         If True, force the solution of W to be in the simplex.
     dicotomy_tol : float, default=1e-3
         Tolerance for the dichotomy algorithm.
+    adaptive_dicotomy_tol : bool, default=False
+        If True, the tolerance of the dichotomy follows the quantities of the stopping criterion (relative changes of 
+        the loss, W and H): it is loose (up to 1e-2) during the first iterations and reaches `dicotomy_tol` as the fit converges.
     gamma : float, default=None
         Initial value for the step size. If None, it is set to the Lipschitz constant of the gradient.
+    acceleration : bool, default=False
+        If True, each step is taken from an extrapolation of the last two iterates of W and H. When the loss 
+        increases, the fit goes back to the previous iterate and the extrapolation is reduced, so that the loss 
+        is still non-increasing. It requires `lazy_loss=False` and `check_every=1`.
+    n_inner_H : int, default=1
+        Number of steps in H (W being fixed) per iteration. The product G @ W is computed once for all of them.
+    n_inner_W : int, default=1
+        Number of steps in W (H being fixed) per iteration.
+    bb_steps : bool, default=False
+        Only for `algo="projected_gradient"`. If True, the initial step sizes are estimated by power iterations on the 
+        Hessian at the initial point (much tighter than the global bounds used otherwise) and the step sizes are then 
+        updated at each iteration with the second Barzilai-Borwein rule (BB2). The loss is only required to be lower than the maximum 
+        of the last 5 losses; when it is not, the fit goes back to the previous iterate with halved step sizes. 
+        It requires `linesearch=False`, `acceleration=False`, `lazy_loss=False` and `check_every=1`.
+    dct_laplacian : bool, default=False
+        Only for `algo="hals"` with `shape_2d`. The step in H also minimizes its quadratic with the exact Laplacian term 
+        (instead of its majorization with `gamma`, which is very conservative for large `lambda_L`), with DCTs which 
+        diagonalize the Laplacian. The solution is projected on the constraints and kept if it decreases the loss 
+        more than the majorized step.
+    chemical_mapping : bool, default=False
+        Solver of the chemical mapping decompositions, where fixed_W has the pattern of `EDS_espm.carto_fixed_W` 
+        (see :func:`espm.estimators.updates.carto_structure`): each element component is the spectrum of one element and 
+        the other components are the bremsstrahlung. Without constraint on H (simplex_H, mu and lambda_L), the intensities 
+        of the elements are carried by the maps H: the free entries of W of the element components keep their initial 
+        values and only the bremsstrahlung entries of W are updated. G @ W @ H is kept in memory and updated with the 
+        low-rank change of the bremsstrahlung after the step in W, so that an iteration costs two products with the n x k 
+        matrix G @ W (instead of about five with the loss). With a constraint on H, the scales of the elements are also 
+        updated, which costs one more product with H. 
+        Only for `algo="log_surrogate"` with the KL loss and a dense X, without simplex_W, acceleration and memory_budget.
+    forget_factor : float, default=0.7
+        Weight of the statistics of the previous blocks in `partial_fit`. With 1.0, all the blocks seen so far 
+        have the same weight. Smaller values forget faster the statistics computed with the first (poor) estimates of W.
     **kwargs : dict
         Additional parameters for the `NMFEstimator` class.
 
@@ -83,7 +122,7 @@ class SmoothNMF(NMFEstimator):
     loss_names_ = NMFEstimator.loss_names_ + ["log_reg_loss"] + ["Lapl_reg_loss"] + ["gamma"]
 
     # args and kwargs are copied from the init to the super instead of capturing them in *args and **kwargs to be scikit-learn compliant.
-    def __init__(self, lambda_L = 0.0, linesearch=False, mu=0, epsilon_reg=1, algo="log_surrogate", dicotomy_tol=dicotomy_tol, gamma=None, **kwargs):
+    def __init__(self, lambda_L = 0.0, linesearch=False, mu=0, epsilon_reg=1, algo="log_surrogate", dicotomy_tol=dicotomy_tol, adaptive_dicotomy_tol=False, gamma=None, acceleration=False, n_inner_H=1, n_inner_W=1, bb_steps=False, dct_laplacian=False, chemical_mapping=False, forget_factor=0.7, **kwargs):
 
         super().__init__( **kwargs)
         self.lambda_L = lambda_L
@@ -91,13 +130,21 @@ class SmoothNMF(NMFEstimator):
         self.mu = mu
         self.epsilon_reg = epsilon_reg
         self.dicotomy_tol = dicotomy_tol
-        assert algo in ["l2_surrogate", "log_surrogate", "projected_gradient", "bmd"]
+        self.adaptive_dicotomy_tol = adaptive_dicotomy_tol
+        assert algo in ["l2_surrogate", "log_surrogate", "projected_gradient", "bmd", "hals"]
         self.algo = algo
         self.gamma = gamma
+        self.acceleration = acceleration
+        self.n_inner_H = n_inner_H
+        self.n_inner_W = n_inner_W
+        self.bb_steps = bb_steps
+        self.dct_laplacian = dct_laplacian
+        self.chemical_mapping = chemical_mapping
+        self.forget_factor = forget_factor
         self.check_params()
 
     def check_params(self) : 
-        assert self.algo in ["l2_surrogate", "log_surrogate", "projected_gradient", "bmd"], "The algorithm must be 'l2_surrogate', 'log_surrogate', 'bmd' or 'projected_gradient'"
+        assert self.algo in ["l2_surrogate", "log_surrogate", "projected_gradient", "bmd", "hals"], "The algorithm must be 'l2_surrogate', 'log_surrogate', 'bmd', 'projected_gradient' or 'hals'"
         assert self.lambda_L >= 0 and self.epsilon_reg > 0.0 and np.all(np.array(self.mu)>=0), "The regularization parameters must be positive"
         assert (self.simplex_H and not(self.simplex_W)) or (not(self.simplex_H) and self.simplex_W) or (not(self.simplex_H) and not(self.simplex_W)), "Only one of simplex_H and simplex_W can be True"
         if self.linesearch:
@@ -107,6 +154,35 @@ class SmoothNMF(NMFEstimator):
         if self.algo=="l2_surrogate":
             assert not self.l2, "The l2 parameter must be False when using l2_surrogate"
 
+        if self.algo=="hals":
+            assert self.l2, "The hals algorithm is only implemented for the l2 loss (l2=True)"
+
+        if self.dct_laplacian:
+            assert self.algo=="hals" and self.shape_2d is not None, "The DCT solver of the Laplacian term (dct_laplacian) needs the hals algorithm and shape_2d"
+
+        if self.chemical_mapping:
+            assert carto_structure(self.fixed_W) is not None, "The chemical mapping solver needs a fixed_W with the pattern of EDS_espm.carto_fixed_W"
+            assert self.algo=="log_surrogate" and not self.l2, "The chemical mapping solver is only implemented for the log_surrogate algorithm with the KL loss"
+            assert not self.simplex_W and not self.acceleration and self.memory_budget is None, "The chemical mapping solver does not support simplex_W, acceleration and memory_budget"
+            assert self.n_inner_H == 1 and self.n_inner_W == 1, "The chemical mapping solver takes one step in H and W per iteration"
+
+        assert 0 < self.forget_factor <= 1, "The forget_factor must be in ]0, 1]"
+
+        if self.acceleration:
+            assert not self.lazy_loss and self.check_every == 1, "The acceleration needs the loss of every iterate (lazy_loss=False and check_every=1)"
+
+        if self.memory_budget is not None:
+            assert self.algo=="log_surrogate", "The out-of-core mode (memory_budget) is only implemented for the log_surrogate algorithm"
+            assert not self.linesearch, "The out-of-core mode (memory_budget) does not support linesearch"
+            assert self.n_inner_H == 1 and self.n_inner_W == 1, "The out-of-core mode (memory_budget) takes one step in H and W per pass over the data"
+
+        assert self.n_inner_H >= 1 and self.n_inner_W >= 1, "The numbers of inner steps n_inner_H and n_inner_W must be at least 1"
+
+        if self.bb_steps:
+            assert self.algo=="projected_gradient", "The Barzilai-Borwein steps (bb_steps) are only implemented for the projected_gradient algorithm"
+            assert not self.linesearch and not self.acceleration, "The Barzilai-Borwein steps (bb_steps) replace the linesearch and the acceleration"
+            assert not self.lazy_loss and self.check_every == 1, "The Barzilai-Borwein steps (bb_steps) need the loss of every iterate (lazy_loss=False and check_every=1)"
+
         
 
     def fit_transform(self, X, y=None, W=None, H=None):
@@ -154,6 +230,135 @@ class SmoothNMF(NMFEstimator):
 
         return super().fit_transform(X, y=y, W=W, H=H)
 
+    def partial_fit(self, X, y=None, W=None, H=None):
+        r"""Update the model with a block of pixels X (online or mini-batch learning).
+
+        H is only learned for the pixels of the block, with at most `max_iter` multiplicative steps in H (W being fixed).
+        The statistics of the KL step in W, i.e. the sums over the pixels of :math:`W \odot G^\top (X / GWH) H^\top` 
+        (computed with the W of the time) and of :math:`H`, are accumulated over all the blocks seen so far in the 
+        attributes `W_num_` and `H_sum_`, the previous statistics being weighted by `forget_factor`. 
+        W is then obtained from these statistics as in a multiplicative step, so that a usable W is obtained 
+        after a single sweep over the data.
+
+        The online learning is only available for the log_surrogate algorithm with the KL divergence. 
+        The Laplacian regularization, the normalization and fixed_H, which need all the pixels, are not supported. 
+        If `shape_2d` is None, the Laplacian is the identity, which is separable over the pixels, and lambda_L can be used.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix} of shape (n, p_block)
+            Block of pixels of the data matrix (shape (p_block, n) if `hspy_comp` is True).
+        y : Ignored
+            Not used, present here for API consistency by convention.
+        W : array-like, shape (m, k)
+            Initial guess for W, only used at the first call. 
+        H : array-like, shape (k, p_block)
+            Initial guess for the H of the block. 
+
+        Returns
+        -------
+        self
+            The model.
+        """
+        if self.l2 or self.algo!="log_surrogate":
+            raise ValueError("partial_fit is only implemented for the log_surrogate algorithm with the KL divergence.")
+        if (not(self.lambda_L==0) and self.shape_2d is not None) or self.normalize or self.fixed_H is not None:
+            raise ValueError("partial_fit does not support the Laplacian regularization (lambda_L with shape_2d), the normalization and fixed_H.")
+
+        first_call = not hasattr(self, "n_steps_")
+        dtype = [np.float64, np.float32] if self.dtype is None else self.dtype
+        Xb = self._validate_data(X.T if self.hspy_comp else X, accept_sparse=('csr', 'csc'), dtype=dtype, reset=first_call)
+        if issparse(Xb):
+            Xb = csr_matrix(Xb)
+        Xb = self.remove_zeros_lines(Xb, self.log_shift)
+
+        if first_call:
+            self.block_size_ = None
+            self.const_KL_ = None
+            self.gamma_ = sigmaL if self.gamma is None else deepcopy(self.gamma)
+            if isinstance(self.G, PhysicalModel):
+                self.physics_model_ = self.G
+                G = self.physics_model_.NMF_update()
+            else:
+                self.physics_model_ = None
+                G = self.G
+            self.G_, self.W_, Hb = initialize_algorithms(X = Xb,
+                                                         G = self._cast(G),
+                                                         W = W,
+                                                         H = H,
+                                                         n_components = self.n_components,
+                                                         init = self.init,
+                                                         random_state = self.random_state,
+                                                         simplex_H = self.simplex_H,
+                                                         simplex_W = self.simplex_W,
+                                                         physics_model = self.physics_model_)
+            self.W_ = self._cast(self.W_)
+            self._compile_constraints()
+            self.W_num_ = np.zeros_like(self.W_)
+            self.H_sum_ = np.zeros(self.n_components, dtype=self.W_.dtype)
+            self.n_steps_ = 0
+        else:
+            # W is given, so that only H is initialized, from the least squares solution
+            _, _, Hb = initialize_algorithms(X = Xb,
+                                             G = self.G_,
+                                             W = self.W_,
+                                             H = H,
+                                             n_components = self.n_components,
+                                             init = self.init,
+                                             random_state = self.random_state,
+                                             simplex_H = self.simplex_H,
+                                             simplex_W = self.simplex_W,
+                                             physics_model = self.physics_model_)
+        Hb = self._cast(Hb)
+
+        # 1. Update for the H of the block, W being fixed
+        GW = G_matmul(self.G_, self.W_)
+        self.L_ = identity(Hb.shape[1], dtype=Hb.dtype, format="csr")
+        # Warm start of the Lagrange multiplier of the simplex constraint between the steps
+        h_workspace = {}
+        for _ in range(self.max_iter):
+            old_Hb = Hb
+            Hb = multiplicative_step_h(Xb,
+                                       None,
+                                       GW,
+                                       Hb,
+                                       simplex_H=self.simplex_H,
+                                       mu=self.mu,
+                                       log_shift=self.log_shift,
+                                       epsilon_reg=self.epsilon_reg,
+                                       safe=self.debug,
+                                       dicotomy_tol=self.dicotomy_tol,
+                                       lambda_L=self.lambda_L,
+                                       L=self.L_,
+                                       sigmaL=self.gamma_,
+                                       n_jobs=self.n_jobs,
+                                       workspace=h_workspace)
+            if np.max(np.abs(Hb - old_Hb)/(Hb + self.tol*np.mean(Hb))) < self.tol:
+                break
+
+        # 2. Accumulate the statistics and update W
+        _, XHt = kl_products(Xb, GW, Hb, log_shift=self.log_shift, DtR=False, RHt=True, n_jobs=self.n_jobs)
+        self.W_num_ = self.forget_factor*self.W_num_ + self.W_*Gt_matmul(self.G_, XHt)
+        self.H_sum_ = self.forget_factor*self.H_sum_ + np.sum(Hb, axis=1)
+        self.W_ = multiplicative_step_w_stats(self.G_,
+                                              self.W_num_,
+                                              self.H_sum_,
+                                              simplex_W=self.simplex_W,
+                                              log_shift=self.log_shift,
+                                              fixed_W=self.fixed_W_,
+                                              physics_model=self.physics_model_,
+                                              simplex_indices=self.simplex_indices_)
+        self.n_steps_ += 1
+        # Same update frequency of G as in fit_transform
+        if self.physics_model_ != None and self.n_steps_%3 == 0:
+            self.G_ = self._cast(self.physics_model_.NMF_update(self.W_))
+
+        self.H_ = Hb
+        self.n_components_ = self.n_components
+        GW = G_matmul(self.G_, self.W_)
+        self.components_ = GW.T if self.hspy_comp else Hb
+        return self
+
     def _iteration(self, W, H):
 
         # KL_surr = KL_loss_surrogate(self.X_, W, H, H, eps=0)
@@ -163,8 +368,10 @@ class SmoothNMF(NMFEstimator):
         if self.n_iter_ == 0:
             if self.gamma is None:
 
-                if self.algo in ["l2_surrogate", "log_surrogate", "bmd"]:
+                if self.algo in ["l2_surrogate", "log_surrogate", "bmd", "hals"]:
                     self.gamma_ = sigmaL
+                elif self.bb_steps:
+                    self.gamma_ = self._local_lipschitz(W, H)
                 else:
                     gamma_W = estimate_Lipschitz_bound_w(self.log_shift, self.X_, self.G_, k=self.n_components)
                     gamma_H = estimate_Lipschitz_bound_h(self.log_shift,
@@ -178,9 +385,48 @@ class SmoothNMF(NMFEstimator):
             else:
                 self.gamma_ = deepcopy(self.gamma)
 
-        # 1. Update for H
-        if self.linesearch:
-            Hold = H.copy()
+        if self.acceleration:
+            W, H = self._extrapolate(W, H)
+        if self.bb_steps:
+            if self.n_iter_ == 0:
+                # The Barzilai-Borwein steps are at most 1e6 times larger than the initial ones
+                self.workspace_["bb_min_gamma"] = [g*1e-6 for g in self.gamma_]
+            self.workspace_["bb_previous"] = (W.copy(), H.copy())
+
+        if self.block_size_ is not None:
+            return self._iteration_blocks(W, H)
+
+        if self.chemical_mapping:
+            return self._iteration_carto(W, H)
+
+        # The Lagrange multipliers of the simplex constraints are warm started from the previous iteration
+        dicotomy_tol_it = self._dicotomy_tol()
+        h_workspace = {"nu": self.workspace_.get("nu_H")}
+        w_workspace = {"nu": self.workspace_.get("nu_W")}
+
+        # 1. Update for H, n_inner_H times with the same W (G @ W is computed once, see _GW)
+        H_in = H
+        for _ in range(self.n_inner_H):
+            H = self._update_H(W, H, dicotomy_tol_it, h_workspace, keep=H_in)
+
+        # 2. Update for W, n_inner_W times with the same H
+        for _ in range(self.n_inner_W):
+            W = self._update_W(W, H, dicotomy_tol_it, w_workspace)
+
+        # KL_surr = KL_loss_surrogate(self.X_, W, H, Hold, eps=0)
+        # log_surr = log_surrogate(H, Hold, mu=self.mu, epsilon=self.epsilon_reg)
+        # print("surrogate before:", KL_surr, log_surr, log_surr+KL_surr)
+        # KL_surr = KL_loss_surrogate(self.X_, W, H, H, eps=0)
+        # log_surr = log_surrogate(H, H, mu=self.mu, epsilon=self.epsilon_reg)
+        # print("loss after:", KL_surr, log_surr, log_surr+KL_surr)
+        self.workspace_["nu_H"] = h_workspace.get("nu")
+        self.workspace_["nu_W"] = w_workspace.get("nu")
+        return  W, H
+
+    def _update_H(self, W, H, dicotomy_tol_it, h_workspace, keep=None):
+        """One step in H, W being fixed. The new H is not written in the array keep (the input H of the iteration)."""
+        # The updates do not write in H
+        Hold = H
         if self.algo=="l2_surrogate":
             H = multiplicative_step_hq(self.X_,
                                        self.G_,
@@ -189,28 +435,60 @@ class SmoothNMF(NMFEstimator):
                                        simplex_H=self.simplex_H,
                                        log_shift=self.log_shift,
                                        safe=self.debug,
-                                       dicotomy_tol=self.dicotomy_tol,
+                                       dicotomy_tol=dicotomy_tol_it,
                                        lambda_L=self.lambda_L,
                                        L=self.L_,
                                        sigmaL=self.gamma_,
-                                       fixed_H=self.fixed_H)
+                                       fixed_H=self.fixed_H_,
+                                       workspace=h_workspace)
         elif self.algo=="log_surrogate":
-            H = multiplicative_step_h(self.X_,
-                                      self.G_,
-                                      W,
-                                      H,
-                                      simplex_H=self.simplex_H,
-                                      mu=self.mu,
-                                      log_shift=self.log_shift,
-                                      epsilon_reg=self.epsilon_reg,
-                                      safe=self.debug,
-                                      dicotomy_tol=self.dicotomy_tol,
-                                      lambda_L=self.lambda_L,
-                                      L=self.L_,
-                                      l2=self.l2,
-                                      fixed_H=self.fixed_H,
-                                      sigmaL=self.gamma_)
+            # G @ W and H @ L are shared with the loss evaluation. With lazy_loss, the log term of the loss at (W, H) is stored in the workspace.
+            # The new H is written in a buffer of the estimator to avoid allocating a new array at each iteration.
+            new_H = multiplicative_step_h(self.X_,
+                                          self.G_,
+                                          W,
+                                          H,
+                                          simplex_H=self.simplex_H,
+                                          mu=self.mu,
+                                          log_shift=self.log_shift,
+                                          epsilon_reg=self.epsilon_reg,
+                                          safe=self.debug,
+                                          dicotomy_tol=dicotomy_tol_it,
+                                          lambda_L=self.lambda_L,
+                                          L=self.L_,
+                                          l2=self.l2,
+                                          fixed_H=self.fixed_H_,
+                                          sigmaL=self.gamma_,
+                                          n_jobs=self.n_jobs,
+                                          workspace=h_workspace,
+                                          x_log=self.lazy_loss,
+                                          GW=self._GW(W),
+                                          HL=self._HL(H) if not(self.lambda_L==0) else None,
+                                          out=self._buffer("H_buffers", H, avoid=keep),
+                                          **self._l2_gram())
+            if "x_log" in h_workspace:
+                self.workspace_["x_log"] = (self.G_, W, H, h_workspace["x_log"])
+            H = new_H
         elif self.algo=="projected_gradient":
+            grad = None
+            if self.bb_steps or self.linesearch:
+                grad = gradH(self.X_,
+                             self.G_,
+                             W,
+                             H,
+                             mu=self.mu,
+                             lambda_L=self.lambda_L,
+                             L=self.L_,
+                             epsilon_reg=self.epsilon_reg,
+                             log_shift=self.log_shift,
+                             safe=self.debug,
+                             l2=self.l2,
+                             **self._l2_gram())
+                if self.bb_steps:
+                    self.gamma_[0] = self._bb_gamma("bb_H", 0, H, grad)
+                if self.linesearch:
+                    # The step overwrites grad
+                    gradf_xt = grad.copy()
             H = proj_grad_step_h(self.X_,
                                  self.G_,
                                  W,
@@ -220,12 +498,14 @@ class SmoothNMF(NMFEstimator):
                                  log_shift=self.log_shift,
                                  epsilon_reg=self.epsilon_reg,
                                  safe=self.debug,
-                                 dicotomy_tol=self.dicotomy_tol,
+                                 dicotomy_tol=dicotomy_tol_it,
                                  lambda_L=self.lambda_L,
                                  L=self.L_,
                                  l2=self.l2,
-                                 fixed_H=self.fixed_H,
-                                 gamma=self.gamma_[0])
+                                 fixed_H=self.fixed_H_,
+                                 gamma=self.gamma_[0],
+                                 grad=grad,
+                                 **self._l2_gram())
         elif self.algo=="bmd":
             H = multiplicative_step_h(self.X_,
                                       self.G_,
@@ -236,44 +516,54 @@ class SmoothNMF(NMFEstimator):
                                       log_shift=self.log_shift,
                                       epsilon_reg=self.epsilon_reg,
                                       safe=self.debug,
-                                      dicotomy_tol=self.dicotomy_tol,
+                                      dicotomy_tol=dicotomy_tol_it,
                                       lambda_L=self.lambda_L,
                                       L=self.L_,
                                       l2=self.l2,
-                                      fixed_H=self.fixed_H,
+                                      fixed_H=self.fixed_H_,
                                       sigmaL=self.gamma_,
-                                      use_bregman=True)
+                                      use_bregman=True,
+                                      **self._l2_gram())
+        elif self.algo=="hals":
+            _, GtX, GtG, _ = self._hals_products()
+            H = hals_step_h(GtX,
+                            GtG,
+                            W,
+                            H,
+                            simplex_H=self.simplex_H,
+                            mu=self.mu,
+                            epsilon_reg=self.epsilon_reg,
+                            lambda_L=self.lambda_L,
+                            L=self.L_,
+                            sigmaL=self.gamma_,
+                            log_shift=self.log_shift,
+                            fixed_H=self.fixed_H_,
+                            HL=self._HL(H) if not(self.lambda_L==0) else None,
+                            dct_shape=self.shape_2d if self.dct_laplacian else None)
         else:
             raise ValueError("Unknown algorithm")
 
         if self.linesearch:
             if self.algo in ["l2_surrogate", "log_surrogate", "bmd"]:
-                d = diff_surrogate(Hold, H, L=self.L_, sigmaL=self.gamma_, algo=self.algo)
+                # H @ L of the new H is cached for the loss and the next update
+                d = diff_surrogate(Hold, H, L=self.L_, sigmaL=self.gamma_, algo=self.algo, HtL=self._HL(Hold), HL=self._HL(H))
                 if d>0:
                     self.gamma_  = self.gamma_ / 1.05
                 else:
                     self.gamma_  = self.gamma_ * 1.5
             else:
-                gradf_xt = gradH(self.X_,
-                                 self.G_,
-                                 W,
-                                 Hold,
-                                 mu= self.mu,
-                                 lambda_L=self.lambda_L,
-                                 L=self.L_,
-                                 epsilon_reg=self.epsilon_reg,
-                                 log_shift=self.log_shift,
-                                 safe=self.debug)
-                f_xt = self.loss(W, Hold, X = self.X_, average=False)
-                f_x = self.loss(W, H, X = self.X_, average=False)
+                f_xt = self._linesearch_loss(W, Hold)
+                f_x = self._linesearch_loss(W, H)
                 g_xxt = quadratic_surrogate(H, Hold, f_xt, gradf_xt, self.gamma_[0])
                 d = g_xxt - f_x
                 if d>0:
                     self.gamma_[0]  = self.gamma_[0] / 1.05
                 else:
                     self.gamma_[0]  = self.gamma_[0] * 1.5
+        return H
 
-        # 2. Update for W
+    def _update_W(self, W, H, dicotomy_tol_it, w_workspace):
+        """One step in W, H being fixed."""
         if self.algo in ["l2_surrogate", "log_surrogate"]:
             W = multiplicative_step_w(self.X_,
                                       self.G_,
@@ -283,8 +573,13 @@ class SmoothNMF(NMFEstimator):
                                       safe=self.debug,
                                       l2=self.l2,
                                       simplex_W=self.simplex_W,
-                                      fixed_W=self.fixed_W,
-                                      physics_model=self.physics_model_)
+                                      fixed_W=self.fixed_W_,
+                                      physics_model=self.physics_model_,
+                                      simplex_indices=self.simplex_indices_,
+                                      n_jobs=self.n_jobs,
+                                      dicotomy_tol=dicotomy_tol_it,
+                                      workspace=w_workspace,
+                                      **self._l2_gram())
         elif self.algo=="bmd":
             W = multiplicative_step_w(self.X_,
                                       self.G_,
@@ -294,12 +589,33 @@ class SmoothNMF(NMFEstimator):
                                       safe=self.debug,
                                       l2=self.l2,
                                       simplex_W=self.simplex_W,
-                                      fixed_W=self.fixed_W,
+                                      fixed_W=self.fixed_W_,
                                       use_bregman=True,
-                                      physics_model=self.physics_model_)
+                                      physics_model=self.physics_model_,
+                                      **self._l2_gram())
+        elif self.algo=="hals":
+            _, GtX, GtG, lipschitz_G = self._hals_products()
+            W = hals_step_w(GtX,
+                            GtG,
+                            W,
+                            H,
+                            simplex_W=self.simplex_W,
+                            log_shift=self.log_shift,
+                            fixed_W=self.fixed_W_,
+                            physics_model=self.physics_model_,
+                            lipschitz_G=lipschitz_G,
+                            simplex_indices=self.simplex_indices_)
         else:
-            if self.linesearch:
-                Wold = W.copy()
+            # The step does not write in W
+            Wold = W
+            grad = None
+            if self.bb_steps or self.linesearch:
+                grad = gradW(self.X_, self.G_, W, H, log_shift=self.log_shift, safe=self.debug, l2=self.l2, **self._l2_gram())
+                if self.bb_steps:
+                    self.gamma_[1] = self._bb_gamma("bb_W", 1, W, grad)
+                if self.linesearch:
+                    # The step overwrites grad
+                    gradf_xt = grad.copy()
             W = proj_grad_step_w(self.X_,
                                  self.G_,
                                  W,
@@ -307,25 +623,331 @@ class SmoothNMF(NMFEstimator):
                                  log_shift=self.log_shift,
                                  safe=self.debug,
                                  gamma=self.gamma_[1],
-                                 simplex_W=self.simplex_W)
+                                 simplex_W=self.simplex_W,
+                                 fixed_W=self.fixed_W_,
+                                 l2=self.l2,
+                                 grad=grad,
+                                 **self._l2_gram())
             if self.linesearch:
-                gradf_xt = gradW(self.X_, self.G_, Wold, H, log_shift=self.log_shift, safe=self.debug)
-                f_xt = self.loss(Wold, H, X = self.X_, average=False)
-                f_x = self.loss(W, H, X = self.X_, average=False)
+                f_xt = self._linesearch_loss(Wold, H)
+                f_x = self._linesearch_loss(W, H)
                 g_xxt = quadratic_surrogate(W, Wold, f_xt, gradf_xt, self.gamma_[1])
                 d = g_xxt - f_x
                 if d>0:
                     self.gamma_[1]  = self.gamma_[1] / 1.05
                 else:
                     self.gamma_[1]  = self.gamma_[1] * 1.5
+        return W
 
-        # KL_surr = KL_loss_surrogate(self.X_, W, H, Hold, eps=0)
-        # log_surr = log_surrogate(H, Hold, mu=self.mu, epsilon=self.epsilon_reg)
-        # print("surrogate before:", KL_surr, log_surr, log_surr+KL_surr)
-        # KL_surr = KL_loss_surrogate(self.X_, W, H, H, eps=0)
-        # log_surr = log_surrogate(H, H, mu=self.mu, epsilon=self.epsilon_reg)
-        # print("loss after:", KL_surr, log_surr, log_surr+KL_surr)
-        return  W, H
+    def _iteration_carto(self, W, H):
+        """Iteration of the chemical mapping solver (see `chemical_mapping`).
+
+        D @ H, with D = G @ W clipped at log_shift as in the loss, is kept in the workspace. It is computed after the step 
+        in H and updated after the step in the bremsstrahlung entries of W, from which the log term of the loss is obtained.
+        """
+        if issparse(self.X_):
+            raise ValueError("The chemical mapping solver needs a dense X.")
+        if self.n_iter_ == 0:
+            self.carto_structure_ = carto_structure(self.fixed_W_)
+            W = self.fixed_W_.apply(W.copy())
+            # X clipped at log_shift for the log term of the loss
+            self.workspace_["carto_X"] = np.maximum(self.X_, self.log_shift)
+        _, _, other_rows, other_cols = self.carto_structure_
+        X = self.X_
+        dicotomy_tol_it = self._dicotomy_tol()
+        h_workspace = {"nu": self.workspace_.get("nu_H")}
+
+        cached = self.workspace_.get("carto_DH")
+        if cached is not None and cached[0] is self.G_ and cached[1] is W and cached[2] is H:
+            D, DH = cached[3], cached[4]
+        else:
+            D = np.maximum(carto_GW(self.G_, W, self.carto_structure_), self.log_shift)
+            DH = D @ H
+        R = self.workspace_.get("carto_R")
+        if R is None or R.shape != DH.shape or R.dtype != DH.dtype:
+            R = self.workspace_["carto_R"] = np.empty_like(DH)
+
+        def ratio(DH):
+            np.divide(X, DH, out=R)
+            if np.any(np.isnan(R)):
+                np.divide(X, np.maximum(DH, self.log_shift), out=R)
+            return R
+
+        # 1. Step in H, from D.T @ (X / (D @ H))
+        H = multiplicative_step_h(X,
+                                  None,
+                                  D,
+                                  H,
+                                  simplex_H=self.simplex_H,
+                                  mu=self.mu,
+                                  log_shift=self.log_shift,
+                                  epsilon_reg=self.epsilon_reg,
+                                  safe=self.debug,
+                                  dicotomy_tol=dicotomy_tol_it,
+                                  lambda_L=self.lambda_L,
+                                  L=self.L_,
+                                  fixed_H=self.fixed_H_,
+                                  sigmaL=self.gamma_,
+                                  workspace=h_workspace,
+                                  GW=D,
+                                  HL=self._HL(H) if not(self.lambda_L==0) else None,
+                                  DtR=D.T @ ratio(DH))
+        self.workspace_["nu_H"] = h_workspace.get("nu")
+        DH = np.matmul(D, H, out=DH)
+
+        # 2. Multiplicative step in the bremsstrahlung entries of W, and in the scales of the elements when H is 
+        # constrained (otherwise the scales are carried by H). D @ H is updated with the change of the bremsstrahlung columns.
+        update_scales = self.simplex_H or not(np.all(np.asarray(self.mu) == 0)) or not(self.lambda_L == 0)
+        colsum = G_colsum(self.G_, W.shape[0], dtype=W.dtype)[0]
+        if update_scales or len(other_cols) > 0:
+            R = ratio(DH)
+            new_W = W.copy()
+        if update_scales:
+            element_rows, element_cols, _, _ = self.carto_structure_
+            H_e = H[element_cols]
+            num = W[element_rows, element_cols] * Gt_matmul_entries(self.G_, R @ H_e.T, element_rows, np.arange(len(element_cols)))
+            denum = colsum[element_rows] * np.sum(H_e, axis=1)
+            new_W[element_rows, element_cols] = np.maximum(num / denum, self.log_shift)
+        if len(other_cols) > 0:
+            block = np.ix_(other_rows, other_cols)
+            # Columns of G of the bremsstrahlung rows of W, None for the identity
+            G_b = None if self.G_ is None else self.G_[:, other_rows]
+            H_b = H[other_cols]
+            RHt_b = R @ H_b.T
+            num = W[block] * (RHt_b[other_rows] if G_b is None else G_b.T @ RHt_b)
+            denum = colsum[other_rows][:, np.newaxis] * np.sum(H_b, axis=1)[np.newaxis, :]
+            new_W[block] = np.maximum(num / denum, self.log_shift)
+        if update_scales:
+            W = self.fixed_W_.apply(new_W)
+            D = np.maximum(carto_GW(self.G_, W, self.carto_structure_), self.log_shift)
+            DH = np.matmul(D, H, out=DH)
+        elif len(other_cols) > 0:
+            W = self.fixed_W_.apply(new_W)
+            if G_b is None:
+                D_b = np.zeros((X.shape[0], len(other_cols)), dtype=D.dtype)
+                D_b[other_rows] = W[block]
+            else:
+                D_b = np.asarray(G_b @ W[block])
+            D_b = np.maximum(D_b, self.log_shift)
+            DH += (D_b - D[:, other_cols]) @ H_b
+            D = D.copy()
+            D[:, other_cols] = D_b
+        self.workspace_["carto_DH"] = (self.G_, W, H, D, DH)
+        self.workspace_["GW"] = (self.G_, W, D)
+
+        # Log term of the loss at the new W and H (the loss clips H at log_shift)
+        if not np.any(H < self.log_shift):
+            log_DH = np.log(DH, out=R)
+            log_DH *= self.workspace_["carto_X"]
+            self.workspace_["x_log"] = (self.G_, W, H, np.sum(log_DH, dtype=np.float64))
+        return W, H
+
+    def _iteration_blocks(self, W, H):
+        """Out-of-core iteration of the log_surrogate algorithm.
+
+        The step in H is separable over the pixels once H @ L and the row maxima of H are known, so that it is done block by block. 
+        The step in W only depends on sums over the pixels, which are accumulated during the same pass over the data.
+        """
+        GW = G_matmul(self.G_, W)
+        HL = H @ self.L_ if not(self.lambda_L==0) else None
+        maxH = np.max(H, axis=1, keepdims=True)
+        new_H = np.empty_like(H)
+        XHt = np.zeros((GW.shape[0], H.shape[0]), dtype=W.dtype)
+        dicotomy_tol_it = self._dicotomy_tol()
+        nu_H = self.workspace_.get("nu_H")
+        if self.simplex_H and nu_H is None:
+            nu_H = self.workspace_["nu_H"] = np.full(H.shape[1], np.nan)
+        w_workspace = {"nu": self.workspace_.get("nu_W")}
+
+        for sl, Xb in self._X_blocks():
+            # 1. Update for H, the multipliers of the simplex constraint are warm started block by block
+            h_workspace = {"nu": None if nu_H is None else nu_H[sl]}
+            new_H[:, sl] = multiplicative_step_h(Xb,
+                                                 None,
+                                                 GW,
+                                                 H[:, sl],
+                                                 simplex_H=self.simplex_H,
+                                                 mu=self.mu,
+                                                 log_shift=self.log_shift,
+                                                 epsilon_reg=self.epsilon_reg,
+                                                 safe=self.debug,
+                                                 dicotomy_tol=dicotomy_tol_it,
+                                                 lambda_L=self.lambda_L,
+                                                 sigmaL=self.gamma_,
+                                                 fixed_H=self._fixed_H_block(sl),
+                                                 HL=None if HL is None else HL[:, sl],
+                                                 maxH=maxH,
+                                                 n_jobs=self.n_jobs,
+                                                 workspace=h_workspace)
+            if self.simplex_H:
+                nu_H[sl] = h_workspace["nu"]
+            # 2. Statistics of the update for W, which uses the new H and the old W
+            XHt += kl_products(Xb, GW, new_H[:, sl], log_shift=self.log_shift, DtR=False, RHt=True, n_jobs=self.n_jobs)[1]
+
+        W = multiplicative_step_w_stats(self.G_,
+                                        W*Gt_matmul(self.G_, XHt),
+                                        np.sum(new_H, axis=1),
+                                        simplex_W=self.simplex_W,
+                                        log_shift=self.log_shift,
+                                        fixed_W=self.fixed_W_,
+                                        physics_model=self.physics_model_,
+                                        simplex_indices=self.simplex_indices_,
+                                        dicotomy_tol=dicotomy_tol_it,
+                                        workspace=w_workspace)
+        self.workspace_["nu_W"] = w_workspace.get("nu")
+        return W, new_H
+
+    def _fixed_H_block(self, sl):
+        """Compiled fixed entries of the columns sl of H (see `compile_fixed`), cached in the workspace for the next passes over the blocks."""
+        if self.fixed_H_ is None:
+            return None
+        blocks = self.workspace_.setdefault("fixed_H_blocks", {})
+        key = (sl.start, sl.stop)
+        if key not in blocks:
+            blocks[key] = compile_fixed(self.fixed_H_.matrix[:, sl])
+        return blocks[key]
+
+    def _extrapolate(self, W, H):
+        """Extrapolation of the iterates W and H, from which the next step is taken.
+
+        The extrapolation weight beta grows while the extrapolated steps decrease the loss and is reduced at each 
+        restart (see `_restart`), the value at which the restart happened becoming its upper bound (the scheme of 
+        Ang and Gillis for NMF). The iterates are kept in the workspace for the next extrapolation and for the restart.
+        """
+        beta = self.workspace_.get("beta", 0.5)
+        beta_max = self.workspace_.get("beta_max", 1.0)
+        if self.workspace_.get("extrapolated"):
+            # The last extrapolated step decreased the loss
+            beta = self.workspace_["beta"] = min(beta_max, 1.05 * beta)
+            self.workspace_["beta_max"] = min(1.0, 1.01 * beta_max)
+        previous = self.workspace_.get("previous")
+        extrapolated = previous is not None
+        if extrapolated:
+            W_y = W + beta * (W - previous[0])
+            H_y = H + beta * (H - previous[1])
+            W_y = np.maximum(W_y, self.log_shift, out=W_y)
+            H_y = np.maximum(H_y, self.log_shift, out=H_y)
+        else:
+            W_y, H_y = W, H
+            previous = self.workspace_["previous"] = (np.empty_like(W), np.empty_like(H))
+        np.copyto(previous[0], W)
+        np.copyto(previous[1], H)
+        self.workspace_["beta"] = beta
+        self.workspace_["extrapolated"] = extrapolated
+        return W_y, H_y
+
+    def _restart(self):
+        """Go back to the previous iterate and reduce the extrapolation if the last step was extrapolated, or 
+        reduce the Barzilai-Borwein steps (at least halved, and not larger than 1 / the local Lipschitz constants)."""
+        # The restored iterates are written in place, they must not hit the cached line search loss
+        self.workspace_.pop("linesearch_loss", None)
+        if self.bb_steps:
+            self.W_, self.H_ = self.workspace_.pop("bb_previous")
+            self.gamma_ = [max(2 * g, l) for g, l in zip(self.gamma_, self._local_lipschitz(self.W_, self.H_))]
+            self.workspace_.pop("bb_H", None)
+            self.workspace_.pop("bb_W", None)
+            return True
+        if not(self.acceleration) or not(self.workspace_.get("extrapolated")):
+            return False
+        self.W_, self.H_ = self.workspace_["previous"]
+        self.workspace_["beta_max"] = self.workspace_["beta"]
+        self.workspace_["beta"] = self.workspace_["beta"] / 1.5
+        self.workspace_["extrapolated"] = False
+        return True
+
+    def _hals_products(self):
+        """Products G.T @ X and G.T @ G of the HALS steps (see `hals_products`), computed again only when G_ changes."""
+        cached = self.workspace_.get("hals_products")
+        if cached is None or cached[0] is not self.G_:
+            GtG, GtX, _ = self._l2_products()
+            lipschitz_G = 1.0 if GtG is None else np.linalg.eigvalsh(GtG)[-1]
+            cached = self.workspace_["hals_products"] = (self.G_, GtX, GtG, lipschitz_G)
+        return cached
+
+    def _l2_gram(self):
+        """Keyword arguments GtG and GtX of the updates for the l2 loss (see `_l2_products`), empty for the KL loss."""
+        if not(self.l2):
+            return {}
+        GtG, GtX, _ = self._l2_products()
+        return {"GtG": GtG, "GtX": GtX}
+
+    def _linesearch_loss(self, W, H):
+        """Loss (not averaged) at (W, H) for the line search of the projected gradient.
+
+        The last value is cached in the workspace: the loss after the step in H is the one before the step in W, and 
+        the loss after the step in W is the one before the step in H of the next iteration.
+        """
+        cached = self.workspace_.get("linesearch_loss")
+        if cached is not None and cached[0] is self.G_ and cached[1] is W and cached[2] is H:
+            return cached[3]
+        loss = self.loss(W, H, average=False)
+        self.workspace_["linesearch_loss"] = (self.G_, W, H, loss)
+        return loss
+
+    def _bb_gamma(self, key, i, A, grad):
+        """Inverse <y, y> / <s, y> of the second Barzilai-Borwein step size (BB2, <s, y> / <y, y>) for the variable A, with s and y 
+        the differences of A and of its gradient since the last step. It is the more conservative of the two rules, its step 
+        being at most the BB1 one <s, s> / <s, y>. The previous step size is kept when the curvature <s, y> is not positive."""
+        gamma = self.gamma_[i]
+        last = self.workspace_.get(key)
+        if last is not None:
+            s = A - last[0]
+            y = grad - last[1]
+            sy = np.vdot(s, y)
+            if sy > 0:
+                gamma = max(np.vdot(y, y) / sy, self.workspace_["bb_min_gamma"][i])
+        self.workspace_[key] = (A.copy(), grad.copy())
+        return gamma
+
+    def _local_lipschitz(self, W, H):
+        """Power-iteration estimates of the Lipschitz constants of the gradients in H and W at (W, H)."""
+        gamma_H = power_iteration_lipschitz_h(self.X_,
+                                              self.G_,
+                                              W,
+                                              H,
+                                              log_shift=self.log_shift,
+                                              lambda_L=self.lambda_L,
+                                              mu=self.mu,
+                                              epsilon_reg=self.epsilon_reg,
+                                              l2=self.l2,
+                                              random_state=self.random_state,
+                                              GtG=self._l2_gram().get("GtG"))
+        gamma_W = power_iteration_lipschitz_w(self.X_, self.G_, W, H, log_shift=self.log_shift, l2=self.l2, random_state=self.random_state, GtG=self._l2_gram().get("GtG"))
+        return [gamma_H, gamma_W]
+
+    def _reference_loss(self, eval_before):
+        if not(self.bb_steps):
+            return eval_before
+        # Nonmonotone safeguard of the Barzilai-Borwein steps
+        return max([eval_before] + self.losses_[-5:])
+
+    def _dicotomy_tol(self):
+        """Tolerance of the dichotomy for the current iteration.
+
+        With adaptive_dicotomy_tol, the tolerance is proportional to the quantities of the stopping criterion, i.e. 
+        the smallest of the last relative decrease of the loss and of the last relative change of W and H, so that 
+        it reaches dicotomy_tol when the stopping criterion is met. It is kept within [dicotomy_tol, dicotomy_tol_max].
+        """
+        if not(self.adaptive_dicotomy_tol):
+            return self.dicotomy_tol
+        tol_max = max(self.dicotomy_tol, dicotomy_tol_max)
+        losses = getattr(self, "losses_", None)
+        if not(losses) or len(losses) < 2:
+            return tol_max
+        change = min(abs(losses[-2] - losses[-1]) / abs(losses[0]), max(self.rel_[-1]))
+        if self.tol > 0:
+            change = change * self.dicotomy_tol / self.tol
+        return min(max(self.dicotomy_tol, change), tol_max)
+
+    def _HL(self, H):
+        """Product H @ L_, cached in the workspace so that the loss and the update of the same H share it."""
+        cached = self.workspace_.get("HL") if self.workspace_ is not None else None
+        if cached is not None and cached[0] is H:
+            return cached[1]
+        HL = H @ self.L_
+        if self.workspace_ is not None:
+            self.workspace_["HL"] = (H, HL)
+        return HL
 
     def loss(self, W, H, average=True, X = None):
         """Compute the loss function."""
@@ -336,7 +958,8 @@ class SmoothNMF(NMFEstimator):
             reg = reg / self.GWH_numel_
         self.detailed_loss_.append(reg)
 
-        l2 = 0.5 * self.lambda_L * trace_xtLx(self.L_, H.T, average=False)
+        # trace(H L H^T), with the product H @ L shared with the update of H
+        l2 = 0.5 * self.lambda_L * np.sum(H * self._HL(H), dtype=np.float64) if not(self.lambda_L==0) else 0.0
         if average:
             l2 = l2 / self.GWH_numel_
         self.detailed_loss_.append(l2)
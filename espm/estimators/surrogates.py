@@ -113,8 +113,13 @@ def smooth_dgkl_surrogate(Ht, L, H=None, sigmaL=sigmaL, lambda_L=1):
         t3 = np.sum(maxH * np.sum(dgkl(Ht, H), axis=1))
     return lambda_L / 2 * (2*t2 - t1 + sigmaL * t3)
 
-def diff_surrogate(Ht, H, L, sigmaL=sigmaL, lambda_L=1, algo="log_surrogate"):
+def diff_surrogate(Ht, H, L, sigmaL=sigmaL, lambda_L=1, algo="log_surrogate", HtL=None, HL=None):
     r"""Compute the difference between the surrogate and the true value of the Laplacian regularizer at :math:`H^t`.
+
+    If the products :math:`H^t \Delta` and :math:`H \Delta` are given (HtL and HL), the Laplacian is not used: 
+    for a symmetric :math:`\Delta`, the difference is 
+    :math:`\frac{\lambda_L}{2} ( \sigma_L d(H, H^t) - tr( (H - H^t) \Delta (H - H^t)^\top ) )`, where 
+    :math:`d` is the distance term of the surrogate.
     
     Parameters
     ----------
@@ -132,6 +137,10 @@ def diff_surrogate(Ht, H, L, sigmaL=sigmaL, lambda_L=1, algo="log_surrogate"):
         Algorithm to use for the surrogate, by default "log_surrogate"
         * "log_surrogate" : use the smooth KL surrogate
         * "l2_surrogate" : use the smooth L2 surrogate
+    HtL : np.ndarray, optional
+        Product :math:`H^t \Delta`, by default None
+    HL : np.ndarray, optional
+        Product :math:`H \Delta`, by default None
 
     Returns
     -------
@@ -139,6 +148,15 @@ def diff_surrogate(Ht, H, L, sigmaL=sigmaL, lambda_L=1, algo="log_surrogate"):
         Value of the difference between the surrogate and the true value of the Laplacian regularizer at :math:`H^t
 
     """
+    if HtL is not None and HL is not None:
+        if algo in ["log_surrogate", "bmd"]:
+            maxH = np.max(H, axis=1)
+            dist = np.sum(maxH * np.sum(Ht * np.log(Ht / H) - Ht + H, axis=1))
+        elif algo=="l2_surrogate":
+            dist = np.sum((Ht - H)**2)
+        else:
+            raise ValueError("Unknown algorithm")
+        return lambda_L / 2 * (sigmaL * dist - np.sum((HL - HtL) * (H - Ht)))
     b_inf = trace_xtLx(L, H.T) * lambda_L / 2
     if algo in ["log_surrogate", "bmd"]:
         b_supp = smooth_dgkl_surrogate(Ht, L=L, H=H, sigmaL=sigmaL, lambda_L=lambda_L)
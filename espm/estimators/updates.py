@@ -1,7 +1,354 @@
 import numpy as np
-from espm.conf import log_shift, dicotomy_tol, sigmaL
+import os
+from concurrent.futures import ThreadPoolExecutor
+from espm.conf import log_shift, dicotomy_tol, sigmaL, tile_bytes
+from scipy import sparse
+from scipy.fft import dctn, idctn
 from sklearn.decomposition._nmf import _initialize_nmf as initialize_nmf 
-from espm.estimators.dicotomy import dichotomy_simplex, dichotomy_simplex_acc, dichotomy_simplex_projected_gradient
+from sklearn.utils import check_random_state
+from espm.estimators.dicotomy import dichotomy_simplex, dichotomy_simplex_acc, simplex_projection_shift
+from espm.utils import sparse_product_values
+
+def kl_ratio(X, D, H, log_shift=log_shift):
+    """
+    Compute the ratio X / (D @ H) that appears in the KL updates.
+
+    If X is a scipy.sparse matrix, the product D @ H is only evaluated at the stored entries of X
+    and the ratio is returned as a csr matrix with the sparsity pattern of X. Zero entries of X do 
+    not contribute to the ratio, so that no n x p temporary is created.
+    """
+    if sparse.issparse(X):
+        X = X.tocsr()
+        DH = sparse_product_values(X, D, H)
+        data = X.data / DH
+        if np.any(np.isnan(data)):
+            data = X.data / np.maximum(DH, log_shift)
+        return sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape)
+    DH = D @ H
+    op = X / DH
+    if np.any(np.isnan(op)):
+        op = X / np.maximum(DH, log_shift)
+    return op
+
+def kl_products(X, D, H, log_shift=log_shift, DtR=True, RHt=False, n_jobs=None, tile_size=None, workspace=None, out=None, x_log=False):
+    """
+    Compute the products D.T @ R, of shape (k, p), and R @ H.T, of shape (n, k), with R = X / (D @ H), used by the KL updates of H and W.
+
+    For a dense X, the pixels (columns of X) are processed by tiles of `tile_size` columns: D @ H, the ratio and the products 
+    are computed for a tile before moving to the next one. The n x p temporaries are never materialized and the tile stays 
+    in cache. If `tile_size` is None, it is chosen such that the temporaries of a tile take about `tile_bytes` bytes. 
+    The tiles are split into `n_jobs` contiguous groups processed by a pool of threads (NumPy releases the GIL). 
+    If n_jobs is None, the tiles are processed sequentially and -1 means one thread per CPU.
+    For a sparse X, the ratio is computed with `kl_ratio`.
+
+    If x_log is True, a dict is given as `workspace` and X is dense, the log term of the KL loss (see :func:`espm.measures.KLdiv_loss`) 
+    at D and H is also accumulated over the tiles and stored in workspace["x_log"], so that the loss at D and H comes at the 
+    cost of one more log per entry instead of a full evaluation.
+
+    The products that are not requested (DtR or RHt False) are returned as None. D.T @ R is written in `out` if it is given.
+    The temporaries of the tiles are allocated once per thread and reused, so that no n x p array is allocated.
+    """
+    if sparse.issparse(X):
+        ratio = kl_ratio(X, D, H, log_shift=log_shift)
+        if DtR and out is not None:
+            out[...] = D.T @ ratio
+            return out, (ratio @ H.T if RHt else None)
+        return (D.T @ ratio if DtR else None), (ratio @ H.T if RHt else None)
+
+    n, p = X.shape
+    dtype = np.result_type(X, D, H)
+    if tile_size is None:
+        # Temporaries of a tile: the tile of X, D @ H and the ratio
+        tile_size = max(1, tile_bytes // (3 * n * dtype.itemsize))
+    n_jobs = 1 if n_jobs is None else (os.cpu_count() if n_jobs < 0 else n_jobs)
+    starts = list(range(0, p, tile_size))
+    n_jobs = max(1, min(n_jobs, len(starts)))
+
+    if DtR:
+        out_DtR = np.empty((D.shape[1], p), dtype=dtype) if out is None else out
+    else:
+        out_DtR = None
+    x_log = x_log and workspace is not None
+    # The loss is evaluated with D and H clipped at log_shift (as in KLdiv_loss), which only matters if they have smaller entries
+    clip_D = x_log and np.any(D < log_shift)
+    clip_H = x_log and np.any(H < log_shift)
+    D_loss = np.maximum(D, log_shift) if clip_D else D
+
+    def process(group):
+        out_RHt = np.zeros((n, H.shape[0]), dtype=dtype) if RHt else None
+        out_x_log = 0.0
+        if len(group) == 0:
+            return out_RHt, out_x_log
+        # Buffers of the tile, reused for all the tiles of the group
+        DH_buf = np.empty((n, tile_size), dtype=dtype)
+        ratio_buf = np.empty((n, tile_size), dtype=dtype)
+        log_buf = np.empty((n, tile_size), dtype=dtype) if x_log else None
+        for start in group:
+            sl = slice(start, min(start + tile_size, p))
+            width = sl.stop - sl.start
+            DH = np.matmul(D, H[:, sl], out=DH_buf[:, :width])
+            if x_log:
+                log_DH = log_buf[:, :width]
+                if clip_D or clip_H:
+                    np.matmul(D_loss, np.maximum(H[:, sl], log_shift), out=log_DH)
+                    np.log(log_DH, out=log_DH)
+                else:
+                    np.log(DH, out=log_DH)
+                log_DH *= np.maximum(X[:, sl], log_shift)
+                out_x_log += np.sum(log_DH, dtype=np.float64)
+            ratio = np.divide(X[:, sl], DH, out=ratio_buf[:, :width])
+            if np.any(np.isnan(ratio)):
+                np.divide(X[:, sl], np.maximum(DH, log_shift, out=DH), out=ratio)
+            if DtR:
+                np.matmul(D.T, ratio, out=out_DtR[:, sl])
+            if RHt:
+                out_RHt += ratio @ H[:, sl].T
+        return out_RHt, out_x_log
+
+    groups = np.array_split(starts, n_jobs)
+    if n_jobs == 1:
+        partials = [process(groups[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            partials = list(executor.map(process, groups))
+    if x_log:
+        workspace["x_log"] = sum(partial[1] for partial in partials)
+    return out_DtR, (sum(partial[0] for partial in partials) if RHt else None)
+
+def data_sum(X, axis=None, keepdims=False):
+    """
+    Sum of X along an axis that also returns np.ndarray (and not np.matrix) for sparse X.
+
+    It is used for both the data matrix X and the (possibly sparse) G matrix, e.g. ``data_sum(G, axis=0, keepdims=True)``.
+    """
+    if sparse.issparse(X):
+        s = np.asarray(X.sum(axis=axis))
+        if axis is None or keepdims:
+            return s
+        return s.ravel()
+    return np.sum(X, axis=axis, keepdims=keepdims)
+
+def G_matmul(G, W):
+    """
+    Compute G @ W, where G=None stands for the identity matrix.
+    """
+    if G is None:
+        return W
+    return G @ W
+
+def Gt_matmul(G, M):
+    """
+    Compute G.T @ M, where G=None stands for the identity matrix.
+    """
+    if G is None:
+        return M
+    return G.T @ M
+
+def _operand(A):
+    """Shape and cost per column of a right operand (its number of stored entries if it is sparse)."""
+    if sparse.issparse(A):
+        return A.shape[0], A.shape[1], A.nnz
+    return A.shape[0], A.shape[1], None
+
+def _product_cost(a, b):
+    """Number of multiplications of the product of two operands described by `_operand`."""
+    if a[2] is not None:
+        return a[2] * b[1]
+    if b[2] is not None:
+        return a[0] * b[2]
+    return a[0] * a[1] * b[1]
+
+def contraction_order(factors):
+    """
+    Cheapest association order of the product of the factors, found by dynamic programming over the splits as in 
+    `np.linalg.multi_dot`. The factors are arrays, scipy.sparse matrices (whose cost is their number of stored entries) 
+    or tuples (rows, columns, number of stored entries or None if dense) describing them.
+
+    Returns
+    -------
+    order : int or tuple
+        Nested pairs of operand indices, e.g. (0, (1, 2)) for A @ (B @ C).
+    cost : int
+        Number of multiplications of this order.
+    """
+    operands = [F if isinstance(F, tuple) else _operand(F) for F in factors]
+    n = len(operands)
+    # best[i, j] = (cost, order, operand) of the product of the operands i to j, the intermediate products being dense
+    best = {(i, i): (0, i, operands[i]) for i in range(n)}
+    for length in range(1, n):
+        for i in range(n - length):
+            j = i + length
+            candidates = []
+            for split in range(i, j):
+                left, right = best[(i, split)], best[(split + 1, j)]
+                cost = left[0] + right[0] + _product_cost(left[2], right[2])
+                candidates.append((cost, (left[1], right[1])))
+            cost, order = min(candidates, key=lambda c: c[0])
+            best[(i, j)] = (cost, order, (operands[i][0], operands[j][1], None))
+    return best[(0, n - 1)][1], best[(0, n - 1)][0]
+
+def matmul_chain(*factors):
+    """
+    Product of the factors in the cheapest association order for their shapes (see `contraction_order`), e.g. for 
+    G.T @ X @ H.T, (G.T @ X) @ H.T costs n m p + m p k and G.T @ (X @ H.T) costs n p k + n k m. The factors can be 
+    scipy.sparse matrices and None, which stands for the identity (as in `G_matmul`) and is skipped.
+    """
+    factors = [F for F in factors if F is not None]
+    if len(factors) == 1:
+        return factors[0]
+    order, _ = contraction_order(factors)
+
+    def evaluate(node):
+        if isinstance(node, tuple):
+            return evaluate(node[0]) @ evaluate(node[1])
+        return factors[node]
+    product = evaluate(order)
+    return np.asarray(product) if isinstance(product, np.matrix) else product
+
+def G_colsum(G, m, dtype=np.float64):
+    """
+    Column sums of G as an array of shape (1, m), where G=None stands for the (m, m) identity matrix.
+    """
+    if G is None:
+        return np.ones((1, m), dtype=dtype)
+    return data_sum(G, axis=0, keepdims=True)
+
+def is_identity(G):
+    """
+    Check whether G is the identity matrix. G can be None (implicit identity), a np.ndarray or a scipy.sparse matrix.
+    """
+    if G is None:
+        return True
+    if G.shape[0] != G.shape[1]:
+        return False
+    if sparse.issparse(G):
+        return abs(G - sparse.identity(G.shape[0], format="csr")).max() <= 1e-8
+    return np.allclose(G, np.eye(G.shape[0]))
+
+class FixedEntries:
+    """
+    Entries of W or H fixed with the fixed_W or fixed_H parameter of the estimators (the entries >= 0 are fixed to 
+    their value, the negative ones are free), compiled once into index arrays.
+
+    The update functions accept either the fixed matrix, which is then compiled at each call, or a `FixedEntries`.
+
+    Attributes
+    ----------
+    mask : np.ndarray of bool
+        True for the fixed entries.
+    matrix : np.ndarray
+        The fixed matrix.
+    index, values : np.ndarray
+        Flat (C order) indices of the fixed entries and their values.
+    free_rows, free_cols : np.ndarray
+        Row and column indices of the free entries.
+    """
+    def __init__(self, fixed):
+        self.matrix = np.asarray(fixed)
+        self.shape = self.matrix.shape
+        self.mask = self.matrix >= 0
+        self.index = np.flatnonzero(self.mask)
+        self.values = self.matrix.ravel()[self.index]
+        self.free_rows, self.free_cols = np.nonzero(~self.mask)
+
+    @property
+    def n_free(self):
+        return len(self.free_rows)
+
+    def apply(self, M):
+        """Set the fixed entries of M (in place) and return M."""
+        if M.flags.c_contiguous:
+            M.reshape(-1)[self.index] = self.values
+        else:
+            M[self.mask] = self.values
+        return M
+
+    def fill(self, free_values, dtype=None):
+        """Matrix with the fixed values and the free entries set to free_values."""
+        M = np.empty(self.shape, dtype=self.values.dtype if dtype is None else dtype)
+        M.reshape(-1)[self.index] = self.values
+        M[self.free_rows, self.free_cols] = free_values
+        return M
+
+def compile_fixed(fixed):
+    """Compile a fixed_W or fixed_H matrix into `FixedEntries` (None and `FixedEntries` are returned as is)."""
+    if fixed is None or isinstance(fixed, FixedEntries):
+        return fixed
+    return FixedEntries(fixed)
+
+def compile_indices(indices):
+    """
+    Compile row indices, e.g. the ones of `physics_model.NMF_simplex()`, into a slice if they are contiguous, so that 
+    indexing returns a view, or into an integer array otherwise.
+    """
+    if isinstance(indices, slice):
+        return indices
+    indices = np.asarray(indices, dtype=np.intp).ravel()
+    if len(indices) > 0 and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+def simplex_rows(physics_model, simplex_indices=None):
+    """Rows of W on which the simplex constraint is applied: simplex_indices if given, else the ones of the physics model (all rows if it is None)."""
+    if simplex_indices is not None:
+        return simplex_indices
+    if physics_model is None:
+        return slice(None)
+    return compile_indices(physics_model.NMF_simplex())
+
+def Gt_matmul_entries(G, M, rows, cols):
+    """
+    Entries (rows[i], cols[i]) of G.T @ M, where G=None stands for the identity matrix, in O(n len(rows)) operations.
+    """
+    if G is None:
+        return M[rows, cols]
+    if sparse.issparse(G):
+        Gr = G.tocsc()[:, rows]
+        return np.asarray(Gr.multiply(M[:, cols]).sum(axis=0)).ravel()
+    return np.einsum("ni,ni->i", G[:, rows], M[:, cols])
+
+def carto_structure(fixed_W):
+    """
+    Detect the pattern of the fixed_W matrices of `espm.datasets.eds_spim.EDS_espm.carto_fixed_W` (chemical mapping).
+
+    The element columns of W have a single free entry, on distinct rows, and their other entries are fixed to 0, so that 
+    the columns of G @ W are the spectra of the elements up to a scale. The free entries of the other (bremsstrahlung) 
+    columns must not be on the rows of the elements and their fixed entries must be 0.
+
+    Returns
+    -------
+    structure : tuple or None
+        (element_rows, element_cols, other_rows, other_cols), where other_rows are the rows of the free entries of the 
+        other columns, or None if fixed_W does not have this pattern.
+    """
+    if fixed_W is None:
+        return None
+    fixed_W = compile_fixed(fixed_W)
+    if np.any(fixed_W.values != 0):
+        return None
+    free = ~fixed_W.mask
+    n_free = np.sum(free, axis=0)
+    element_cols = np.flatnonzero(n_free == 1)
+    other_cols = np.flatnonzero(n_free != 1)
+    element_rows = np.argmax(free[:, element_cols], axis=0)
+    other_rows = np.flatnonzero(np.any(free[:, other_cols], axis=1))
+    if len(element_cols) == 0 or len(np.unique(element_rows)) < len(element_rows) or len(np.intersect1d(element_rows, other_rows)) > 0:
+        return None
+    return element_rows, element_cols, other_rows, other_cols
+
+def carto_GW(G, W, structure):
+    """
+    G @ W for W with the pattern of `carto_structure`: the element columns are scaled columns of G and only the rows 
+    other_rows of W contribute to the other columns, so that it costs O(n k + n m_b k_b) operations instead of O(n m k).
+    """
+    if G is None or sparse.issparse(G):
+        return G_matmul(G, W)
+    element_rows, element_cols, other_rows, other_cols = structure
+    GW = np.empty((G.shape[0], W.shape[1]), dtype=np.result_type(G, W))
+    GW[:, element_cols] = G[:, element_rows] * W[element_rows, element_cols]
+    if len(other_cols) > 0:
+        GW[:, other_cols] = G[:, other_rows] @ W[np.ix_(other_rows, other_cols)]
+    return GW
 
 def multiplicative_step_w(X,
                           G,
@@ -13,73 +360,108 @@ def multiplicative_step_w(X,
                           l2=False,
                           fixed_W = None,
                           physics_model=None,
-                          use_bregman=False):
+                          use_bregman=False,
+                          n_jobs=None,
+                          dicotomy_tol=dicotomy_tol,
+                          workspace=None,
+                          simplex_indices=None,
+                          GtG=None,
+                          GtX=None):
     """
     Multiplicative step in W.
+    For the KL loss, n_jobs threads are used to compute the main terms (see `kl_products`).
+    With simplex_W, the Lagrange multiplier is read from and stored in workspace["nu"] (see `multiplicative_step_w_stats`).
+    fixed_W can be compiled with `compile_fixed` and the rows of the simplex constraint (`physics_model.NMF_simplex()`) 
+    can be given with simplex_indices (see `compile_indices`). Without simplex_W, when most of W is fixed, only its free 
+    entries are computed. For the l2 loss, G.T @ G and G.T @ X can be given precomputed with GtG and GtX (see `l2_products`).
     """
+    fixed_W = compile_fixed(fixed_W)
     if safe:
         # Allow for very small negative values!
         assert(np.sum(H<-log_shift/2)==0)
         assert(np.sum(W<-log_shift/2)==0)
-        assert(np.sum(G<-log_shift/2)==0)
+        assert(G is None or np.sum(G<-log_shift/2)==0)
 
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
     if l2:
-        GG = G.T @ G
+        if GtX is None:
+            GG = None if G is None else G.T @ G
+            GXH = matmul_chain(None if G is None else G.T, X, H.T)
+        else:
+            GG = GtG
+            GXH = GtX @ H.T
         HH = H @ H.T
-        GGWHH = GG @ W @ HH
-
-        GXH = G.T @ (X @ H.T)
+        GGWHH = G_matmul(GG, W) @ HH
 
         new_W = W / GGWHH * GXH
     else:
-        GW = G @ W
-        GWH = GW @ H
-        if use_bregman:
-            # check if G is the identity matrix
-            if np.allclose(G, np.eye(G.shape[0])):
-                sigmaR = np.sum(X, axis=1, keepdims=True)
-            else:
-                sigmaR = np.sum(X)
-            num = sigmaR * W
-            gradg = - G.T @ (X / GWH) @ H.T + np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
-            denum = gradg * W + sigmaR
+        GW = G_matmul(G, W)
+        if not(use_bregman):
+            # Only the stored entries of a sparse X contribute to the ratio
+            _, XHt = kl_products(X, GW, H, log_shift=log_shift, DtR=False, RHt=True, n_jobs=n_jobs)
+            if fixed_W is not None and not(simplex_W) and 4*fixed_W.n_free <= W.size:
+                # Only the free entries of G.T @ XHt are needed
+                rows, cols = fixed_W.free_rows, fixed_W.free_cols
+                num = W[rows, cols] * Gt_matmul_entries(G, XHt, rows, cols)
+                denum = G_colsum(G, W.shape[0], dtype=W.dtype)[0, rows] * np.sum(H, axis=1)[cols]
+                return fixed_W.fill(np.maximum(num / denum, log_shift), dtype=num.dtype)
+            return multiplicative_step_w_stats(G, W*Gt_matmul(G, XHt), np.sum(H, axis=1), simplex_W=simplex_W, log_shift=log_shift, fixed_W=fixed_W, physics_model=physics_model, dicotomy_tol=dicotomy_tol, workspace=workspace, simplex_indices=simplex_indices)
 
+        # check if G is the identity matrix
+        if is_identity(G):
+            sigmaR = data_sum(X, axis=1, keepdims=True)
         else:
-            # Split to debug timing...
-            # term1 = G.T @ (X / (GWH + eps)) @ H.T
-            op1 = X / GWH
-            if np.any(np.isnan(op1)):
-                GWH = np.maximum(GWH, log_shift)
-                op1 = X / GWH
-            
-            mult1 = G.T @ op1
-            num = W*(mult1 @ H.T)
-            denum = np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
-            if simplex_W:
-                if physics_model != None:
-                    indices = physics_model.NMF_simplex()
-                    nu = dichotomy_simplex(num[indices,:], denum[indices,:], log_shift=log_shift, tol=dicotomy_tol)
-                    denum[indices,:] = denum[indices,:] + nu
-                else : 
-                    nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol)
-                    denum = denum + nu
+            sigmaR = data_sum(X)
+        num = sigmaR * W
+        op1 = kl_ratio(X, GW, H, log_shift=log_shift)
+        gradg = - matmul_chain(None if G is None else G.T, op1, H.T) + G_colsum(G, W.shape[0], dtype=W.dtype).T @ np.sum(H, axis=1,  keepdims=True).T
+        denum = gradg * W + sigmaR
 
         new_W = num / denum
-    
+
     new_W = np.maximum(new_W, log_shift)
     
-    # TODO: exclude the fixed values in the update process. It is not straightforward
     if fixed_W is not None: 
-        new_W[fixed_W >= 0] = fixed_W[fixed_W >=0]
+        fixed_W.apply(new_W)
     return new_W
 
 
 
 
-def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, sigmaL=sigmaL, fixed_H = None, use_bregman=False):
+def multiplicative_step_w_stats(G, num, H_sum, simplex_W=False, log_shift=log_shift, fixed_W=None, physics_model=None, dicotomy_tol=dicotomy_tol, workspace=None, simplex_indices=None):
+    """
+    Multiplicative step in W (KL loss) from accumulated statistics.
+
+    The KL step in W only depends on the data through the numerator num = W * (G.T @ (X / GWH) @ H.T), of shape (m, k), 
+    and on the row sums H_sum of H, of shape (k,). Both are sums over the pixels (columns of X), so they can be accumulated 
+    over blocks of pixels before taking the step.
+
+    If workspace is a dict, the Lagrange multiplier of the simplex constraint is warm started from workspace["nu"] and 
+    the new multiplier is stored in it.
+    """
+    denum = G_colsum(G, num.shape[0], dtype=num.dtype).T @ H_sum[np.newaxis, :]
+
+    if simplex_W:
+        nu0 = None if workspace is None else workspace.get("nu")
+        if physics_model != None or simplex_indices is not None:
+            indices = simplex_rows(physics_model, simplex_indices)
+            nu = dichotomy_simplex(num[indices,:], denum[indices,:], log_shift=log_shift, tol=dicotomy_tol, nu0=nu0)
+            denum[indices,:] = denum[indices,:] + nu
+        else : 
+            nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, nu0=nu0)
+            denum = denum + nu
+        if workspace is not None:
+            workspace["nu"] = nu
+
+    new_W = np.maximum(num / denum, log_shift)
+
+    if fixed_W is not None: 
+        compile_fixed(fixed_W).apply(new_W)
+    return new_W
+
+def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, sigmaL=sigmaL, fixed_H = None, use_bregman=False, HL=None, maxH=None, n_jobs=None, workspace=None, GW=None, out=None, DtR=None, GtG=None, GtX=None, x_log=False):
     """
     Multiplicative step in A.
     The main terms are calculated first.
@@ -88,8 +470,17 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
     by the mask are calculaed, without particle regularization. Note that mu can be passed
     as a vector to regularize the different phase of A differently.
     To calculate the regularized step, we make a linear approximation of the log.
+
+    The step is separable over the pixels (columns of H) except for the Laplacian terms H @ L and the row maxima of H.
+    They can be given precomputed with HL and maxH, e.g. to update H by blocks of pixels. The product G @ W can be given precomputed with GW, 
+    and for the KL loss D.T @ (X / (D @ H)) (D = G @ W) with DtR, which is then overwritten. For the l2 loss, G.T @ G and 
+    G.T @ X can be given precomputed with GtG and GtX (see `l2_products`).
+    For the KL loss, n_jobs threads are used to compute the main terms (see `kl_products`). If a dict is given as workspace 
+    and x_log is True, the log term of the KL loss at the input W and H is stored in it (see `kl_products`). With simplex_H, 
+    the Lagrange multiplier is warm started from workspace["nu"] and the new one is stored in it.
+    The new H is written in `out` if it is given (it must not be H). The intermediate terms are computed in place.
     """
-    if not(lambda_L==0):
+    if not(lambda_L==0) and HL is None:
         if L is None:
             raise ValueError("Please provide the laplacian")
         HL = H@L
@@ -99,11 +490,12 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
         # TODO: update this
         assert(np.sum(H<-log_shift/2)==0)
         assert(np.sum(W<-log_shift/2)==0)
-        assert(np.sum(G<-log_shift/2)==0)
+        assert(G is None or np.sum(G<-log_shift/2)==0)
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
-    GW = G @ W # Also called D
+    if GW is None and not(l2 and GtX is not None):
+        GW = G_matmul(G, W) # Also called D
     
     if l2:
         assert lambda_L == 0
@@ -111,67 +503,106 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
             assert mu == 0
         else:
             assert (mu==0).all()
-        WGGW = GW.T @ GW
-        WGX = GW.T @ X
+        if GtX is None:
+            WGGW = GW.T @ GW
+            WGX = GW.T @ X
+        else:
+            WGGW = W.T @ G_matmul(GtG, W)
+            WGX = W.T @ GtX
         num = WGX
         denum = WGGW @ H
     else:
         if use_bregman:
-            GWH = GW @ H
-            sigmaR = np.sum(X, axis=0, keepdims=True)
+            sigmaR = data_sum(X, axis=0, keepdims=True)
             num = sigmaR / H
-            gradg = - GW.T @ (X / GWH) +  np.sum(GW, axis=0,  keepdims=True).T
+            if sparse.issparse(X):
+                op1 = kl_ratio(X, GW, H, log_shift=log_shift)
+            else:
+                GWH = GW @ H
+                op1 = X / GWH
+            gradg = - GW.T @ op1 +  np.sum(GW, axis=0,  keepdims=True).T
             denum = gradg + sigmaR / H
         else:
-            GWH = GW @ H
-            num = GW.T @ (X / GWH)
-            if np.any(np.isnan(num)):
-                GWH = np.maximum(GWH, log_shift)
-                num = GW.T @ (X / GWH)
+            if DtR is None:
+                # Only the stored entries of a sparse X contribute to the ratio
+                num, _ = kl_products(X, GW, H, log_shift=log_shift, n_jobs=n_jobs, workspace=workspace, out=out, x_log=x_log)
+            else:
+                num = DtR
             denum = np.sum(GW, axis=0, keepdims=True).T 
 
         if not(np.isscalar(mu) and mu==0):
             if len(np.shape(mu))==1:
-                mu = np.expand_dims(mu, axis=1)
-            denum = denum + mu / (H + epsilon_reg)
+                mu = np.expand_dims(np.asarray(mu, dtype=H.dtype), axis=1)
+            reg = np.add(H, epsilon_reg)
+            reg = np.divide(mu, reg, out=reg)
+            reg += denum
+            denum = reg
         if not(lambda_L==0):
-            maxH = np.max(H, axis=1, keepdims=True)
-            num = num + lambda_L * sigmaL * maxH
-            denum = denum + lambda_L * sigmaL * maxH + lambda_L * HL 
-    num = H * num
+            if maxH is None:
+                maxH = np.max(H, axis=1, keepdims=True)
+            num += lambda_L * sigmaL * maxH
+            lap = np.multiply(HL, lambda_L)
+            lap += denum
+            lap += lambda_L * sigmaL * maxH
+            denum = lap
+    # num is a temporary (or out) at this point, the next operations are done in place
+    num = np.multiply(H, num, out=num)
     if simplex_H:
-        nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol)
-    else:
-        nu = 0
+        # The multiplier of the previous iteration is a good starting point
+        nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, nu0=None if workspace is None else workspace.get("nu"))
+        if workspace is not None:
+            workspace["nu"] = nu
+        denum = denum + nu
     if safe:
         assert np.sum(denum<0)==0
         assert np.sum(num<0)==0
 
     # Add the shift...
-    new_H = np.maximum(num/(denum+nu), log_shift)
+    new_H = np.divide(num, denum, out=num)
+    new_H = np.maximum(new_H, log_shift, out=new_H)
 
+    if out is not None and new_H is not out:
+        out[...] = new_H
+        new_H = out
     if fixed_H is not None: 
-        new_H[fixed_H >= 0] = fixed_H[fixed_H >= 0]
+        compile_fixed(fixed_H).apply(new_H)
     return new_H
 
 
 
-def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_H, simplex_W, logshift=log_shift, physics_model = None):
-    # Handle initialization
-
-    if G is None : 
-        skip_second = True
-        # G = sparse.diags(np.ones(X.shape[0]).astype(X.dtype))        
-        G = np.diag(np.ones(X.shape[0]).astype(X.dtype))
+def initialize_W(D, G, simplex_W, physics_model = None):
+    """
+    Initialize W from an estimate D of GW, i.e. solve GW = D in the least squares sense.
+    If G is None (identity), W is D.
+    """
+    if G is None:
+        return D
+    if physics_model != None: 
+    # [np.where(G[:,:-2].sum(axis=1)<(np.max(G[:,:-2].sum(axis=1))*0.001))[0],:]
+    # Divide in two parts the initial fitting, otherwise the bremsstrahlung (which has a low intensity) tends to be poorly learned
+    # First fit the caracteristic Xrays, then subtract that contribution to obtain a rough estimate of the bremsstralung parameters
+        W = physics_model.NMF_initialize_W(D)
+        # Wbrem = (np.linalg.lstsq(G[:,-2:],D - G[:,:-2]@Wcarac,rcond = None)[0]).clip(min = 0)
+        if simplex_W:
+            indices = physics_model.NMF_simplex()
+            W = np.nan_to_num(W, nan = 1.0/W.shape[0])
+            scale = np.sum(W[indices,:], axis=0, keepdims=True)
+            W[indices,:] = W[indices,:]/scale
+    # P = np.abs(np.linalg.lstsq(G, D,rcond=None)[0])
+    else : 
+        # The initialization is done once, a sparse G can be densified here
+        Gd = G.toarray() if sparse.issparse(G) else G
+        W = np.abs(np.linalg.lstsq(Gd, D,rcond=None)[0])
 
-    # elif callable(G) : 
-    #     assert not(model_params is None), "You need to input model_parameters"
-    #     assert not(g_params is None), "You need to input g_parameters"
-    #     G = G(model_params,g_params)
-    #     skip_second = False
+        if simplex_W:
+            W = np.nan_to_num(W, nan = 1.0/W.shape[0])
+            scale = np.sum(W, axis=0, keepdims=True)
+            W = W/scale
+    return W
 
-    else:
-        skip_second = False
+def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_H, simplex_W, logshift=log_shift, physics_model = None):
+    # Handle initialization
+    # If G is None, it stays None: it is handled as an implicit identity matrix by the update functions
 
     if W is None:
         if H is None:
@@ -184,34 +615,20 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
                 
                 # D = np.abs(np.linalg.lstsq(H.T, X.T,rcond=None)[0].T)
                 D = D*np.mean(scale)
+        elif sparse.issparse(X):
+            # Least squares solution without densifying X
+            D = np.abs(X @ np.linalg.pinv(H))
         else:
             D = np.abs(np.linalg.lstsq(H.T, X.T,rcond=None)[0].T)
-        if skip_second:
-            W = D
-        else:
-            if physics_model != None: 
-            # [np.where(G[:,:-2].sum(axis=1)<(np.max(G[:,:-2].sum(axis=1))*0.001))[0],:]
-            # Divide in two parts the initial fitting, otherwise the bremsstrahlung (which has a low intensity) tends to be poorly learned
-            # First fit the caracteristic Xrays, then subtract that contribution to obtain a rough estimate of the bremsstralung parameters
-                W = physics_model.NMF_initialize_W(D)
-                # Wbrem = (np.linalg.lstsq(G[:,-2:],D - G[:,:-2]@Wcarac,rcond = None)[0]).clip(min = 0)
-                if simplex_W:
-                    indices = physics_model.NMF_simplex()
-                    W = np.nan_to_num(W, nan = 1.0/W.shape[0])
-                    scale = np.sum(W[indices,:], axis=0, keepdims=True)
-                    W[indices,:] = W[indices,:]/scale
-            # P = np.abs(np.linalg.lstsq(G, D,rcond=None)[0])
-            else : 
-                W = np.abs(np.linalg.lstsq(G, D,rcond=None)[0])
-
-                if simplex_W:
-                    W = np.nan_to_num(W, nan = 1.0/W.shape[0])
-                    scale = np.sum(W, axis=0, keepdims=True)
-                    W = W/scale
+        W = initialize_W(D, G, simplex_W, physics_model=physics_model)
 
     elif H is None:
-        D = G @ W
-        H = np.abs(np.linalg.lstsq(D, X, rcond=None)[0])
+        D = G_matmul(G, W)
+        if sparse.issparse(X):
+            # Least squares solution without densifying X
+            H = np.abs(np.linalg.pinv(D) @ X)
+        else:
+            H = np.abs(np.linalg.lstsq(D, X, rcond=None)[0])
         if simplex_H:
             scale = np.sum(H, axis=0, keepdims=True)
             H = H/scale
@@ -228,7 +645,7 @@ def update_q(D, H, log_shift=log_shift):
     Ntmp = np.expand_dims(D @ H, axis=2) 
     return Htmp * (Dtmp / (Ntmp+log_shift))
    
-def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, safe=True, physics_model = None):
+def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, safe=True, physics_model = None, simplex_indices=None):
     """
     Multiplicative step in W using the WQ technique.
 
@@ -239,19 +656,19 @@ def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, sa
         # Allow for very small negative values!
         assert np.sum(H<-log_shift/2)==0
         assert np.sum(W<-log_shift/2)==0
-        assert np.sum(G<-log_shift/2)==0
+        assert G is None or np.sum(G<-log_shift/2)==0
 
-    GW = G @ W
+    GW = G_matmul(G, W)
     Q = update_q(GW, H, log_shift=log_shift)
 
     XQ = np.sum(np.expand_dims(X, axis=2) * Q, axis=1)
 
-    term1 = G.T @ (XQ / (GW + log_shift)) 
+    term1 = Gt_matmul(G, XQ / (GW + log_shift)) 
 
-    term2 = np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
+    term2 = G_colsum(G, W.shape[0], dtype=W.dtype).T @ np.sum(H, axis=1,  keepdims=True).T
     if simplex_W :
-        if physics_model != None:
-            indices = physics_model.NMF_simplex()
+        if physics_model != None or simplex_indices is not None:
+            indices = simplex_rows(physics_model, simplex_indices)
             nu = dichotomy_simplex(term1[indices,:], term2[indices,:], log_shift=log_shift, tol=dicotomy_tol)
             term2[indices,:] = term2[indices,:] + nu
         else : 
@@ -259,9 +676,10 @@ def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, sa
             term2 = term2 + nu
     return W / term2 * term1
 
-def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, sigmaL=sigmaL, fixed_H = None):
+def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, sigmaL=sigmaL, fixed_H = None, workspace=None):
     """
     Multiplicative step in H.
+    If workspace is a dict, the Lagrange multiplier of the simplex constraint is warm started from workspace["nu"] (see `multiplicative_step_h`).
     """
     if not lambda_L==0:
         if L is None:
@@ -271,138 +689,433 @@ def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe
         # Allow for very small negative values!
         assert np.sum(H<-log_shift/2)==0
         assert np.sum(W<-log_shift/2)==0
-        assert np.sum(G<-log_shift/2)==0
+        assert G is None or np.sum(G<-log_shift/2)==0
 
-    GW = G @ W # Also called D
-    GWH = GW @ H
-
-    minus_c = H * (GW.T @ (X / (GWH+log_shift)))
+    GW = G_matmul(G, W) # Also called D
+    if sparse.issparse(X):
+        minus_c = H * (GW.T @ kl_ratio(X, GW, H, log_shift=log_shift))
+    else:
+        GWH = GW @ H
+        minus_c = H * (GW.T @ (X / (GWH+log_shift)))
 
     b = np.sum(GW, axis=0, keepdims=True).T 
     if not lambda_L==0 :
         b = b + lambda_L * H @ L - lambda_L * sigmaL  * H 
         a = lambda_L * sigmaL
         if simplex_H:
-            nu = dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol)
+            nu = dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol, nu0=None if workspace is None else workspace.get("nu"))
             b = b + nu
         new_H = (-b + np.sqrt(b**2 + 4* a *minus_c)) / (2*a)
     else: # We recover the classic case: multiplicative_step_a
         if simplex_H:
-            nu = dichotomy_simplex(minus_c, b, log_shift=log_shift, tol=dicotomy_tol)
+            nu = dichotomy_simplex(minus_c, b, log_shift=log_shift, tol=dicotomy_tol, nu0=None if workspace is None else workspace.get("nu"))
             b = b + nu
         new_H = minus_c / b
+    if simplex_H and workspace is not None:
+        workspace["nu"] = nu
 
     # Add the shift...
     new_H = np.maximum(new_H, log_shift)
 
     if fixed_H is not None: 
-        new_H[fixed_H >= 0] = fixed_H[fixed_H >= 0]
+        compile_fixed(fixed_H).apply(new_H)
     return new_H
 
-def gradW(X, G, W, H, log_shift=log_shift, safe=False, l2=False):
+def gradW(X, G, W, H, log_shift=log_shift, safe=False, l2=False, GtG=None, GtX=None):
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
-    if l2:
-        grad = 2*G.T @ ( (G @ W) @ H - X ) @ H.T
+    if l2 and GtX is not None:
+        # From the products of `l2_products`
+        grad = 2*(G_matmul(GtG, W) @ (H @ H.T) - GtX @ H.T)
+    elif l2:
+        grad = 2*matmul_chain(None if G is None else G.T, matmul_chain(G, W, H) - X, H.T)
     else:
-        D = G @ W
-        DH = D @ H
-        grad = G.T @ (- (X / DH) @ H.T + np.sum(H, axis=1, keepdims=True).T)
+        D = G_matmul(G, W)
+        # The ratio X / DH is processed by tiles, without n x p temporaries
+        _, XHt = kl_products(X, D, H, log_shift=log_shift, DtR=False, RHt=True)
+        XHt = np.subtract(np.sum(H, axis=1, keepdims=True).T, XHt, out=XHt)
+        grad = Gt_matmul(G, XHt)
     return grad
 
-def gradH(X, G, W, H, mu=0,  lambda_L=0, L=None, epsilon_reg=1, log_shift=log_shift, safe=False, l2=False):
+def gradH(X, G, W, H, mu=0,  lambda_L=0, L=None, epsilon_reg=1, log_shift=log_shift, safe=False, l2=False, GtG=None, GtX=None):
     if not(lambda_L==0):
         if L is None:
             raise ValueError("Please provide the laplacian")
-        HL = H@L
     
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
 
-    if l2:
-        D = G @ W
+    if l2 and GtX is not None:
+        # From the products of `l2_products`
+        grad = (W.T @ G_matmul(GtG, W)) @ H - W.T @ GtX
+    elif l2:
+        D = G_matmul(G, W)
         grad = D.T @ (D @ H - X)
     else:
-        D = G @ W
-        DH = D @ H
-        grad =  - D.T @ (X / DH) + np.sum(D, axis=0, keepdims=True).T
+        D = G_matmul(G, W)
+        # The ratio X / DH is processed by tiles, without n x p temporaries
+        grad, _ = kl_products(X, D, H, log_shift=log_shift)
+        grad = np.subtract(np.sum(D, axis=0, keepdims=True).T, grad, out=grad)
 
     if not(np.isscalar(mu) and mu==0):
         if len(np.shape(mu))==1:
-            mu = np.expand_dims(mu, axis=1)
+            mu = np.expand_dims(np.asarray(mu, dtype=H.dtype), axis=1)
         grad += mu / (H + epsilon_reg)
 
     if not(lambda_L==0):
-        grad += (lambda_L * L @ H.T).T
+        # L is symmetric, H @ L = (L @ H.T).T
+        grad += lambda_L * (H @ L)
 
     return grad
 # 
-def proj_grad_step_w(X, G, W, H, gamma, simplex_W = True, log_shift=log_shift, safe=True, l2=False, fixed_W = None):
-    """Projected gradient step for the variable W."""
+def proj_grad_step_w(X, G, W, H, gamma, simplex_W = True, log_shift=log_shift, safe=True, l2=False, fixed_W = None, grad=None, GtG=None, GtX=None):
+    """Projected gradient step for the variable W.
+    The gradient at W can be given precomputed with grad (it is overwritten). GtG and GtX are passed to `gradW`."""
 
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
-    grad = gradW(X, G, W, H, log_shift=log_shift, safe=safe, l2=l2)
+    if grad is None:
+        grad = gradW(X, G, W, H, log_shift=log_shift, safe=safe, l2=l2, GtG=GtG, GtX=GtX)
 
-    # gradient step
-    new_W = W - 1/gamma * grad
+    # gradient step, computed in place in the gradient array
+    grad *= -1/gamma
+    new_W = np.add(W, grad, out=grad)
     # projection
-    new_W = np.maximum(new_W, log_shift)
+    new_W = np.maximum(new_W, log_shift, out=new_W)
 
     if fixed_W is not None: 
-        new_W[fixed_W >= 0] = fixed_W[fixed_W >=0]
+        compile_fixed(fixed_W).apply(new_W)
 
     if simplex_W : 
         raise NotImplementedError("Simplex constraint not implemented for W using the projected gradient method")
     return new_W
 
-def proj_grad_step_h(X, G, W, H, gamma, simplex_H=True, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, fixed_H = None):
-    """Projected gradient step for the variable H."""
+def proj_grad_step_h(X, G, W, H, gamma, simplex_H=True, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, fixed_H = None, grad=None, GtG=None, GtX=None):
+    """Projected gradient step for the variable H.
+    The gradient at H can be given precomputed with grad (it is overwritten). GtG and GtX are passed to `gradH`."""
 
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
     # gradient step
-    grad = gradH(X, G, W, H, log_shift=log_shift, safe=safe, mu=mu, epsilon_reg=epsilon_reg, lambda_L=lambda_L, L=L, l2=l2)
-    new_H = H - 1/gamma * grad
+    if grad is None:
+        grad = gradH(X, G, W, H, log_shift=log_shift, safe=safe, mu=mu, epsilon_reg=epsilon_reg, lambda_L=lambda_L, L=L, l2=l2, GtG=GtG, GtX=GtX)
+    # gradient step, computed in place in the gradient array
+    grad *= -1/gamma
+    new_H = np.add(H, grad, out=grad)
 
-    # Dichotomy
+    # Exact shift of the projection on the simplex
     if simplex_H:
-        nu = dichotomy_simplex_projected_gradient(new_H, log_shift=log_shift, tol=dicotomy_tol)
+        nu = simplex_projection_shift(new_H, log_shift=log_shift)
     else:
         nu = 0
 
     # projection
-    new_H = np.maximum(new_H + nu, log_shift)
+    new_H += nu
+    new_H = np.maximum(new_H, log_shift, out=new_H)
 
     if fixed_H is not None: 
-        new_H[fixed_H >= 0] = fixed_H[fixed_H >=0]
+        compile_fixed(fixed_H).apply(new_H)
     return new_H
 
-def estimate_Lipschitz_bound_w(log_shift, X, G, k):
+def l2_products(X, G):
+    """
+    Products of the data for the l2 loss: G.T @ G, G.T @ X and the squared norm of X (accumulated in float64).
+    They do not depend on W and H and can be computed once for all the iterations: the l2 updates (GtG and GtX 
+    parameters) and loss (see :func:`espm.measures.Frobenius_loss_products`) are then evaluated in O(m k p) operations, 
+    without n x p temporaries. With G=None (identity), G.T @ G is None and G.T @ X is X.
+    """
+    X_sq = np.sum(X.multiply(X), dtype=np.float64) if sparse.issparse(X) else np.sum(np.square(X), dtype=np.float64)
     if G is None:
-        G = np.eye(X.shape[0])
-    Wlim = np.ones([G.shape[1], k]) * log_shift
+        return None, X, X_sq
+    GtG = G.T @ G
+    if sparse.issparse(GtG):
+        GtG = GtG.toarray()
+    GtX = G.T @ X
+    if sparse.issparse(GtX):
+        GtX = GtX.toarray()
+    return GtG, np.asarray(GtX), X_sq
+
+def update_l2_products(products, X, G_old, G):
+    """
+    Products of `l2_products` for the matrix G, updated from the products computed with G_old by recomputing only the 
+    rows and columns of the columns of G that changed (e.g. the two bremsstrahlung columns replaced by 
+    `espm.models.EDXS.NMF_update`): O(c n p) operations for c changed columns instead of O(m n p). 
+    The arrays of products are updated in place. Returns None if G_old and G are not matrices of the same shape.
+    """
+    if G_old is None or G is None or G_old.shape != G.shape:
+        return None
+    GtG, GtX, X_sq = products
+    if sparse.issparse(G):
+        diff = sparse.csc_matrix(G - G_old)
+        diff.eliminate_zeros()
+        changed = np.flatnonzero(np.diff(diff.indptr))
+    else:
+        changed = np.flatnonzero(np.any(G != G_old, axis=0))
+    if len(changed) == 0:
+        return products
+    dense = lambda A : A.toarray() if sparse.issparse(A) else np.asarray(A)
+    G_c = G[:, changed]
+    GtX[changed] = dense(G_c.T @ X)
+    GtG_c = dense(G_c.T @ G)
+    GtG[changed, :] = GtG_c
+    GtG[:, changed] = GtG_c.T
+    return GtG, GtX, X_sq
+
+def hals_products(X, G):
+    """
+    Products of the data used by the HALS steps for the l2 loss: G.T @ G, G.T @ X (see `l2_products`) and the largest 
+    eigenvalue of G.T @ G. With G=None (identity), G.T @ G is None, G.T @ X is X and the eigenvalue is 1.
+    """
+    GtG, GtX, _ = l2_products(X, G)
+    return GtG, GtX, (1.0 if GtG is None else np.linalg.eigvalsh(GtG)[-1])
+
+def hals_step_h(GtX, GtG, W, H, simplex_H=False, mu=0, epsilon_reg=1, lambda_L=0, L=None, sigmaL=sigmaL, log_shift=log_shift, fixed_H=None, HL=None, WtGtX=None, WtGtGW=None, n_sweeps_simplex=5, dct_shape=None):
+    """
+    HALS (hierarchical alternating least squares) step in H for the l2 loss 0.5 ||X - GWH||^2, from the products 
+    GtX = G.T @ X and GtG = G.T @ G of `hals_products` (GtG=None stands for the identity).
+
+    The Laplacian term is majorized at H as in `smooth_l2_surrogate` (with sigmaL) and the log regularization by its 
+    tangent at H, so that the step minimizes a quadratic function of H. Its rows are minimized exactly one after the other. 
+    With simplex_H, the rows are coupled by the constraint and n_sweeps_simplex accelerated projected gradient 
+    iterations are taken instead, with the inverse of the largest eigenvalue of the quadratic as step size. The products W.T @ GtX and W.T @ GtG @ W can be 
+    given precomputed with WtGtX and WtGtGW, and H @ L with HL.
+
+    If the shape of the maps dct_shape is given (L being `create_laplacian_matrix(*dct_shape)`), the quadratic with the 
+    exact Laplacian term is also minimized with `laplacian_quadratic_solve` and projected on the constraints. This 
+    solution is returned if it decreases the loss more than the majorized step.
+    """
+    fixed_H = compile_fixed(fixed_H)
+    if not(lambda_L==0) and HL is None:
+        if L is None:
+            raise ValueError("Please provide the laplacian")
+        HL = H@L
+    if WtGtGW is None:
+        WtGtGW = W.T @ G_matmul(GtG, W)
+    if WtGtX is None:
+        WtGtX = W.T @ GtX
+
+    if dct_shape is not None and not(lambda_L==0):
+        B = np.array(WtGtX, dtype=H.dtype)
+        if not(np.isscalar(mu) and mu==0):
+            mu_ = np.expand_dims(np.asarray(mu, dtype=H.dtype), axis=1) if len(np.shape(mu))==1 else mu
+            B -= mu_ / (H + epsilon_reg)
+        H_dct = laplacian_quadratic_solve(WtGtGW, B, lambda_L, dct_shape, simplex=simplex_H).astype(H.dtype, copy=False)
+        if simplex_H:
+            H_dct += simplex_projection_shift(H_dct, log_shift=log_shift)
+        H_dct = np.maximum(H_dct, log_shift, out=H_dct)
+        if fixed_H is not None: 
+            fixed_H.apply(H_dct)
+        H_maj = hals_step_h(GtX, GtG, W, H, simplex_H=simplex_H, mu=mu, epsilon_reg=epsilon_reg, lambda_L=lambda_L, L=L, sigmaL=sigmaL, 
+                            log_shift=log_shift, fixed_H=fixed_H, HL=HL, WtGtX=WtGtX, WtGtGW=WtGtGW, n_sweeps_simplex=n_sweeps_simplex)
+        if L is None:
+            return H_maj
+        def quadratic(M):
+            return 0.5 * np.sum(M * (WtGtGW @ M)) - np.sum(B * M) + 0.5 * lambda_L * np.sum(M * (M @ L))
+        return H_dct if quadratic(H_dct) < quadratic(H_maj) else H_maj
+
+    # Quadratic 0.5 tr(H.T A H) - tr(B.T H) majorizing the loss at H
+    A = WtGtGW
+    B = np.array(WtGtX, dtype=H.dtype)
+    if not(lambda_L==0):
+        A = A + lambda_L * sigmaL * np.eye(A.shape[0], dtype=A.dtype)
+        B -= lambda_L * (HL - sigmaL * H)
+    if not(np.isscalar(mu) and mu==0):
+        if len(np.shape(mu))==1:
+            mu = np.expand_dims(np.asarray(mu, dtype=H.dtype), axis=1)
+        B -= mu / (H + epsilon_reg)
+
+    new_H = H.copy()
+    if simplex_H:
+        # Accelerated projected gradient iterations, each of them costs as much as a sweep over the rows
+        def quadratic(M):
+            return 0.5 * np.sum(M * (A @ M)) - np.sum(B * M)
+        step = 1 / np.linalg.eigvalsh(A)[-1]
+        Y = new_H
+        t = 1
+        for it in range(n_sweeps_simplex):
+            prev_H = new_H
+            new_H = Y - step * (A @ Y - B)
+            new_H += simplex_projection_shift(new_H, log_shift=log_shift)
+            new_H = np.maximum(new_H, log_shift, out=new_H)
+            if fixed_H is not None: 
+                fixed_H.apply(new_H)
+            if it == 0:
+                first_H = new_H
+            t_next = (1 + np.sqrt(1 + 4 * t**2)) / 2
+            Y = new_H + (t - 1) / t_next * (new_H - prev_H)
+            t = t_next
+        # The accelerated iterations are not monotone, the first (projected gradient) one is
+        if quadratic(new_H) > quadratic(first_H):
+            return first_H
+        return new_H
+
+    for i in range(new_H.shape[0]):
+        if A[i, i] <= 0:
+            continue
+        h = new_H[i]
+        h += (B[i] - A[i] @ new_H) / A[i, i]
+        np.maximum(h, log_shift, out=h)
+        if fixed_H is not None:
+            mask = fixed_H.mask[i]
+            h[mask] = fixed_H.matrix[i, mask]
+    return new_H
+
+def laplacian_eigenvalues(shape_2d):
+    """
+    Eigenvalues of the Laplacian of `espm.utils.LaplacianOperator(shape_2d)` (for a map, the one of 
+    `create_laplacian_matrix(*shape_2d)`: 4 neighbours, free boundaries), as an array of shape shape_2d. 
+    The eigenvectors are the ones of the DCT (scipy.fft.dctn with norm="ortho").
+    """
+    eigenvalues = np.zeros(tuple(shape_2d))
+    for axis, n in enumerate(shape_2d):
+        dims = [1] * len(shape_2d)
+        dims[axis] = n
+        eigenvalues = eigenvalues + (2 - 2*np.cos(np.pi*np.arange(n)/n)).reshape(dims)
+    return eigenvalues
+
+def laplacian_quadratic_solve(A, B, lambda_L, shape_2d, simplex=False):
+    """
+    Minimizer of 0.5 tr(H.T A H) - tr(B.T H) + lambda_L / 2 tr(H L H.T), without the positivity constraint, 
+    where L is the Laplacian of `espm.utils.LaplacianOperator(shape_2d)` and A is a symmetric positive definite k x k matrix. 
+    With simplex, the columns of H are constrained to sum to 1.
+
+    The DCT over the image axes diagonalizes L, so that the optimality conditions A H + lambda_L H L = B (- 1 nu.T for the simplex) are 
+    decoupled over the frequencies. The solution costs two DCTs of k maps, i.e. O(k p log p), for any lambda_L.
+    """
+    k = A.shape[0]
+    shape = (k,) + tuple(shape_2d)
+    axes = tuple(range(1, len(shape)))
+    s, V = np.linalg.eigh(A)
+    inv = 1 / np.maximum(s[:, np.newaxis] + lambda_L * laplacian_eigenvalues(shape_2d).reshape(1, -1), np.finfo(np.float64).tiny)
+    # Coordinates in the eigenvectors of A and in the DCT basis
+    Y = V.T @ dctn(np.reshape(B, shape), axes=axes, norm="ortho").reshape(k, -1)
+    if simplex:
+        # Multipliers of the constraints, the DCT of the constant map is zero except at the frequency 0
+        v = (V.T @ np.ones(k))[:, np.newaxis]
+        ones_hat = np.zeros(Y.shape[1])
+        ones_hat[0] = np.sqrt(Y.shape[1])
+        nu = (np.sum(v * inv * Y, axis=0) - ones_hat) / np.sum(v**2 * inv, axis=0)
+        Y -= v * nu
+    Y *= inv
+    return idctn(np.reshape(V @ Y, shape), axes=axes, norm="ortho").reshape(k, -1)
+
+def hals_step_w(GtX, GtG, W, H, simplex_W=False, log_shift=log_shift, fixed_W=None, physics_model=None, lipschitz_G=1.0, simplex_indices=None):
+    """
+    HALS step in W for the l2 loss 0.5 ||X - GWH||^2, from the products of `hals_products` (GtG=None stands for the identity).
+
+    The columns of W are updated one after the other. With G the identity, each column is minimized exactly. Otherwise, 
+    G.T @ G is majorized by lipschitz_G times the identity (its largest eigenvalue), i.e. a projected gradient step is 
+    taken on the column. With simplex_W, the columns (the rows given by physics_model.NMF_simplex() if a physics model is 
+    given, or simplex_indices) are projected on the simplex.
+    """
+    fixed_W = compile_fixed(fixed_W)
+    HHt = H @ H.T
+    GtXHt = np.asarray(GtX @ H.T)
+    indices = simplex_rows(physics_model, simplex_indices) if simplex_W else slice(None)
+
+    new_W = W.copy()
+    for i in range(new_W.shape[1]):
+        if HHt[i, i] <= 0:
+            continue
+        grad = G_matmul(GtG, new_W @ HHt[:, i]) - GtXHt[:, i]
+        w = new_W[:, i] - grad / (lipschitz_G * HHt[i, i])
+        if simplex_W:
+            w[indices] += simplex_projection_shift(w[indices, np.newaxis], log_shift=log_shift)
+        w = np.maximum(w, log_shift, out=w)
+        if fixed_W is not None:
+            mask = fixed_W.mask[:, i]
+            w[mask] = fixed_W.matrix[mask, i]
+        new_W[:, i] = w
+    return new_W
+
+def estimate_Lipschitz_bound_w(log_shift, X, G, k):
+    m = X.shape[0] if G is None else G.shape[1]
+    Wlim = np.ones([m, k]) * log_shift
     Hlim = np.ones([k, X.shape[1]]) * log_shift
-    D = G @ Wlim
+    D = G_matmul(G, Wlim)
     DH = D @ Hlim
-    gamma = np.max((np.sum(Hlim,axis=0, keepdims=True) * X/(DH**2))@ Hlim.T)
+    if sparse.issparse(X):
+        gamma = np.max(X.multiply(np.sum(Hlim,axis=0, keepdims=True)/(DH**2)) @ Hlim.T)
+    else:
+        gamma = np.max((np.sum(Hlim,axis=0, keepdims=True) * X/(DH**2))@ Hlim.T)
     return gamma
 
 def estimate_Lipschitz_bound_h(log_shift, X, G, k, lambda_L=0, mu=0, epsilon_reg=1):
-    if G is None:
-        G = np.eye(X.shape[0])
-    Wlim = np.ones([G.shape[1], k]) * log_shift
+    m = X.shape[0] if G is None else G.shape[1]
+    Wlim = np.ones([m, k]) * log_shift
     Hlim = np.ones([k, X.shape[1]]) * log_shift
-    D = G @ Wlim
+    D = G_matmul(G, Wlim)
     DH = D @ Hlim
     
-    gamma = np.max(D.T @ (np.sum(D,axis=1, keepdims=True) * X/(DH**2)) ) + 2*lambda_L+mu*epsilon_reg
+    if sparse.issparse(X):
+        gamma = np.max(D.T @ X.multiply(np.sum(D,axis=1, keepdims=True)/(DH**2)) ) + 2*lambda_L+mu*epsilon_reg
+    else:
+        gamma = np.max(D.T @ (np.sum(D,axis=1, keepdims=True) * X/(DH**2)) ) + 2*lambda_L+mu*epsilon_reg
+
+    return gamma
 
-    return gamma
\ No newline at end of file
+def _kl_hessian_weights(X, D, H, log_shift=log_shift, l2=False):
+    """Weights X / (DH)**2 of the Hessian of the KL loss (only at the stored entries of a sparse X), ones for the l2 loss."""
+    if l2:
+        return np.ones((D.shape[0], H.shape[1]))
+    DH = np.maximum(D @ H, log_shift)
+    if sparse.issparse(X):
+        return X.multiply(1 / DH**2).tocsr()
+    return X / DH**2
+
+def power_iteration_lipschitz_h(X, G, W, H, log_shift=log_shift, lambda_L=0, mu=0, epsilon_reg=1, l2=False, n_iter=10, random_state=None, GtG=None):
+    """
+    Estimate of the Lipschitz constant of the gradient in H (see `gradH`) at the point (W, H).
+
+    The Hessian of the KL loss in H is block diagonal, with one k x k block D.T @ diag(x_j / (D h_j)**2) @ D for every 
+    pixel j (D = G @ W), or D.T @ D for the l2 loss. n_iter power iterations are run on all the blocks at the same time and the largest eigenvalue 
+    is returned, plus the same bounds of the regularization terms as `estimate_Lipschitz_bound_h`. Contrary to the 
+    latter, the estimate is local: it is much tighter but it is not an upper bound.
+    For the l2 loss, if G.T @ G is given with GtG (or G is None), the largest eigenvalue of the k x k matrix 
+    W.T @ G.T @ G @ W is computed exactly instead.
+    """
+    if l2 and (GtG is not None or G is None):
+        return np.linalg.eigvalsh(W.T @ G_matmul(GtG, W))[-1] + 2*lambda_L + mu*epsilon_reg
+    rng = check_random_state(random_state)
+    D = G_matmul(G, W)
+    weights = _kl_hessian_weights(X, D, H, log_shift=log_shift, l2=l2)
+    V = rng.rand(*H.shape)
+    for _ in range(n_iter):
+        V /= np.linalg.norm(V, axis=0, keepdims=True)
+        if sparse.issparse(weights):
+            V = np.asarray(weights.multiply(D @ V).T @ D).T
+        else:
+            V = D.T @ (weights * (D @ V))
+    return np.max(np.linalg.norm(V, axis=0)) + 2*lambda_L + mu*epsilon_reg
+
+def power_iteration_lipschitz_w(X, G, W, H, log_shift=log_shift, l2=False, n_iter=10, random_state=None, GtG=None):
+    """
+    Estimate of the Lipschitz constant of the gradient of the loss in W (see `gradW`) at the point (W, H).
+
+    n_iter power iterations are run with the Hessian-vector products 
+    V -> G.T @ ((X / (GWH)**2) * (G @ V @ H)) @ H.T (without the weights for the l2 loss). As for `power_iteration_lipschitz_h`, the estimate is local.
+    For the l2 loss, if G.T @ G is given with GtG (or G is None), the constant 2 * |G.T @ G| * |H @ H.T| is computed exactly.
+    """
+    if l2 and (GtG is not None or G is None):
+        lipschitz_G = 1.0 if GtG is None else np.linalg.eigvalsh(GtG)[-1]
+        return 2 * lipschitz_G * np.linalg.eigvalsh(H @ H.T)[-1]
+    rng = check_random_state(random_state)
+    D = G_matmul(G, W)
+    weights = _kl_hessian_weights(X, D, H, log_shift=log_shift, l2=l2)
+    V = rng.rand(*W.shape)
+    for _ in range(n_iter):
+        V /= np.linalg.norm(V)
+        GVH = matmul_chain(G, V, H)
+        if sparse.issparse(weights):
+            V = matmul_chain(None if G is None else G.T, weights.multiply(GVH), H.T)
+        else:
+            V = matmul_chain(None if G is None else G.T, weights * GVH, H.T)
+    # The gradient of the l2 loss in W has a factor 2 (see `gradW`)
+    return (2 if l2 else 1) * np.linalg.norm(V)
\ No newline at end of file
@@ -9,6 +9,8 @@ from espm.conf import log_shift
 import warnings as w
 from itertools import permutations
 from sklearn.metrics import r2_score
+from scipy.sparse import issparse
+from espm.utils import sparse_product_values
 
 def spectral_angle(v1, v2):
     r"""Spectral angle
@@ -379,10 +381,49 @@ def Frobenius_loss(X, W, H, average=False):
 
     DH = W @ H
 
+    # The reductions are accumulated in float64, also when the matrices are float32
     if average:
-        return np.mean((DH - X)**2)
+        return np.mean((DH - X)**2, dtype=np.float64)
     else:
-        return np.sum((DH - X)**2)
+        return np.sum((DH - X)**2, dtype=np.float64)
+
+def Frobenius_loss_products(GtG, GtX, X_sq, W, H):
+    r"""Frobenius loss of X - GWH from the products G.T @ G, G.T @ X and the squared norm of X.
+
+    The loss is expanded as:
+
+    .. math::
+
+        \| X - GWH \|_F^2 = \| X \|_F^2 - 2 \langle W^T G^T X, H \rangle + \langle W^T G^T G W, H H^T \rangle
+
+    so that it is evaluated in O(m k p) operations without the n x p matrices X - GWH. The reductions are 
+    accumulated in float64. Since the terms cancel, the result is less accurate than `Frobenius_loss` 
+    when the fit is very close to the data.
+
+    :param np.array 2D GtG: m x m matrix G.T @ G, or None if G is the identity
+    :param np.array 2D GtX: m x p matrix G.T @ X
+    :param float X_sq: squared Frobenius norm of X
+    :param np.array 2D W: m x k matrix
+    :param np.array 2D H: k x p matrix
+
+    :returns: the answer
+
+    Examples
+    --------
+
+    >>> import numpy as np
+    >>> from espm.measures import Frobenius_loss_products
+    >>> X = np.array([[1, 1, -1], [2, 4, 5]])
+    >>> W = np.array([[1], [1]])
+    >>> H = np.array([[1, 2, 3]])
+    >>> float(Frobenius_loss_products(None, X, np.sum(X**2), W, H))
+    26.0
+
+    """
+    GGW = W if GtG is None else GtG @ W
+    cross = np.sum((W.T @ GtX) * H, dtype=np.float64)
+    quadratic = np.sum((W.T @ GGW) * (H @ H.T), dtype=np.float64)
+    return max(X_sq - 2*cross + quadratic, 0.0)
 
 def KLdiv(X, D, H, log_shift=log_shift, average=False):
     r"""Generalized KL (Kullback–Leibler) divergence
@@ -465,7 +506,11 @@ def KLdiv_loss(X, W, H, log_shift=log_shift, average=False):
     This does not contains all the term of the KL divergence, only the ones
     depending on W and H.
 
-    :param np.array 2D X: n x m matrix
+    If X is a scipy.sparse matrix, the log term is only evaluated at the stored entries of X 
+    and the linear term is computed in closed form from the column sums of W and the row sums of H. 
+    No n x m temporary is created in this case.
+
+    :param np.array 2D X: n x m matrix (np.array or scipy.sparse matrix)
     :param np.array 2D Y: n x m matrix
     :param float log_shift: small constant to ensure the KL divergence does 
         not explode (default value set in module :mod:`esppy.conf`)
@@ -492,15 +537,27 @@ def KLdiv_loss(X, W, H, log_shift=log_shift, average=False):
 
     W = np.maximum(W, log_shift)
     H = np.maximum(H, log_shift)
+
+    if issparse(X):
+        X = X.tocsr()
+        x_lin = np.sum(W, axis=0, dtype=np.float64) @ np.sum(H, axis=1, dtype=np.float64)
+        x_log = np.sum(np.maximum(X.data, log_shift) * np.log(sparse_product_values(X, W, H)), dtype=np.float64)
+        if average:
+            numel = X.shape[0] * X.shape[1]
+            x_lin = x_lin / numel
+            x_log = x_log / numel
+        return x_lin - x_log
+
     X = np.maximum(X, log_shift)
 
     Y = W @ H
+    # The reductions are accumulated in float64, also when the matrices are float32
     if average:
-        x_lin = np.mean(Y)
-        x_log = np.mean(X*np.log(Y))        
+        x_lin = np.mean(Y, dtype=np.float64)
+        x_log = np.mean(X*np.log(Y), dtype=np.float64)
     else:
-        x_lin = np.sum(Y)
-        x_log = np.sum(X*np.log(Y))
+        x_lin = np.sum(Y, dtype=np.float64)
+        x_log = np.sum(X*np.log(Y), dtype=np.float64)
     return x_lin - x_log
 
 def KL_loss_surrogate(X, W, H, Ht, log_shift=log_shift, average=False):
@@ -543,9 +600,9 @@ def log_reg(H, mu, epsilon=1, average=False):
     if not(np.isscalar(mu)):
         mu = np.expand_dims(mu, axis=1)
     if average:
-        return np.mean(mu* np.log(H+epsilon))        
+        return np.mean(mu* np.log(H+epsilon), dtype=np.float64)
     else:
-        return np.sum(mu* np.log(H+epsilon))
+        return np.sum(mu* np.log(H+epsilon), dtype=np.float64)
 
 def log_surrogate(H, Ht, mu, epsilon, average=False):
     r"""Surrogate loss for the log function."""
@@ -572,9 +629,9 @@ def trace_xtLx(L, x, average=False):
     :rtype: float
     """
     if average:
-        return np.mean(x * (L @ x))
+        return np.mean(x * (L @ x), dtype=np.float64)
     else:
-        return np.sum(x * (L @ x))
+        return np.sum(x * (L @ x), dtype=np.float64)
 
 def squared_distance(x, y=None):
     r""" Squared distance between two between all colon vectors matrices.
@@ -10,9 +10,10 @@ The :mod:`espm.models.edxs` module implements the creation of the G matrix that
 
 import numpy as np
 import re
+from scipy import sparse
 from espm.models import PhysicalModel
 from espm.models.EDXS_function import G_bremsstrahlung, continuum_xrays, gaussian, read_lines_db, read_compact_db, elts_dict_from_dict_list
-from espm.conf import DEFAULT_EDXS_PARAMS
+from espm.conf import DEFAULT_EDXS_PARAMS, sparse_G_tol
 from espm.utils import arg_helper, symbol_to_number_dict, symbol_to_number_list
 from espm.models.absorption_edxs import absorption_correction, det_efficiency, det_efficiency_from_curve, absorption_mass_thickness
 # Class to model the EDXS spectra. This is a temporary version since there are some design issues.
@@ -25,6 +26,7 @@ class EDXS(PhysicalModel):
         width_slope=0.01,
         width_intercept=0.065,
         custom_init = False,
+        sparse_G = False,
         **kwargs
     ):
         r"""
@@ -36,6 +38,7 @@ class EDXS(PhysicalModel):
         :e_scale: ev/channel calibration of the energy axis (float)
         :width_slope: The FWHM of the detector increases with energy which is modeled with an affine function. This is the slope of this affine function (float).
         :width_intercept: The FWHM of the detector increases with energy which is modeled with an affine function. This is the intercept of this affine function (float).
+        :sparse_G: If True, the G matrix is stored as a scipy.sparse.csc_matrix. The characteristic X-rays columns are truncated where they fall below sparse_G_tol times their maximum (bool).
         """
         super().__init__(*args,**kwargs)
         self.width_slope = width_slope
@@ -45,6 +48,7 @@ class EDXS(PhysicalModel):
         self.norm = 1.0
         self.model_elts = []
         self.custom_init = custom_init
+        self.sparse_G = sparse_G
 
     def __add_elts_G(self, reference_elt = {}, *, elements=[]):
         for elt in elements:
@@ -152,7 +156,7 @@ class EDXS(PhysicalModel):
         Returns
         -------
         g matrix :
-            :np.array 2D: matrix of the edx model. 
+            :np.array 2D: matrix of the edx model. If the model was created with sparse_G=True, it is a scipy.sparse.csc_matrix.
 
         Notes
         -----
@@ -198,9 +202,34 @@ class EDXS(PhysicalModel):
                 norms[0] = np.mean(norms[0])
             self.norm = norms
             self.G /= self.norm
+            if self.sparse_G : 
+                self.G = self.sparsify_G(self.G)
         else : 
             print("g_type has to be one of those : \"bremsstrahlung\", \"no_brstlg\" or \"identity\". G will be None, corresponding to \"identity\". ")
 
+    def sparsify_G(self, G) : 
+        r"""
+        Convert a dense G matrix to a scipy.sparse.csc_matrix.
+
+        Each characteristic X-ray peak is a gaussian that is negligible a few widths away from its energy. The entries of each column 
+        that are smaller than sparse_G_tol times the maximum of the column are dropped. The bremsstrahlung columns are dense and kept as is.
+
+        Parameters
+        ----------
+        G : 
+            :np.array 2D: dense G matrix of shape (e_size, n_G)
+        
+        Returns
+        -------
+        G : 
+            :scipy.sparse.csc_matrix: sparse G matrix of shape (e_size, n_G)
+        """
+        G = G.copy()
+        n_carac = G.shape[1] - 2 if self.bkgd_in_G else G.shape[1]
+        carac = G[:, :n_carac]
+        carac[carac < sparse_G_tol * np.max(carac, axis=0, keepdims=True)] = 0.0
+        return sparse.csc_matrix(G)
+
     def generate_phases(self, phases_parameters) : 
         r"""
         Generate a series of spectra from list of phase parameters. 
@@ -323,16 +352,18 @@ class EDXS(PhysicalModel):
     def NMF_initialize_W(self, D) :
         if self.G is None :
             raise ValueError('The G matrix is identity, the W matrix cannot be initialized. Please use a np.array for G in the ESpM-NMF instead of the model object')
+        # The initialization is done once, a sparse G can be densified here
+        G = self.G.toarray() if sparse.issparse(self.G) else self.G
         if self.bkgd_in_G and self.custom_init:
             idx = self.carac_X_span()
-            mask = np.ones(self.G.shape[0], bool)
+            mask = np.ones(G.shape[0], bool)
             mask[idx] = 0
-            Wbrem = (np.linalg.lstsq(self.G[mask,-2:],D[mask,:],rcond = None)[0]).clip(min = 0)
-            Wcarac = (np.linalg.lstsq(self.G[idx,:-2],D[idx,:] ,rcond = None)[0]).clip(min = 0)
+            Wbrem = (np.linalg.lstsq(G[mask,-2:],D[mask,:],rcond = None)[0]).clip(min = 0)
+            Wcarac = (np.linalg.lstsq(G[idx,:-2],D[idx,:] ,rcond = None)[0]).clip(min = 0)
             # filter = np.where(np.mean(self.G[:,:-2],axis=1)<(np.max(np.mean(self.G[:,:-2],axis=1))*0.001))[0]
             W = np.vstack((Wcarac,Wbrem))
         else :
-            W = (np.linalg.lstsq(self.G,D,rcond = None)[0]).clip(min = 0)
+            W = (np.linalg.lstsq(G,D,rcond = None)[0]).clip(min = 0)
 
         return W
         
@@ -363,8 +394,12 @@ class EDXS(PhysicalModel):
             return self.G
         else :
             new_brstlg = self.update_bremsstrahlung(W)
-            new_G = self.G.copy()
-            new_G[:,-2:] = new_brstlg/self.norm[0][-2:]
+            if sparse.issparse(self.G) : 
+                # Only the two bremsstrahlung columns are rebuilt, the characteristic X-rays columns are shared
+                new_G = sparse.hstack((self.G[:,:-2], sparse.csc_matrix(new_brstlg/self.norm[0][-2:])), format="csc")
+            else : 
+                new_G = self.G.copy()
+                new_G[:,-2:] = new_brstlg/self.norm[0][-2:]
             self.G = new_G
             return self.G
 
@@ -1,6 +1,7 @@
 from espm.models.absorption_edxs import det_efficiency, absorption_correction
 from espm.models.generate_EDXS_phases import generate_elts_dict
 import numpy as np
+from scipy import sparse
 import espm.models.EDXS_function as ef
 from espm.models import EDXS
 from espm.models.EDXS_function import lifshin_bremsstrahlung, lifshin_bremsstrahlung_b0, lifshin_bremsstrahlung_b1
@@ -152,6 +153,26 @@ def test_NMF_update () :
     with np.testing.assert_raises(AssertionError):
         np.testing.assert_array_equal(model.NMF_update(np.random.rand(6,10))[:,-2:], temp_G[:,-2:])
     
+def test_sparse_G () : 
+    elts_list = ["Na", "Sr", "Ge", "Nb"]
+    model = EDXS(**model_parameters)
+    model.generate_g_matr(g_type = "bremsstrahlung", elements = elts_list, elements_dict={})
+    model_s = EDXS(**model_parameters, sparse_G = True)
+    model_s.generate_g_matr(g_type = "bremsstrahlung", elements = elts_list, elements_dict={})
+
+    assert sparse.issparse(model_s.G)
+    assert model_s.G.nnz < np.prod(model_s.G.shape)
+    np.testing.assert_allclose(model_s.G.toarray(), model.G, atol=1e-7)
+
+    D = np.random.rand(1900,2)
+    np.testing.assert_allclose(model_s.NMF_initialize_W(D), model.NMF_initialize_W(D), rtol=1e-3, atol=1e-6)
+
+    W = np.random.rand(6,10)
+    G = model.NMF_update(W)
+    G_s = model_s.NMF_update(W)
+    assert sparse.issparse(G_s)
+    np.testing.assert_allclose(G_s.toarray(), G, atol=1e-7)
+
 def test_generate_g_matr () : 
     model1 = EDXS(**model_parameters)
     model2 = EDXS(**model_parameters)
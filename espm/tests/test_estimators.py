@@ -1,3 +1,6 @@
+import pytest
+import espm.estimators.base
+from scipy import sparse
 from sklearn.utils.estimator_checks import check_estimator
 from espm.estimators.surrogates import diff_surrogate, smooth_l2_surrogate, smooth_dgkl_surrogate
 from espm.estimators import SmoothNMF
@@ -6,8 +9,10 @@ import numpy as np
 from espm.models import EDXS
 from espm.weights import generate_weights
 from espm.datasets.base import generate_spim
-from espm.measures import trace_xtLx
+from espm.measures import trace_xtLx, find_min_angle
 from espm.utils import create_laplacian_matrix
+from espm.estimators.updates import l2_products
+from espm.conf import dicotomy_tol_max
 from espm.models.generate_EDXS_phases import generate_modular_phases
 from espm.datasets.base import generate_spim_sample
 
@@ -90,6 +95,24 @@ def gen_fixed_mat () :
 
     return fixed_W, fixed_H
 
+# Parameters of the small problems of the tests of the SmoothNMF options
+smooth_params = dict(n_components=3, lambda_L=1.0, shape_2d=(10, 10), simplex_H=True, simplex_W=False, random_state=0)
+
+def generate_simplex_sample(k=3, l=60, p=100):
+    """Poisson data of mean 10 * D @ H, with the columns of H on the simplex."""
+    np.random.seed(0)
+    D = np.random.rand(l, k)
+    H = np.random.dirichlet(np.ones(k), size=p).T
+    return np.random.poisson(10 * D @ H).astype(float)
+
+def fit_with_option(X, params, **option):
+    """Fit SmoothNMF to X with params, without and with the tested option."""
+    estim = SmoothNMF(**params)
+    estim.fit_transform(X)
+    estim_option = SmoothNMF(**params, **option)
+    estim_option.fit_transform(X)
+    return estim, estim_option
+
 
 def test_generate_one_sample():
     G, W, H, D, w, X, Xdot, N = generate_one_sample()
@@ -182,6 +205,8 @@ def test_surrogate_smooth_nmf():
             assert v4 >= v5
             d = diff_surrogate(A1, A2, L=L, algo="l2_surrogate")
             np.testing.assert_almost_equal(v4 - v5 , d)
+            d = diff_surrogate(A1, A2, L=L, algo="l2_surrogate", HtL=A1 @ L, HL=A2 @ L)
+            np.testing.assert_almost_equal(v4 - v5 , d)
             
 def test_surrogate_smooth_dgkl_nmf():
 
@@ -201,6 +226,8 @@ def test_surrogate_smooth_dgkl_nmf():
             assert v4 >= v5
             d = diff_surrogate(A1, A2, L=L, algo="log_surrogate")
             np.testing.assert_almost_equal(v4 - v5 , d)
+            d = diff_surrogate(A1, A2, L=L, algo="log_surrogate", HtL=A1 @ L, HL=A2 @ L)
+            np.testing.assert_almost_equal(v4 - v5 , d)
 
 
 
@@ -299,4 +326,498 @@ def test_normalization_factor () :
 #     # m, (G, P, A), loss  = run_experiment(spim,estimator,exp)
     
 #     values = np.array([list(e) for e in loss])
-#     np.testing.assert_allclose(KL(X, G@P @ A, average=True), values[-1,1])
\ No newline at end of file
+#     np.testing.assert_allclose(KL(X, G@P @ A, average=True), values[-1,1])
+def test_sparse_X():
+    np.random.seed(0)
+    k, l, p = 3, 60, 100
+    D = np.random.rand(l, k)
+    H = np.random.dirichlet(np.ones(k), size=p).T
+    X = np.random.poisson(0.1 * D @ H).astype(float)
+    Xs = sparse.csr_matrix(X)
+
+    for algo in ["log_surrogate", "l2_surrogate", "bmd"]:
+        params = dict(n_components=k, max_iter=20, tol=0, lambda_L=1.0, shape_2d=(10, 10), simplex_H=True, simplex_W=False, random_state=0, algo=algo)
+        estim = SmoothNMF(**params)
+        GW = estim.fit_transform(X)
+        estim_s = SmoothNMF(**params)
+        GW_s = estim_s.fit_transform(Xs)
+        np.testing.assert_allclose(GW, GW_s, rtol=1e-4, atol=1e-8)
+        np.testing.assert_allclose(estim.H_, estim_s.H_, rtol=1e-4, atol=1e-8)
+        np.testing.assert_allclose(estim.losses_, estim_s.losses_, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        SmoothNMF(n_components=k, max_iter=2, l2=True).fit_transform(Xs)
+
+def test_sparse_G():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    model = EDXS(**phases_dict["model_params"])
+    model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+    model_s = EDXS(**phases_dict["model_params"], sparse_G=True)
+    model_s.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+
+    params = dict(n_components=2, max_iter=20, tol=0, simplex_W=False, simplex_H=True, random_state=0, hspy_comp=False)
+    estimator = SmoothNMF(G=model, **params)
+    GW = estimator.fit_transform(X=X)
+    estimator_s = SmoothNMF(G=model_s, **params)
+    GW_s = estimator_s.fit_transform(X=X)
+    assert sparse.issparse(estimator_s.G_)
+    np.testing.assert_allclose(GW_s, GW, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(estimator_s.H_, estimator.H_, rtol=1e-4, atol=1e-6)
+
+def test_identity_G():
+    X = generate_simplex_sample()
+    l = X.shape[0]
+
+    for algo in ["log_surrogate", "l2_surrogate", "bmd"]:
+        estim, estim_eye = fit_with_option(X, dict(smooth_params, max_iter=20, tol=0, algo=algo), G=np.eye(l))
+        # No l x l identity matrix is built
+        assert estim.G_ is None
+        assert not any(isinstance(entry, np.ndarray) and entry.shape == (l, l) for entry in vars(estim).values())
+        np.testing.assert_allclose(estim.W_, estim_eye.W_, rtol=1e-6, atol=1e-10)
+        np.testing.assert_allclose(estim.H_, estim_eye.H_, rtol=1e-6, atol=1e-10)
+        np.testing.assert_allclose(estim.inverse_transform(estim.W_), estim_eye.inverse_transform(estim_eye.W_), rtol=1e-6, atol=1e-10)
+
+def test_float32():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    model = EDXS(**phases_dict["model_params"])
+    model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+
+    for algo in ["log_surrogate", "l2_surrogate", "bmd"]:
+        params = dict(G=model, n_components=2, max_iter=20, tol=0, lambda_L=1.0, shape_2d=(10, 20), simplex_W=True, simplex_H=False, random_state=0, algo=algo, hspy_comp=False)
+        estimator = SmoothNMF(**params)
+        GW = estimator.fit_transform(X=X)
+        estimator_32 = SmoothNMF(dtype=np.float32, **params)
+        GW_32 = estimator_32.fit_transform(X=X)
+
+        assert GW_32.dtype == np.float32
+        assert estimator_32.X_.dtype == np.float32
+        assert estimator_32.G_.dtype == np.float32
+        assert estimator_32.W_.dtype == np.float32
+        assert estimator_32.H_.dtype == np.float32
+        assert estimator_32.L_.dtype == np.float32
+        assert isinstance(estimator_32.losses_[-1], np.float64)
+        np.testing.assert_allclose(GW_32, GW, rtol=1e-2, atol=1e-4)
+        np.testing.assert_allclose(estimator_32.losses_, estimator.losses_, rtol=1e-3)
+
+def test_out_of_core(tmp_path):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    # The G matrix of the model is updated during the fit, each estimator needs its own model
+    def new_model():
+        model = EDXS(**phases_dict["model_params"])
+        model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+        return model
+    # A zero pixel and a zero channel exercise the filling of the blocks
+    X = X.copy()
+    X[:, 5] = 0
+    X[3, :] = 0
+
+    for hspy_comp in [False, True]:
+        Xm = np.memmap(tmp_path / "X_{}.dat".format(hspy_comp), dtype=np.float64, mode="w+", shape=X.T.shape if hspy_comp else X.shape)
+        Xm[:] = X.T if hspy_comp else X
+        Xm.flush()
+        Xm = np.memmap(tmp_path / "X_{}.dat".format(hspy_comp), dtype=np.float64, mode="r", shape=Xm.shape)
+
+        W0, H0 = np.random.rand(new_model().G.shape[1], 2), np.random.rand(2, X.shape[1])
+        params = dict(n_components=2, max_iter=10, tol=0, lambda_L=1.0, mu=0.1, shape_2d=(10, 20), simplex_W=True, normalize=True, hspy_comp=hspy_comp)
+        estimator = SmoothNMF(G=new_model(), **params)
+        out = estimator.fit_transform(X=X.T if hspy_comp else X, W=W0.copy(), H=H0.copy())
+        # Blocks of 8 columns, i.e. 25 blocks for 200 pixels
+        estimator_ooc = SmoothNMF(G=new_model(), memory_budget=4 * 8 * X.shape[0] * 8, **params)
+        out_ooc = estimator_ooc.fit_transform(X=Xm, W=W0.copy(), H=H0.copy())
+
+        assert estimator_ooc.block_size_ == 8
+        assert estimator_ooc.X_ is Xm
+        np.testing.assert_allclose(estimator_ooc.norm_factor_, estimator.norm_factor_)
+        np.testing.assert_allclose(out_ooc, out, rtol=1e-6, atol=1e-10)
+        np.testing.assert_allclose(estimator_ooc.W_, estimator.W_, rtol=1e-6, atol=1e-10)
+        np.testing.assert_allclose(estimator_ooc.losses_, estimator.losses_, rtol=1e-8)
+
+    # Fixed entries of H, compiled once per block of pixels
+    fixed_H = -np.ones((2, X.shape[1]))
+    fixed_H[0, :20], fixed_H[1, :20] = 0.7, 0.3
+    params = dict(n_components=2, max_iter=10, tol=0, simplex_W=True, fixed_H=fixed_H)
+    estimator = SmoothNMF(G=new_model(), **params)
+    estimator.fit_transform(X=X, W=W0.copy(), H=H0.copy())
+    estimator_ooc = SmoothNMF(G=new_model(), memory_budget=4 * 8 * X.shape[0] * 8, **params)
+    estimator_ooc.fit_transform(X=X, W=W0.copy(), H=H0.copy())
+    assert len(estimator_ooc.workspace_["fixed_H_blocks"]) == 25
+    np.testing.assert_array_equal(estimator_ooc.H_[:, :20], fixed_H[:, :20])
+    np.testing.assert_allclose(estimator_ooc.H_, estimator.H_, rtol=1e-6, atol=1e-10)
+
+    # Random initialization
+    estimator_ooc = SmoothNMF(G=new_model(), n_components=2, max_iter=5, tol=0, random_state=0, memory_budget=10**5, hspy_comp=True)
+    H_ooc = estimator_ooc.fit_transform(X=Xm)
+    assert H_ooc.shape == (X.shape[1], 2)
+    assert np.all(np.diff(estimator_ooc.losses_) <= 0)
+
+    with pytest.raises(AssertionError):
+        SmoothNMF(memory_budget=10**5, algo="projected_gradient")
+    with pytest.raises(ValueError):
+        SmoothNMF(memory_budget=10**5, l2=True).fit_transform(np.abs(X))
+
+def test_partial_fit():
+    np.random.seed(0)
+    k, l, p = 3, 60, 2000
+    D = np.random.rand(l, k)
+    H = np.random.dirichlet(0.1*np.ones(k), size=p).T
+    X = np.random.poisson(100 * D @ H).astype(float)
+    W0 = np.random.rand(l, k)
+
+    estim = SmoothNMF(n_components=k, max_iter=50, simplex_H=True, simplex_W=False, forget_factor=1.0)
+    for start in range(0, p, 50):
+        estim.partial_fit(X[:, start:start+50], W=W0)
+        assert estim.H_.shape == (k, 50)
+        np.testing.assert_allclose(np.sum(estim.H_, axis=0), 1, atol=1e-3)
+    assert estim.n_steps_ == 40
+    # Without forgetting, H_sum_ is the sum of all the H seen so far
+    np.testing.assert_allclose(estim.H_sum_.sum(), p, rtol=1e-3)
+
+    # A single sweep does better than 10 iterations over the full data
+    estim = SmoothNMF(n_components=k, max_iter=50, simplex_H=True, simplex_W=False, forget_factor=0.5)
+    for start in range(0, p, 50):
+        estim.partial_fit(X[:, start:start+50], W=W0)
+    estim_full = SmoothNMF(n_components=k, max_iter=10, tol=0, simplex_H=True, simplex_W=False)
+    estim_full.fit_transform(X, W=W0.copy())
+    assert np.mean(find_min_angle(D.T, estim.W_.T, unique=True)) < np.mean(find_min_angle(D.T, estim_full.W_.T, unique=True))
+
+    with pytest.raises(ValueError):
+        estim.partial_fit(X[:-1, :50])
+    with pytest.raises(ValueError):
+        SmoothNMF(n_components=k, lambda_L=1.0, shape_2d=(10, 5)).partial_fit(X[:, :50])
+
+def test_lazy_loss():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    def new_model():
+        model = EDXS(**phases_dict["model_params"])
+        model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+        return model
+
+    for G in [None, "model"]:
+        params = dict(n_components=2, max_iter=10, tol=0, lambda_L=1.0, mu=0.1, shape_2d=(10, 20), simplex_W=True, random_state=0)
+        estimator = SmoothNMF(G=new_model() if G else None, **params)
+        GW = estimator.fit_transform(X)
+        estimator_lazy = SmoothNMF(G=new_model() if G else None, lazy_loss=True, **params)
+        GW_lazy = estimator_lazy.fit_transform(X)
+
+        np.testing.assert_allclose(GW_lazy, GW)
+        np.testing.assert_allclose(estimator_lazy.reconstruction_err_, estimator.reconstruction_err_)
+        # Only the lazy mode computes the log term of the loss in the updates
+        assert "x_log" not in estimator.workspace_ and "x_log" in estimator_lazy.workspace_
+        # The losses are reported one iteration late
+        if G is None:
+            np.testing.assert_allclose(estimator_lazy.losses_[1:], estimator.losses_[:-1], rtol=1e-10)
+        else:
+            # The losses after an update of G are the ones of the same iterates with the new G
+            np.testing.assert_allclose(estimator_lazy.losses_[1:3], estimator.losses_[:2], rtol=1e-10)
+            np.testing.assert_allclose(estimator_lazy.losses_[4:6], estimator.losses_[3:5], rtol=1e-10)
+
+def count_loss_calls(estim):
+    """Replace the loss of estim by a wrapper counting its calls, appended to the returned list."""
+    n_calls = []
+    loss = estim.loss
+    def counted_loss(*args, **kwargs):
+        n_calls.append(1)
+        return loss(*args, **kwargs)
+    estim.loss = counted_loss
+    return n_calls
+
+def test_check_every():
+    X = generate_simplex_sample()
+
+    params = dict(smooth_params, max_iter=20, tol=0)
+    estim = SmoothNMF(**params)
+    n_calls = count_loss_calls(estim)
+    GW = estim.fit_transform(X)
+    estim_5 = SmoothNMF(check_every=5, **params)
+    n_calls_5 = count_loss_calls(estim_5)
+    GW_5 = estim_5.fit_transform(X)
+    np.testing.assert_allclose(GW_5, GW)
+    # The loss is only evaluated every 5 iterations (plus at the start and for reconstruction_err_)
+    assert len(n_calls) == 22 and len(n_calls_5) == 6
+    assert len(estim_5.losses_) == 4
+    np.testing.assert_allclose(estim_5.losses_, estim.losses_[4::5])
+    np.testing.assert_allclose(estim_5.rel_, estim.rel_[4::5])
+
+    # The relative change of H on a subset of the pixels is smaller than on all the pixels
+    estim_sub = SmoothNMF(check_every=5, check_subsample=30, **params)
+    GW_sub = estim_sub.fit_transform(X)
+    np.testing.assert_allclose(GW_sub, GW)
+    assert estim_sub.check_pixels_.shape == (30,)
+    assert np.all(np.array(estim_sub.rel_)[:, 1] <= np.array(estim_5.rel_)[:, 1] * (1 + 1e-12))
+
+    # With a physics model, the reference loss after an update of G is only evaluated for the last update before a check
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    def new_model():
+        model = EDXS(**phases_dict["model_params"])
+        model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+        return model
+    params = dict(n_components=2, max_iter=30, tol=0, simplex_W=True, random_state=0)
+    estim = SmoothNMF(G=new_model(), **params)
+    estim.fit_transform(X)
+    estim_10 = SmoothNMF(G=new_model(), check_every=10, **params)
+    n_calls_10 = count_loss_calls(estim_10)
+    estim_10.fit_transform(X)
+    np.testing.assert_allclose(estim_10.losses_, estim.losses_[9::10])
+    # At the start, 3 checks, the updates of G at the iterations 9, 18 and 27 and reconstruction_err_
+    assert len(n_calls_10) == 8
+
+def test_adaptive_dicotomy_tol():
+    X = generate_simplex_sample()
+    k, p = 3, X.shape[1]
+
+    params = dict(smooth_params, max_iter=200)
+    estim = SmoothNMF(**params)
+    estim.fit_transform(X)
+    # The multipliers of the last iteration are kept to warm start the next one
+    assert estim.workspace_["nu_H"].shape == (p,)
+
+    estim_adapt = SmoothNMF(adaptive_dicotomy_tol=True, **params)
+    tols = []
+    dicotomy_tol_it = estim_adapt._dicotomy_tol
+    def recorded_tol():
+        tols.append(dicotomy_tol_it())
+        return tols[-1]
+    estim_adapt._dicotomy_tol = recorded_tol
+    estim_adapt.fit_transform(X)
+    # The first iterations use the loosest tolerance, which is tightened as the fit converges
+    assert tols[0] == dicotomy_tol_max
+    assert tols[-1] < 1e-3
+    assert all(tol >= estim.dicotomy_tol for tol in tols)
+    np.testing.assert_allclose(np.sum(estim_adapt.H_, axis=0), 1, atol=tols[-1] * k)
+    np.testing.assert_allclose(estim_adapt.losses_[-1], estim.losses_[-1], rtol=1e-2)
+
+def test_acceleration():
+    X = generate_simplex_sample()
+
+    for algo in ["log_surrogate", "l2_surrogate"]:
+        params = dict(smooth_params, max_iter=40, tol=0, no_stop_criterion=True, lambda_L=10.0, algo=algo)
+        estim = SmoothNMF(**params)
+        estim.fit_transform(X)
+        estim_acc = SmoothNMF(acceleration=True, **params)
+        restarts = []
+        restart = estim_acc._restart
+        def recorded_restart():
+            restarts.append(restart())
+            return restarts[-1]
+        estim_acc._restart = recorded_restart
+        estim_acc.fit_transform(X)
+        # Some extrapolated steps increased the loss and were undone, reducing the extrapolation weight
+        assert any(restarts)
+        assert estim_acc.workspace_["beta_max"] < 1.0
+        # The restarts keep the loss non-increasing
+        assert np.all(np.diff(estim_acc.losses_) <= 1e-12)
+        assert estim_acc.losses_[-1] < estim.losses_[-1]
+        np.testing.assert_allclose(np.sum(estim_acc.H_, axis=0), 1, atol=1e-4)
+
+    with pytest.raises(AssertionError):
+        SmoothNMF(acceleration=True, lazy_loss=True)
+
+def test_inner_steps(monkeypatch):
+    X = generate_simplex_sample()
+    G = np.random.rand(X.shape[0], 5)
+
+    params = dict(smooth_params, max_iter=10, tol=0, no_stop_criterion=True)
+    estim = SmoothNMF(**params)
+    estim.fit_transform(X)
+    estim_inner = SmoothNMF(n_inner_H=3, n_inner_W=2, **params)
+    n_steps = {"H": 0, "W": 0}
+    update_H, update_W = estim_inner._update_H, estim_inner._update_W
+    def counted_update_H(*args, **kwargs):
+        n_steps["H"] += 1
+        return update_H(*args, **kwargs)
+    def counted_update_W(*args, **kwargs):
+        n_steps["W"] += 1
+        return update_W(*args, **kwargs)
+    estim_inner._update_H, estim_inner._update_W = counted_update_H, counted_update_W
+    estim_inner.fit_transform(X)
+    assert n_steps == {"H": 30, "W": 20}
+    assert np.all(np.diff(estim_inner.losses_) <= 1e-12)
+    assert estim_inner.losses_[-1] < estim.losses_[-1]
+
+    # The input H of the iteration is not overwritten by the inner steps
+    estim_lazy = SmoothNMF(n_inner_H=3, n_inner_W=2, lazy_loss=True, **params)
+    estim_lazy.fit_transform(X)
+    np.testing.assert_allclose(estim_lazy.losses_[1:], estim_inner.losses_[:-1])
+
+    # G @ W is computed once per W, shared by the steps in H and the loss: the inner steps do not add products
+    n_GW = []
+    G_matmul = espm.estimators.base.G_matmul
+    def counted_G_matmul(*args, **kwargs):
+        n_GW.append(1)
+        return G_matmul(*args, **kwargs)
+    monkeypatch.setattr(espm.estimators.base, "G_matmul", counted_G_matmul)
+    for n_inner_H in [1, 3]:
+        n_GW.clear()
+        SmoothNMF(G=G, n_components=3, max_iter=10, tol=0, no_stop_criterion=True, n_inner_H=n_inner_H, random_state=0).fit_transform(X)
+        assert len(n_GW) == 12
+
+def test_linesearch():
+    X = generate_simplex_sample()
+
+    # Number of additional loss evaluations per iteration and outside of the iterations
+    for algo, n_extra, n_start in [("log_surrogate", 0, 2), ("l2_surrogate", 0, 2), ("projected_gradient", 2, 3)]:
+        estim = SmoothNMF(**dict(smooth_params, max_iter=10, tol=0, no_stop_criterion=True, algo=algo, linesearch=True))
+        n_calls = count_loss_calls(estim)
+        estim.fit_transform(X)
+        # The line search reuses the products of the updates and the loss of the previous step: in surrogate mode, 
+        # only the losses of the fit loop are evaluated (one per iteration, one at the start and one at the end). 
+        # The projected gradient evaluates the losses after its steps in H and W, the ones before them are cached 
+        # (except before the first step).
+        assert len(n_calls) == (1 + n_extra) * estim.n_iter_ + n_start
+        if algo == "projected_gradient":
+            assert "linesearch_loss" in estim.workspace_
+        if algo != "projected_gradient":
+            assert np.all(np.diff(estim.losses_) <= 1e-12)
+
+def test_bb_steps():
+    X = generate_simplex_sample()
+
+    estim, estim_bb = fit_with_option(X, dict(smooth_params, max_iter=50, algo="projected_gradient"), bb_steps=True)
+    assert estim_bb.losses_[-1] < 0.9 * estim.losses_[-1]
+    # The step sizes are updated during the fit, the fixed ones are not
+    assert estim_bb.gamma_ != estim.gamma_
+    # Nonmonotone safeguard: the loss never exceeds the maximum of the 5 previous ones
+    losses = [np.inf] + estim_bb.losses_
+    assert all(losses[i] <= max(losses[max(0, i-5):i]) for i in range(1, len(losses)))
+    np.testing.assert_allclose(np.sum(estim_bb.H_, axis=0), 1, atol=1e-4)
+
+    # Inverse of the BB2 step: <y, y> / <s, y>, s and y being the changes of the variable and of its gradient
+    A, grad = np.random.rand(3, 4), np.random.rand(3, 4)
+    s, y = np.random.rand(3, 4), np.random.rand(3, 4)
+    estim_bb.workspace_["bb_test"] = (A - s, grad - y)
+    np.testing.assert_allclose(estim_bb._bb_gamma("bb_test", 0, A, grad), np.vdot(y, y) / np.vdot(s, y))
+    # The step is kept when the curvature is not positive
+    estim_bb.workspace_["bb_test"] = (A - s, grad + y)
+    assert estim_bb._bb_gamma("bb_test", 0, A, grad) == estim_bb.gamma_[0]
+
+    with pytest.raises(AssertionError):
+        SmoothNMF(bb_steps=True)
+    with pytest.raises(AssertionError):
+        SmoothNMF(bb_steps=True, algo="projected_gradient", linesearch=True, lambda_L=1.0)
+
+def test_hals():
+    np.random.seed(0)
+    k, l, p = 3, 60, 400
+    D = np.random.rand(l, k)
+    H = np.random.dirichlet(np.ones(k), size=p).T
+    X = np.abs(D @ H + 0.05 * np.random.randn(l, p))
+
+    for simplex_H in [False, True]:
+        params = dict(n_components=k, l2=True, max_iter=1000, tol=1e-6, simplex_H=simplex_H, simplex_W=False, random_state=0)
+        estim = SmoothNMF(**params)
+        estim.fit_transform(X)
+        estim_hals = SmoothNMF(algo="hals", **params)
+        estim_hals.fit_transform(X)
+        assert np.all(np.diff(estim_hals.losses_) <= 1e-12)
+        assert estim_hals.n_iter_ < estim.n_iter_ / 2
+        assert estim_hals.losses_[-1] < estim.losses_[-1] * 1.01
+        if simplex_H:
+            np.testing.assert_allclose(np.sum(estim_hals.H_, axis=0), 1)
+
+    # Laplacian and log regularizations, with G
+    G = np.random.rand(l, 10)
+    estim_hals = SmoothNMF(G=G, algo="hals", l2=True, n_components=k, max_iter=20, tol=0, no_stop_criterion=True, lambda_L=1.0, mu=0.1, shape_2d=(20, 20), simplex_H=True, simplex_W=False, random_state=0)
+    estim_hals.fit_transform(X)
+    assert np.all(np.diff(estim_hals.losses_) <= 1e-12)
+
+    with pytest.raises(AssertionError):
+        SmoothNMF(algo="hals")
+
+def test_l2_products_loss(monkeypatch):
+    np.random.seed(0)
+    k, l, m, p = 3, 60, 10, 200
+    G = np.random.rand(l, m)
+    X = np.abs(G @ np.random.rand(m, k) @ np.random.rand(k, p) + 0.05 * np.random.randn(l, p))
+    for algo in ["log_surrogate", "hals"]:
+        estim = SmoothNMF(G=G, algo=algo, l2=True, n_components=k, max_iter=20, tol=0, no_stop_criterion=True, simplex_W=False, random_state=0)
+        estim.fit_transform(X)
+        # The loss is evaluated from the cached G.T @ G, G.T @ X and squared norm of X
+        assert "l2_products" in estim.workspace_
+        expected = 0.5 * np.sum((X - G @ estim.W_ @ estim.H_)**2) / X.size
+        np.testing.assert_allclose(estim.loss(estim.W_, estim.H_), expected, rtol=1e-8)
+        np.testing.assert_allclose(estim.loss(estim.W_, estim.H_, X=X), expected, rtol=1e-8)
+        assert estim.losses_[-1] < estim.losses_[0]
+
+    # The products follow the updates of G by the EDXS model, which only change its bremsstrahlung columns
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    model = EDXS(**phases_dict["model_params"])
+    model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+    estim = SmoothNMF(G=model, l2=True, n_components=2, max_iter=7, tol=0, no_stop_criterion=True, simplex_W=True, random_state=0)
+    n_updates = []
+    update = espm.estimators.base.update_l2_products
+    def counted_update(*args):
+        n_updates.append(1)
+        return update(*args)
+    monkeypatch.setattr(espm.estimators.base, "update_l2_products", counted_update)
+    estim.fit_transform(X)
+    # G is updated after the iterations 3 and 6
+    assert len(n_updates) == 2
+    for A, B in zip(estim._l2_products(), l2_products(estim.X_, estim.G_)):
+        np.testing.assert_allclose(A, B, rtol=1e-10)
+
+def test_dct_laplacian():
+    np.random.seed(0)
+    k, l, nx = 3, 60, 20
+    D = np.random.rand(l, k)
+    H = np.random.dirichlet(np.ones(k), size=nx*nx).T
+    X = np.abs(D @ H + 0.1 * np.random.randn(l, nx*nx))
+
+    # With a strong regularization, the majorized step in H is very conservative
+    params = dict(n_components=k, l2=True, algo="hals", max_iter=30, tol=0, no_stop_criterion=True, lambda_L=100.0, shape_2d=(nx, nx), random_state=0)
+    estim = SmoothNMF(**params)
+    estim.fit_transform(X)
+    estim_dct = SmoothNMF(dct_laplacian=True, **params)
+    estim_dct.fit_transform(X)
+    assert np.all(np.diff(estim_dct.losses_) <= 1e-12)
+    assert estim_dct.losses_[-1] < 0.5 * estim.losses_[-1]
+
+    with pytest.raises(AssertionError):
+        SmoothNMF(dct_laplacian=True, l2=True, algo="hals")
+
+def test_chemical_mapping():
+    np.random.seed(0)
+    e, l, p = 4, 200, 150
+    # Peaked spectra of the elements and two smooth bremsstrahlung spectra
+    E = np.linspace(0, 1, l)[:, np.newaxis]
+    G_elts = np.exp(-(E - np.random.rand(e))**2 / (2 * 0.01**2))
+    G_elts[G_elts < 1e-3] = 0
+    G = np.hstack([G_elts, np.exp(-3*E), E*np.exp(-3*E)])
+    fixed_W = np.zeros((e + 2, e + 1))
+    fixed_W[np.arange(e), np.arange(e)] = -1
+    fixed_W[e:, e:] = -1
+    W = np.zeros((e + 2, e + 1))
+    W[np.arange(e), np.arange(e)] = 1
+    W[e:, e] = [1, 0.5]
+    X = np.random.poisson(G @ W @ (5 * np.random.rand(e + 1, p))).astype(float)
+
+    params = dict(n_components=e + 1, G=G, fixed_W=fixed_W, simplex_W=False, max_iter=100, tol=1e-6, no_stop_criterion=True, random_state=0)
+    estim = SmoothNMF(**params)
+    estim.fit_transform(X)
+    estim_carto = SmoothNMF(chemical_mapping=True, **params)
+    estim_carto.fit_transform(X)
+    assert np.all(np.diff(estim_carto.losses_) <= 1e-12)
+    np.testing.assert_allclose(estim_carto.losses_[-1], estim.losses_[-1], rtol=1e-3)
+    # The loss obtained from the cached G @ W @ H is the one of the final iterate
+    estim_carto.workspace_ = {}
+    np.testing.assert_allclose(estim_carto.loss(estim_carto.W_, estim_carto.H_), estim_carto.losses_[-1], rtol=1e-10)
+    np.testing.assert_array_equal(estim_carto.W_[fixed_W >= 0], 0)
+
+    # With a constraint on H, the scales of the elements are updated and the same loss is reached
+    for constraint in [dict(simplex_H=True), dict(mu=1.0), dict(lambda_L=5.0, shape_2d=(10, 15))]:
+        estim = SmoothNMF(**params, **constraint)
+        estim.fit_transform(X)
+        estim_carto = SmoothNMF(chemical_mapping=True, **params, **constraint)
+        estim_carto.fit_transform(X)
+        assert np.all(np.diff(estim_carto.losses_) <= 1e-12)
+        assert estim_carto.losses_[-1] < estim.losses_[-1] * 1.005
+
+    # Sparse G (as built by EDXS with sparse_G) with a constraint on H
+    estim_sparse = SmoothNMF(chemical_mapping=True, **dict(params, G=sparse.csc_matrix(G)), simplex_H=True)
+    estim_sparse.fit_transform(X)
+    estim_carto = SmoothNMF(chemical_mapping=True, **params, simplex_H=True)
+    estim_carto.fit_transform(X)
+    np.testing.assert_allclose(estim_sparse.losses_, estim_carto.losses_, rtol=1e-8)
+
+    fixed_W[0, 1] = -1
+    with pytest.raises(AssertionError):
+        SmoothNMF(chemical_mapping=True, **params)
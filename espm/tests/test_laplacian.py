@@ -1,5 +1,6 @@
 import numpy as np
-from espm.utils import create_laplacian_matrix
+from espm.utils import create_laplacian_matrix, LaplacianOperator
+from espm.estimators.updates import laplacian_eigenvalues
 from espm.conf import sigmaL
 from scipy.sparse.linalg import eigs
 
@@ -36,3 +37,32 @@ def test_sigma_L():
             Delta = create_laplacian_matrix(nx, ny)
             l2 = np.abs(eigs(Delta, k=1)[0][0])
             assert(l2 <= sigmaL)
+
+
+def test_laplacian_operator():
+    np.random.seed(0)
+    for nx in range(2, 5):
+        for ny in range(2, 8):
+            L = LaplacianOperator((nx, ny))
+            L2 = create_laplacian_matrix(nx, ny)
+            H = np.random.rand(3, nx*ny)
+            np.testing.assert_array_almost_equal(H @ L, H @ L2)
+            np.testing.assert_array_almost_equal(L @ H.T, L2 @ H.T)
+            np.testing.assert_array_almost_equal(L @ H[0], L2 @ H[0])
+            np.testing.assert_array_almost_equal(L.toarray(), L2.toarray())
+            assert L.max_eigenvalue <= sigmaL
+    # Line scans and volumes
+    for shape in [(7,), (3, 4, 5), (2, 1, 3)]:
+        L = LaplacianOperator(shape)
+        A = L.toarray()
+        np.testing.assert_array_almost_equal(A, A.T)
+        np.testing.assert_array_almost_equal(A.sum(axis=1), 0)
+        assert np.sum(A < 0) == np.sum(np.diag(A))
+        H = np.random.rand(3, A.shape[0])
+        np.testing.assert_array_almost_equal(H @ L, H @ A)
+        np.testing.assert_array_almost_equal(L @ H.T, A @ H.T)
+        eigenvalues = np.sort(laplacian_eigenvalues(shape).flatten())
+        np.testing.assert_array_almost_equal(eigenvalues, np.linalg.eigvalsh(A))
+        np.testing.assert_almost_equal(L.max_eigenvalue, eigenvalues[-1])
+    # The CSR matrix is cached
+    assert LaplacianOperator(shape).tocsr() is L.tocsr()
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 from numpy.lib.function_base import kaiser
 from espm.measures import mse, spectral_angle, KLdiv_loss, KLdiv, find_min_MSE, find_min_angle, trace_xtLx, Frobenius_loss, ordered_angles, ordered_mse
 from espm.measures import KL_loss_surrogate, log_reg, log_surrogate
@@ -278,3 +279,17 @@ def test_surrogates():
     np.testing.assert_allclose(
         log_surrogate(H0, H0, mu=mu, epsilon=epsilon),
         log_reg(H0, mu=mu, epsilon=epsilon))
+
+def test_KLdiv_loss_sparse():
+    np.random.seed(0)
+    l = 40
+    k = 4
+    p = 150
+
+    D = np.random.rand(l,k)
+    A = np.random.rand(k,p)
+    X = np.random.poisson(0.1 * D @ A).astype(float)
+    Xs = sparse.csr_matrix(X)
+
+    np.testing.assert_allclose(KLdiv_loss(X, D, A), KLdiv_loss(Xs, D, A))
+    np.testing.assert_allclose(KLdiv_loss(X, D, A, average=True), KLdiv_loss(Xs, D, A, average=True))
@@ -1,8 +1,10 @@
 import numpy as np
+from scipy import sparse
 
 from espm.estimators.updates import dichotomy_simplex, multiplicative_step_w, multiplicative_step_h, update_q, dichotomy_simplex_acc, multiplicative_step_hq
-from espm.estimators.updates import estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w, gradW, gradH, proj_grad_step_h, proj_grad_step_w
-from espm.measures import KLdiv_loss, log_reg, Frobenius_loss, trace_xtLx
+from espm.estimators.dicotomy import dicotomy, simplex_projection_shift, dichotomy_simplex_projected_gradient, simplex_root_small
+from espm.estimators.updates import estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w, gradW, gradH, proj_grad_step_h, proj_grad_step_w, kl_products, power_iteration_lipschitz_h, power_iteration_lipschitz_w, hals_products, hals_step_h, hals_step_w, laplacian_eigenvalues, laplacian_quadratic_solve, FixedEntries, compile_fixed, compile_indices, contraction_order, matmul_chain, l2_products, update_l2_products
+from espm.measures import KLdiv_loss, log_reg, Frobenius_loss, Frobenius_loss_products, trace_xtLx
 from espm.conf import log_shift, dicotomy_tol
 from espm.utils import create_laplacian_matrix
 import pytest
@@ -248,6 +250,125 @@ def test_dicotomy2():
         v = np.sum(np.maximum(num/(denum + sol), log_shift), axis=0)
         np.testing.assert_allclose(v, np.ones([v.shape[0]]), atol=1e-2)
 
+def test_dicotomy_newton():
+    rng = np.random.RandomState(0)
+    k, p = 5, 300
+    num = rng.rand(k, p)
+    denum = rng.rand(k, p)
+    a = np.max(num/2 - denum, axis=0)
+    b = len(num) * np.max(num, axis=0)/0.5 - np.min(denum, axis=0)
+    calls = []
+    def func(x, cols=slice(None)):
+        calls.append(len(x))
+        return np.sum(num[:, cols] / (x + denum[:, cols]), axis=0) - 1
+    def dfunc(x, cols=slice(None)):
+        return - np.sum(num[:, cols] / (x + denum[:, cols])**2, axis=0)
+
+    tol = 1e-10
+    sol_bisect = dicotomy(a.copy(), b.copy(), func, 200, tol)
+    n_bisect = sum(calls)
+    calls.clear()
+    sol_newton = dicotomy(a.copy(), b.copy(), func, 200, tol, dfunc=dfunc)
+    n_newton = sum(calls)
+    # Only the unconverged columns are evaluated
+    assert calls[-1] < p
+    np.testing.assert_allclose(func(sol_newton), 0, atol=tol)
+    np.testing.assert_allclose(sol_newton, sol_bisect, atol=1e-8)
+    assert n_newton < n_bisect / 2
+
+    # Scalar problem
+    sol = dicotomy(0., 2., lambda x, cols=None: 1 - x**2, 100, tol, dfunc=lambda x, cols=None: -2*x)
+    np.testing.assert_allclose(sol, 1, atol=tol)
+
+def test_dichotomy_warm_start():
+    rng = np.random.RandomState(0)
+    k, p = 5, 200
+    num = rng.rand(k, p)
+    denum = rng.rand(k, p)
+    tol = 1e-8
+    nu = dichotomy_simplex(num, denum, log_shift, tol=tol)
+    # Start from the solution of a slightly different problem
+    num2 = num * (1 + 0.01 * rng.rand(k, p))
+    sol = dichotomy_simplex(num2, denum, log_shift, tol=tol)
+    sol_warm = dichotomy_simplex(num2, denum, log_shift, tol=tol, nu0=nu)
+    np.testing.assert_allclose(np.sum(np.maximum(num2/(denum + sol_warm), log_shift), axis=0), 1, atol=tol)
+    np.testing.assert_allclose(sol_warm, sol, atol=1e-6)
+
+    # Invalid starting points are ignored
+    nu0 = nu.copy()
+    nu0[:10] = np.nan
+    nu0[10:20] = 1e10
+    sol_warm = dichotomy_simplex(num2, denum, log_shift, tol=tol, nu0=nu0)
+    np.testing.assert_allclose(sol_warm, sol, atol=1e-6)
+    sol_warm = dichotomy_simplex(num2, denum, log_shift, tol=tol, nu0=nu[:10])
+    np.testing.assert_allclose(sol_warm, sol, atol=1e-6)
+
+def test_simplex_projection_shift():
+    rng = np.random.RandomState(0)
+    for k in [2, 3, 6]:
+        a = rng.randn(k, 500)
+        log_shift = 0.1 / k
+        nu = simplex_projection_shift(a, log_shift=log_shift)
+        # The constraint is met up to the rounding errors
+        np.testing.assert_allclose(np.sum(np.maximum(a + nu, log_shift), axis=0), 1, atol=1e-12)
+        nu2 = dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=1e-10)
+        np.testing.assert_allclose(nu, nu2, atol=1e-9)
+
+    # One single entry
+    a = rng.randn(1, 10)
+    np.testing.assert_allclose(simplex_projection_shift(a, log_shift=0.5), 1 - a[0])
+
+    # The projection of a point of the simplex is itself
+    a = rng.dirichlet(np.ones(4), size=10).T
+    np.testing.assert_allclose(simplex_projection_shift(a, log_shift=0), 0, atol=1e-12)
+
+    assert simplex_projection_shift(rng.randn(3, 5).astype(np.float32)).dtype == np.float32
+    with pytest.raises(ValueError):
+        simplex_projection_shift(rng.randn(3, 5), log_shift=0.5)
+
+def test_simplex_root_small():
+    rng = np.random.RandomState(0)
+    for k in [2, 3]:
+        num = rng.rand(k, 1000) * rng.choice(np.logspace(-3, 3, 7), size=(k, 1000))
+        denum = rng.rand(k, 1000)
+        x = simplex_root_small(num, denum)
+        np.testing.assert_allclose(np.sum(num/(denum + x), axis=0), 1, atol=1e-6)
+        # The root is the one at the right of the singularities
+        assert np.all(x + np.min(denum, axis=0) > 0)
+        np.testing.assert_allclose(dichotomy_simplex(num, denum, 0, tol=1e-10), x, rtol=1e-6, atol=1e-8)
+
+        # Broadcasted denum
+        x = simplex_root_small(num, denum[:, :1])
+        np.testing.assert_allclose(np.sum(num/(denum[:, :1] + x), axis=0), 1, atol=1e-6)
+
+        # With clipped entries, the closed form is only a starting point
+        num[0, :100] = 0
+        log_shift = 0.05
+        sol = dichotomy_simplex(num, denum, log_shift, tol=1e-8)
+        np.testing.assert_allclose(np.sum(np.maximum(num/(denum + sol), log_shift), axis=0), 1, atol=1e-8)
+
+def test_power_iteration_lipschitz():
+    rng = np.random.RandomState(0)
+    n, m, k, p = 50, 20, 3, 200
+    G = rng.rand(n, m)
+    W = rng.rand(m, k)
+    H = rng.rand(k, p)
+    X = rng.poisson(G @ W @ H).astype(float)
+    D = G @ W
+    weights = X / (D @ H)**2
+    # Largest eigenvalues of the Hessians of the KL loss in H (one block per pixel) and in W
+    L_H = np.max(np.linalg.eigvalsh(np.einsum("ia,ij,ib->jab", D, weights, D)))
+    hess_W = sum(np.kron(G.T @ (weights[:, j:j+1] * G), np.outer(H[:, j], H[:, j])) for j in range(p))
+    L_W = np.max(np.linalg.eigvalsh(hess_W))
+    for Xi in [X, sparse.csr_matrix(X)]:
+        np.testing.assert_allclose(power_iteration_lipschitz_h(Xi, G, W, H, n_iter=50, random_state=0), L_H, rtol=1e-6)
+        np.testing.assert_allclose(power_iteration_lipschitz_w(Xi, G, W, H, n_iter=50, random_state=0), L_W, rtol=1e-6)
+        # Much tighter than the global bounds
+        assert power_iteration_lipschitz_w(Xi, G, W, H, random_state=0) < estimate_Lipschitz_bound_w(log_shift, X, G, k)
+    L_H_reg = power_iteration_lipschitz_h(X, G, W, H, lambda_L=2, mu=3, epsilon_reg=0.5, n_iter=50, random_state=0)
+    np.testing.assert_allclose(L_H_reg, L_H + 4 + 1.5, rtol=1e-6)
+    np.testing.assert_allclose(power_iteration_lipschitz_h(X, G, W, H, l2=True, n_iter=50, random_state=0), np.linalg.norm(D, 2)**2, rtol=1e-6)
+
 def test_dicotomy_aq():
     def func_abc(x, a, b, minus_c):
         n_p = len(b)
@@ -774,3 +895,307 @@ def test_proj_step_w():
             n_grad_old = n_grad
 
 
+
+def test_sparse_updates():
+    np.random.seed(0)
+    l = 40
+    k = 4
+    p = 150
+    c = 12
+
+    G = np.random.rand(l,c)
+    W = np.random.rand(c,k)
+    H = np.random.rand(k,p)
+    H = H/np.sum(H, axis=0, keepdims=True)
+    X = np.random.poisson(0.1 * G @ W @ H).astype(float)
+    Xs = sparse.csr_matrix(X)
+    assert Xs.nnz < X.size
+
+    for simplex_H in [False, True]:
+        Hd = multiplicative_step_h(X, G, W, H, simplex_H=simplex_H, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True)
+        Hs = multiplicative_step_h(Xs, G, W, H, simplex_H=simplex_H, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True)
+        np.testing.assert_allclose(Hd, Hs, rtol=1e-6)
+
+    for simplex_W in [False, True]:
+        Wd = multiplicative_step_w(X, G, W, H, simplex_W=simplex_W, log_shift=log_shift, safe=True)
+        Ws = multiplicative_step_w(Xs, G, W, H, simplex_W=simplex_W, log_shift=log_shift, safe=True)
+        np.testing.assert_allclose(Wd, Ws, rtol=1e-6)
+
+    np.testing.assert_allclose(gradH(X, G, W, H), gradH(Xs, G, W, H), rtol=1e-6)
+    np.testing.assert_allclose(gradW(X, G, W, H), gradW(Xs, G, W, H), rtol=1e-6)
+
+def test_identity_G():
+    np.random.seed(0)
+    l = 40
+    k = 4
+    p = 150
+
+    W = np.random.rand(l,k)
+    H = np.random.rand(k,p)
+    H = H/np.sum(H, axis=0, keepdims=True)
+    X = np.random.poisson(10 * W @ H).astype(float)
+    I = np.eye(l)
+
+    for l2 in [False, True]:
+        np.testing.assert_allclose(multiplicative_step_w(X, None, W, H, l2=l2), multiplicative_step_w(X, I, W, H, l2=l2))
+        np.testing.assert_allclose(multiplicative_step_h(X, None, W, H, simplex_H=True, l2=l2), multiplicative_step_h(X, I, W, H, simplex_H=True, l2=l2))
+        np.testing.assert_allclose(gradW(X, None, W, H, l2=l2), gradW(X, I, W, H, l2=l2))
+        np.testing.assert_allclose(gradH(X, None, W, H, l2=l2), gradH(X, I, W, H, l2=l2))
+    np.testing.assert_allclose(multiplicative_step_w(X, None, W, H, use_bregman=True), multiplicative_step_w(X, I, W, H, use_bregman=True))
+    np.testing.assert_allclose(multiplicative_step_hq(X, None, W, H), multiplicative_step_hq(X, I, W, H))
+    np.testing.assert_allclose(estimate_Lipschitz_bound_w(log_shift, X, None, k), estimate_Lipschitz_bound_w(log_shift, X, I, k))
+    np.testing.assert_allclose(estimate_Lipschitz_bound_h(log_shift, X, None, k), estimate_Lipschitz_bound_h(log_shift, X, I, k))
+
+def test_fixed_entries():
+    np.random.seed(0)
+    l = 30
+    k = 5
+    m = 6
+    p = 80
+
+    G = np.random.rand(l, m)
+    W = np.random.rand(m, k)
+    H = np.random.rand(k, p)
+    X = np.random.poisson(10 * G @ W @ H).astype(float)
+
+    # Chemical mapping pattern: only the diagonal of W is free
+    fixed_W = np.zeros((m, k))
+    fixed_W[np.arange(k), np.arange(k)] = -1
+    fixed_W[k:, :] = 0.5
+    compiled = compile_fixed(fixed_W)
+    assert compile_fixed(compiled) is compiled and compile_fixed(None) is None
+    assert compiled.n_free == k
+    np.testing.assert_array_equal(compiled.apply(W.copy())[fixed_W >= 0], fixed_W[fixed_W >= 0])
+    np.testing.assert_array_equal(compiled.apply(np.asfortranarray(W))[fixed_W >= 0], fixed_W[fixed_W >= 0])
+    filled = fixed_W.copy()
+    filled[np.arange(k), np.arange(k)] = np.arange(k)
+    np.testing.assert_array_equal(compiled.fill(np.arange(k)), filled)
+
+    # Only the free entries are computed, which gives the step with the fixed entries set afterwards
+    for G_ in [G, sparse.csr_matrix(G)]:
+        new_W = multiplicative_step_w(X, G_, W, H, fixed_W=compiled)
+        expected = multiplicative_step_w(X, G_, W, H)
+        expected[fixed_W >= 0] = fixed_W[fixed_W >= 0]
+        np.testing.assert_allclose(new_W, expected)
+    np.testing.assert_allclose(multiplicative_step_w(X, G, W, H, fixed_W=fixed_W), new_W)
+    np.testing.assert_allclose(multiplicative_step_w(X, G, W, H, fixed_W=compiled, l2=True), multiplicative_step_w(X, G, W, H, fixed_W=fixed_W, l2=True))
+
+    fixed_H = -np.ones((k, p))
+    fixed_H[0, :10] = 0
+    np.testing.assert_allclose(multiplicative_step_h(X, G, W, H, fixed_H=FixedEntries(fixed_H)), multiplicative_step_h(X, G, W, H, fixed_H=fixed_H))
+
+    assert compile_indices([2, 3, 4]) == slice(2, 5)
+    np.testing.assert_array_equal(compile_indices([0, 2, 3]), [0, 2, 3])
+    # The simplex rows can be given instead of the physics model
+    for indices in [[0, 1, 2, 3], [0, 2, 3]]:
+        rows = compile_indices(indices)
+        Ws = W.copy()
+        Ws[indices] /= np.sum(Ws[indices], axis=0, keepdims=True)
+        new_W = multiplicative_step_w(X, G, Ws, H, simplex_W=True, simplex_indices=rows)
+        np.testing.assert_allclose(np.sum(new_W[indices], axis=0), 1, rtol=1e-3)
+
+def test_matmul_chain():
+    np.random.seed(0)
+    n, m, k, p = 300, 20, 3, 500
+    G = np.random.rand(n, m)
+    X = np.random.rand(n, p)
+    H = np.random.rand(k, p)
+    # G.T @ X @ H.T: the n x p matrix is first multiplied by H.T
+    order, cost = contraction_order([(m, n, None), (n, p, None), (p, k, None)])
+    assert order == (0, (1, 2)) and cost == n*p*k + m*n*k
+    # With a wide G the other order is cheaper
+    assert contraction_order([(2, n, None), (n, p, None), (p, k, None)])[0] == ((0, 1), 2)
+    # The cost of a sparse operand is its number of stored entries
+    Xs = sparse.random(n, p, density=0.001, format="csr", random_state=0)
+    assert contraction_order([(m, n, None), (n, p, Xs.nnz), (p, k, None)]) == ((0, (1, 2)), Xs.nnz*k + m*n*k)
+    assert contraction_order([G.T, Xs, H.T]) == ((0, (1, 2)), Xs.nnz*k + m*n*k)
+
+    expected = G.T @ X @ H.T
+    np.testing.assert_allclose(matmul_chain(G.T, X, H.T), expected)
+    np.testing.assert_allclose(matmul_chain(None, G.T, None, X, H.T), expected)
+    np.testing.assert_allclose(matmul_chain(G.T, Xs, H.T), G.T @ Xs.toarray() @ H.T)
+    assert isinstance(matmul_chain(G.T, Xs, H.T), np.ndarray)
+    assert matmul_chain(None, X) is X
+
+def test_l2_products():
+    rng = np.random.RandomState(0)
+    n, m, k, p = 60, 8, 3, 100
+    G = rng.rand(n, m)
+    W = rng.rand(m, k)
+    H = rng.rand(k, p)
+    X = G @ W @ H + rng.rand(n, p)
+
+    for G_ in [G, None]:
+        W_ = W if G_ is not None else rng.rand(n, k)
+        GtG, GtX, X_sq = l2_products(X, G_)
+        np.testing.assert_allclose(Frobenius_loss_products(GtG, GtX, X_sq, W_, H), Frobenius_loss(X, W_ if G_ is None else G_ @ W_, H), rtol=1e-10)
+        np.testing.assert_allclose(gradW(X, G_, W_, H, l2=True, GtG=GtG, GtX=GtX), gradW(X, G_, W_, H, l2=True), rtol=1e-10)
+        np.testing.assert_allclose(gradH(X, G_, W_, H, l2=True, GtG=GtG, GtX=GtX), gradH(X, G_, W_, H, l2=True), rtol=1e-10)
+        for params in [dict(), dict(simplex_W=False)]:
+            np.testing.assert_allclose(multiplicative_step_w(X, G_, W_, H, l2=True, GtG=GtG, GtX=GtX, **params), multiplicative_step_w(X, G_, W_, H, l2=True, **params), rtol=1e-10)
+        for params in [dict(), dict(simplex_H=True)]:
+            np.testing.assert_allclose(multiplicative_step_h(X, G_, W_, H, l2=True, GtG=GtG, GtX=GtX, **params), multiplicative_step_h(X, G_, W_, H, l2=True, **params), rtol=1e-10)
+        np.testing.assert_allclose(power_iteration_lipschitz_h(X, G_, W_, H, l2=True, GtG=GtG, n_iter=200), power_iteration_lipschitz_h(X, G, W, H, l2=True, n_iter=200) if G_ is not None else np.linalg.eigvalsh(W_.T @ W_)[-1], rtol=1e-6)
+        np.testing.assert_allclose(power_iteration_lipschitz_w(X, G_, W_, H, l2=True, GtG=GtG, n_iter=200), power_iteration_lipschitz_w(X, G, W, H, l2=True, n_iter=200) if G_ is not None else 2*np.linalg.eigvalsh(H @ H.T)[-1], rtol=1e-6)
+
+    # Sparse data
+    Xs = sparse.random(n, p, density=0.1, format="csr", random_state=0)
+    GtG, GtX, X_sq = l2_products(Xs, G)
+    np.testing.assert_allclose(Frobenius_loss_products(GtG, GtX, X_sq, W, H), Frobenius_loss(Xs.toarray(), G @ W, H), rtol=1e-10)
+
+    # Update of the products when the last two columns of G change, as with EDXS.NMF_update
+    for G_old in [G, sparse.csc_matrix(G)]:
+        G_new = G.copy()
+        G_new[:, -2:] = rng.rand(n, 2)
+        if sparse.issparse(G_old):
+            G_new = sparse.hstack((G_old[:, :-2], sparse.csc_matrix(G_new[:, -2:])), format="csc")
+        products = l2_products(X, G_old)
+        GtX_old = products[1]
+        updated = update_l2_products(products, X, G_old, G_new)
+        assert updated[1] is GtX_old
+        for A, B in zip(updated, l2_products(X, G_new)):
+            np.testing.assert_allclose(A, B, rtol=1e-12)
+    assert update_l2_products(l2_products(X, G), X, G, G[:, :-1]) is None
+    assert update_l2_products(l2_products(X, None), X, None, None) is None
+
+def test_kl_products():
+    np.random.seed(0)
+    l, k, p = 40, 3, 157
+    D = np.random.rand(l,k)
+    H = np.random.rand(k,p)
+    X = np.random.poisson(D @ H).astype(float)
+    R = X / (D @ H)
+
+    for tile_size in [None, 1, 10, 1000]:
+        for n_jobs in [None, 1, 3, -1]:
+            DtR, RHt = kl_products(X, D, H, RHt=True, n_jobs=n_jobs, tile_size=tile_size)
+            np.testing.assert_allclose(DtR, D.T @ R, rtol=1e-12)
+            np.testing.assert_allclose(RHt, R @ H.T, rtol=1e-12)
+    # The log term of the loss is only computed when it is requested
+    workspace = {}
+    kl_products(X, D, H, workspace=workspace, tile_size=10)
+    assert "x_log" not in workspace
+    kl_products(X, D, H, workspace=workspace, tile_size=10, x_log=True)
+    np.testing.assert_allclose(workspace["x_log"], np.sum(X * np.log(D @ H)), rtol=1e-12)
+    DtR, RHt = kl_products(sparse.csr_matrix(X), D, H, DtR=False, RHt=True)
+    assert DtR is None
+    np.testing.assert_allclose(RHt, R @ H.T, rtol=1e-12)
+
+    G = np.random.rand(l, 5)
+    W = np.random.rand(5, k)
+    np.testing.assert_allclose(multiplicative_step_h(X, G, W, H, n_jobs=2), multiplicative_step_h(X, G, W, H), rtol=1e-12)
+    np.testing.assert_allclose(multiplicative_step_w(X, G, W, H, n_jobs=2), multiplicative_step_w(X, G, W, H), rtol=1e-12)
+
+def test_multiplicative_step_h_x_log(monkeypatch):
+    np.random.seed(0)
+    l, k, p, c = 40, 3, 100, 12
+    G = np.random.rand(l,c)
+    W = np.random.rand(c,k)
+    H = np.random.rand(k,p)
+    X = np.random.poisson(G @ W @ H).astype(float)
+    n_log = []
+    log = np.log
+    def counted_log(*args, **kwargs):
+        n_log.append(1)
+        return log(*args, **kwargs)
+    monkeypatch.setattr(np, "log", counted_log)
+
+    # Without x_log, the workspace is only used for the simplex multiplier and no log is computed
+    workspace = {}
+    multiplicative_step_h(X, G, W, H, simplex_H=True, workspace=workspace)
+    assert "x_log" not in workspace and "nu" in workspace
+    assert len(n_log) == 0
+    multiplicative_step_h(X, G, W, H, simplex_H=True, workspace=workspace, x_log=True)
+    assert len(n_log) > 0
+    np.testing.assert_allclose(workspace["x_log"], np.sum(X * log(G @ W @ H)), rtol=1e-12)
+
+def test_multiplicative_step_h_out():
+    np.random.seed(0)
+    l, k, p, c = 40, 3, 100, 12
+    G = np.random.rand(l,c)
+    W = np.random.rand(c,k)
+    H = np.random.rand(k,p)
+    X = np.random.poisson(G @ W @ H).astype(float)
+    L = create_laplacian_matrix(10, 10)
+
+    for params in [dict(), dict(mu=0.1, simplex_H=True), dict(lambda_L=1.0, L=L, mu=np.array([0.1, 0.2, 0.3]))]:
+        H_ref = multiplicative_step_h(X, G, W, H, **params)
+        out = np.empty_like(H)
+        H_out = multiplicative_step_h(X, G, W, H, out=out, **params)
+        assert H_out is out
+        np.testing.assert_allclose(H_out, H_ref, rtol=1e-12)
+
+def test_hals_steps():
+    rng = np.random.RandomState(0)
+    n, m, k, p = 40, 10, 3, 100
+    L = create_laplacian_matrix(10, 10)
+    for G in [None, rng.rand(n, m)]:
+        W = rng.rand(n if G is None else m, k)
+        H = rng.dirichlet(np.ones(k), size=p).T
+        GW = W if G is None else G @ W
+        X = np.abs(GW @ H + 0.1 * rng.randn(n, p))
+        GtG, GtX, lipschitz_G = hals_products(X, G)
+        if G is not None:
+            np.testing.assert_allclose(GtX, G.T @ X)
+            np.testing.assert_allclose(lipschitz_G, np.linalg.norm(G, 2)**2)
+            # Sparse data
+            GtG_s, GtX_s, _ = hals_products(sparse.csr_matrix(X), sparse.csr_matrix(G))
+            np.testing.assert_allclose(GtX_s, GtX)
+            np.testing.assert_allclose(GtG_s, GtG)
+
+        def loss(W, H, lambda_L=0, mu=0):
+            GW = W if G is None else G @ W
+            return 0.5 * np.sum((X - GW @ H)**2) + lambda_L / 2 * trace_xtLx(L, H.T) + mu * np.sum(np.log(H + 1))
+
+        W0 = rng.rand(*W.shape)
+        H0 = rng.dirichlet(np.ones(k), size=p).T
+        for simplex_H, simplex_W in [(False, False), (True, False), (False, True)]:
+            for lambda_L, mu in [(0, 0), (2, 0), (0, 0.5)]:
+                # The starting point is feasible
+                W0s = W0 / np.sum(W0, axis=0) if simplex_W else W0
+                W1 = hals_step_w(GtX, GtG, W0s, H0, simplex_W=simplex_W, lipschitz_G=lipschitz_G)
+                assert loss(W1, H0, lambda_L, mu) <= loss(W0s, H0, lambda_L, mu)
+                H1 = hals_step_h(GtX, GtG, W1, H0, simplex_H=simplex_H, mu=mu, lambda_L=lambda_L, L=L)
+                assert loss(W1, H1, lambda_L, mu) <= loss(W1, H0, lambda_L, mu)
+                assert np.all(W1 >= log_shift) and np.all(H1 >= log_shift)
+                if simplex_H:
+                    np.testing.assert_allclose(np.sum(H1, axis=0), 1)
+                if simplex_W:
+                    np.testing.assert_allclose(np.sum(W1, axis=0), 1)
+
+        # Without constraints and G, a sweep over the rows minimizes each row exactly
+        if G is None:
+            H1 = hals_step_h(GtX, GtG, W0, H0)
+            r = X - W0 @ H1 + np.outer(W0[:, -1], H1[-1])
+            np.testing.assert_allclose(H1[-1], np.maximum(W0[:, -1] @ r / (W0[:, -1] @ W0[:, -1]), log_shift))
+
+        # Fixed entries
+        fixed_H = -np.ones_like(H0)
+        fixed_H[0, :10] = 0.5
+        fixed_W = -np.ones_like(W0)
+        fixed_W[:3, 1] = 0.2
+        H1 = hals_step_h(GtX, GtG, W0, H0, fixed_H=fixed_H)
+        W1 = hals_step_w(GtX, GtG, W0, H1, fixed_W=fixed_W, lipschitz_G=lipschitz_G)
+        np.testing.assert_allclose(H1[0, :10], 0.5)
+        np.testing.assert_allclose(W1[:3, 1], 0.2)
+
+def test_laplacian_quadratic_solve():
+    rng = np.random.RandomState(0)
+    k, nx, ny = 3, 6, 5
+    p = nx * ny
+    L = create_laplacian_matrix(nx, ny).toarray().astype(float)
+    np.testing.assert_allclose(np.sort(laplacian_eigenvalues((nx, ny)).ravel()), np.linalg.eigvalsh(L), atol=1e-6)
+    M = rng.rand(10, k)
+    A = M.T @ M
+    B = rng.rand(k, p)
+    lambda_L = 2.5
+    K = np.kron(A, np.eye(p)) + lambda_L * np.kron(np.eye(k), L)
+    H = laplacian_quadratic_solve(A, B, lambda_L, (nx, ny))
+    np.testing.assert_allclose(H, np.linalg.solve(K, B.ravel()).reshape(k, p), atol=1e-10)
+
+    # Columns summing to 1 (KKT system)
+    C = np.kron(np.ones((1, k)), np.eye(p))
+    KKT = np.block([[K, C.T], [C, np.zeros((p, p))]])
+    sol = np.linalg.solve(KKT, np.concatenate([B.ravel(), np.ones(p)]))
+    H = laplacian_quadratic_solve(A, B, lambda_L, (nx, ny), simplex=True)
+    np.testing.assert_allclose(H, sol[:k*p].reshape(k, p), atol=1e-10)
@@ -1,12 +1,12 @@
 r"""Utils for the ESPM package"""
 
 import numpy as np
-from scipy.sparse import lil_matrix, block_diag
+from scipy.sparse import lil_matrix, block_diag, issparse, diags, identity, kron, csr_matrix
 from scipy.optimize import nnls
 from espm.conf import SYMBOLS_PERIODIC_TABLE, NUMBER_PERIODIC_TABLE
 import json
 from exspy.misc.material import atomic_to_weight, density_of_mixture
-from functools import wraps
+from functools import wraps, lru_cache
 import re
 
 _qtg_widgets = []
@@ -76,6 +76,131 @@ def create_laplacian_matrix(nx, ny=None):
     return blocks
 
 
+@lru_cache(maxsize=8)
+def _laplacian_csr(shape, dtype):
+    """Laplacian of `LaplacianOperator` as a CSR matrix, built from Kronecker products of 1D Laplacians (cached)."""
+    p = int(np.prod(shape))
+    L = csr_matrix((p, p), dtype=dtype)
+    for axis, n in enumerate(shape):
+        if n < 2:
+            continue
+        path = diags([-np.ones(n-1), np.array([1] + [2]*(n-2) + [1]), -np.ones(n-1)], [-1, 0, 1])
+        L = L + kron(kron(identity(int(np.prod(shape[:axis]))), path), identity(int(np.prod(shape[axis+1:]))))
+    L = csr_matrix(L, dtype=dtype)
+    # The cached matrix is shared
+    L.data.flags.writeable = False
+    return L
+
+class LaplacianOperator:
+    r"""
+    Matrix-free Laplacian of a regular grid of pixels.
+
+    The grid can be a line scan (shape of length 1), a map (length 2, the Laplacian is then the one of 
+    `create_laplacian_matrix`) or a volume (length 3). Each pixel is linked to its 2, 4 or 6 neighbours, with free 
+    boundaries. The products H @ L (H of shape (k, p)) and L @ x (x of shape (p,) or (p, k)) are computed with differences 
+    of the reshaped images (5-point stencil in 2D), without building a p x p matrix. The operator is symmetric.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the grid, the pixels being ordered as in np.reshape (C order).
+    dtype : data-type, default=np.float64
+        Data type of the operator (see `tocsr`).
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.utils import LaplacianOperator, create_laplacian_matrix
+    >>> L = LaplacianOperator((3, 4))
+    >>> H = np.random.rand(2, 12)
+    >>> np.allclose(H @ L, H @ create_laplacian_matrix(3, 4))
+    True
+    """
+    # numpy defers H @ L to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, shape, dtype=np.float64):
+        self.grid_shape = tuple(int(n) for n in shape)
+        p = int(np.prod(self.grid_shape))
+        self.shape = (p, p)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def T(self):
+        return self
+
+    @property
+    def max_eigenvalue(self):
+        """Largest eigenvalue of the Laplacian, lower than 4 times the number of dimensions of the grid."""
+        return sum(2 - 2*np.cos(np.pi*(n-1)/n) for n in self.grid_shape)
+
+    def apply(self, H):
+        """Laplacian of the images stored along the last axis of H."""
+        H = np.asarray(H)
+        lead = H.shape[:-1]
+        images = H.reshape(lead + self.grid_shape)
+        out = None
+        for axis in range(len(lead), images.ndim):
+            if images.shape[axis] < 2:
+                continue
+            low = [slice(None)] * images.ndim
+            low[axis] = slice(None, -1)
+            high = [slice(None)] * images.ndim
+            high[axis] = slice(1, None)
+            low, high = tuple(low), tuple(high)
+            d = images[high] - images[low]
+            if out is None:
+                # The first axis initializes the output, which saves a pass over zeros
+                out = np.empty(images.shape, dtype=np.result_type(d.dtype, self.dtype))
+                out[low] = -d
+                last = [slice(None)] * images.ndim
+                last[axis] = slice(-1, None)
+                out[tuple(last)] = 0
+            else:
+                out[low] -= d
+            out[high] += d
+        if out is None:
+            out = np.zeros(images.shape, dtype=np.result_type(H.dtype, self.dtype))
+        return out.reshape(H.shape)
+
+    def __rmatmul__(self, H):
+        return self.apply(H)
+
+    def __matmul__(self, x):
+        return self.apply(np.asarray(x).T).T
+
+    def tocsr(self):
+        """The Laplacian as a CSR matrix. It is cached by shape and dtype and must not be modified."""
+        return _laplacian_csr(self.grid_shape, self.dtype)
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+def sparse_product_values(X, D, H):
+    r"""Evaluate the product :math:`DH` only at the stored entries of the sparse matrix :math:`X`.
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix
+        Sparse n x p matrix giving the positions where the product is evaluated.
+    D : np.ndarray
+        n x k matrix
+    H : np.ndarray
+        k x p matrix
+
+    Returns
+    -------
+    values : np.ndarray
+        1D array of size X.nnz containing :math:`(DH)_{ij}` for every stored entry of the csr version of X, in the same order as `X.tocsr().data`.
+
+    """
+    if not(issparse(X)):
+        raise ValueError("X should be a scipy.sparse matrix")
+    X = X.tocsr()
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    return np.einsum("ij,ji->i", D[rows], H[:, X.indices])
+
+
 def rescaled_DH(D,H) :
     r"""Rescale the matrices D and H such that the columns of H sums approximately to one.
 
@@ -91,6 +216,8 @@ def rescaled_DH(D,H) :
     s = np.linalg.lstsq(H.T, o, rcond=None)[0]
     if (s<=0).any():
         s = np.maximum(nnls(H.T, o)[0], 1e-10)
+    # Keep the precision of the inputs (e.g. float32)
+    s = s.astype(H.dtype, copy=False)
     D_rescale = D@np.diag(1/s)
     H_rescale = np.diag(s)@H
     return D_rescale, H_rescale
@@ -396,16 +523,18 @@ def close_all():
 def get_explained_intensity_W(G, W, H) : 
     r""" Compute the explained intensity of each element of W.
 
-    :param np.array 2D G: G matrix of the ESpM-NMF decomposition
+    :param np.array 2D G: G matrix of the ESpM-NMF decomposition (np.array, scipy.sparse matrix or None for the identity)
     :param np.array 2D W: W matrix of the ESpM-NMF decomposition
     :param np.array 2D H: H matrix of the ESpM-NMF decomposition
 
     :return: np.array 2D
 
     """
-    # I couldn't find a linear algebra trick
-    int_matrix = np.zeros(W.shape)
-    for i in range(W.shape[0]) : 
-        for j in range(W.shape[1]) : 
-            int_matrix[i,j] = np.sum(G[:,i, np.newaxis]*W[i,j]*H[np.newaxis,j,:])
-    return int_matrix
\ No newline at end of file
+    # The sum over energies and pixels of G[:,i] W[i,j] H[j,:] factorizes into the column sums of G and the row sums of H
+    if G is None : 
+        # G is the identity matrix
+        G_sum = np.ones(W.shape[0])
+    else : 
+        G_sum = np.asarray(G.sum(axis=0)).ravel()
+    H_sum = np.sum(H, axis=1)
+    return G_sum[:, np.newaxis] * W * H_sum[np.newaxis, :]
\ No newline at end of file